@@ -0,0 +1,115 @@
+# app/core/middleware.py
+"""
+Middlewares ASGI puros de la aplicación.
+
+Se implementan como clases ASGI en lugar de `@app.middleware("http")`
+para evitar el `BaseHTTPMiddleware` de Starlette, que mueve el body de
+la respuesta entre dos tareas mediante un canal de memoria en cada request.
+"""
+
+import logging
+import time
+from collections import Counter
+
+from ..database.db_config import settings
+
+logger = logging.getLogger(__name__)
+
+# Headers de seguridad ya codificados a bytes, calculados una sola vez.
+# Fuera de producción queda vacío.
+SECURITY_HEADERS: list[tuple[bytes, bytes]] = [
+    (b"x-content-type-options", b"nosniff"),
+    (b"x-frame-options", b"DENY"),
+    (b"x-xss-protection", b"1; mode=block"),
+    (b"strict-transport-security", b"max-age=31536000"),
+] if settings.app_env == "production" else []
+
+# Rutas que nunca se registran en el log: documentación y esquema OpenAPI
+_SKIP_PATHS = frozenset({"/openapi.json"})
+_SKIP_PREFIXES = ("/docs", "/redoc")
+
+# Rutas de alto volumen que se registran por muestreo: 1 de cada N
+# (el /health lo consultan los probes de la plataforma cada pocos segundos)
+_SAMPLED_PREFIXES = {"/health": 100, "/static": 50}
+
+
+def _is_skipped(path: str) -> bool:
+    return path in _SKIP_PATHS or path.startswith(_SKIP_PREFIXES)
+
+
+class _SamplingFilter(logging.Filter):
+    """
+    Muestrea las líneas de log de rutas ruidosas.
+
+    Para cada prefijo se emite el primer hit y luego uno de cada N; las
+    respuestas con status >= 400 siempre pasan. Los registros sin
+    `req_path` (el resto de logs del módulo) no se filtran.
+    """
+
+    def __init__(self, rates: dict[str, int]):
+        super().__init__()
+        self.rates = rates
+        self.counts: Counter[str] = Counter()
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        path = getattr(record, "req_path", None)
+        if path is None or getattr(record, "status_code", 0) >= 400:
+            return True
+        for prefix, every in self.rates.items():
+            if path.startswith(prefix):
+                self.counts[prefix] += 1
+                return (self.counts[prefix] - 1) % every == 0
+        return True
+
+
+logger.addFilter(_SamplingFilter(_SAMPLED_PREFIXES))
+
+
+class AppMiddleware:
+    """
+    Middleware único de la aplicación.
+
+    En un solo wrapper de `send`:
+    - agrega SECURITY_HEADERS (solo producción) al iniciar la respuesta
+    - captura el status y registra una línea de log por request
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        # isEnabledFor usa la caché interna de logging; si INFO está filtrado
+        # no se mide tiempo ni se construye el mensaje
+        log_request = (
+            not _is_skipped(scope["path"]) and logger.isEnabledFor(logging.INFO)
+        )
+        if not log_request and not SECURITY_HEADERS:
+            await self.app(scope, receive, send)
+            return
+
+        start_time = time.perf_counter()
+        status_code = 500
+
+        async def send_wrapper(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+                if SECURITY_HEADERS:
+                    message["headers"] = [*message.get("headers", ()), *SECURITY_HEADERS]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            if log_request:
+                # Una sola línea por request, con formateo diferido
+                logger.info(
+                    "%s %s -> %s (%.3fs)",
+                    scope["method"], scope["path"], status_code,
+                    time.perf_counter() - start_time,
+                    extra={"req_path": scope["path"], "status_code": status_code},
+                )
@@ -1,32 +1,109 @@
 # app/core/security.py
 
+import asyncio
+import base64
+import calendar
+import hashlib
+import hmac
+import json
+import time
 from datetime import datetime, timedelta
 from typing import Optional
-from jose import JWTError, jwt
+import jwt as pyjwt
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric.ed25519 import Ed25519PrivateKey
+from jose import JWTError, jwk, jwt
 from passlib.context import CryptContext
-from fastapi import Depends, HTTPException, status
+from fastapi import Depends, HTTPException, Request, status
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
-from sqlalchemy.orm import Session
+from sqlalchemy.ext.asyncio import AsyncSession
 from ..database.database import get_db
 from ..models.user import User
 from ..database.db_config import settings
+from .cache import TTLCache
 import secrets
 
 # SEGURIDAD: Usar variable de entorno en lugar de hardcodear
 SECRET_KEY = settings.secret_key
-ALGORITHM = "HS256"
-ACCESS_TOKEN_EXPIRE_MINUTES = 30
+ALGORITHM = settings.jwt_algorithm
+ACCESS_TOKEN_EXPIRE_MINUTES = settings.jwt_expiration_minutes
 
 # Validar que SECRET_KEY sea suficientemente segura
 if len(SECRET_KEY) < 32:
     raise ValueError("SECRET_KEY debe tener al menos 32 caracteres")
 
-# Contexto de encriptación para passwords
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+if ALGORITHM not in ("HS256", "EdDSA"):
+    raise ValueError("JWT_ALGORITHM debe ser HS256 o EdDSA")
+
+
+def _b64url(data: bytes) -> bytes:
+    return base64.urlsafe_b64encode(data).rstrip(b"=")
+
+
+if ALGORITHM == "EdDSA":
+    # Claves Ed25519 cargadas una sola vez (sin parsear el PEM por token).
+    # Las firmas son deterministas y los servicios externos verifican con
+    # la clave pública del JWKS, sin conocer ningún secreto
+    if not settings.jwt_private_key:
+        raise ValueError("JWT_PRIVATE_KEY es requerida cuando JWT_ALGORITHM=EdDSA")
+    _ED25519_PRIVATE_KEY = serialization.load_pem_private_key(
+        settings.jwt_private_key.replace("\\n", "\n").encode("utf-8"),
+        password=None
+    )
+    if not isinstance(_ED25519_PRIVATE_KEY, Ed25519PrivateKey):
+        raise ValueError("JWT_PRIVATE_KEY debe ser una clave privada Ed25519")
+    _ED25519_PUBLIC_KEY = _ED25519_PRIVATE_KEY.public_key()
+    _ED25519_PUBLIC_RAW = _ED25519_PUBLIC_KEY.public_bytes(
+        serialization.Encoding.Raw, serialization.PublicFormat.Raw
+    )
+    _JWT_KID = _b64url(hashlib.sha256(_ED25519_PUBLIC_RAW).digest()[:12]).decode("ascii")
+    _JWKS = {
+        "keys": [{
+            "kty": "OKP",
+            "crv": "Ed25519",
+            "x": _b64url(_ED25519_PUBLIC_RAW).decode("ascii"),
+            "use": "sig",
+            "alg": "EdDSA",
+            "kid": _JWT_KID
+        }]
+    }
+else:
+    # Clave HMAC construida una sola vez; jose acepta un `Key` ya construido
+    # en encode/decode y así no re-deriva la clave (ni intenta parsearla como
+    # JWK en JSON) en cada token
+    _JWT_KEY = jwk.construct(SECRET_KEY, ALGORITHM)
+
+    # Para emitir tokens HS256 el header es siempre el mismo y el estado HMAC
+    # (clave con ipad/opad ya aplicados) se copia en lugar de recalcularse.
+    # Mismo formato que jose: JSON compacto y header con claves ordenadas
+    _JWT_HEADER_B64 = _b64url(
+        json.dumps({"alg": ALGORITHM, "typ": "JWT"}, separators=(",", ":"), sort_keys=True).encode()
+    )
+    _JWT_HMAC = hmac.new(SECRET_KEY.encode("utf-8"), digestmod=hashlib.sha256)
+
+    # Una clave simétrica nunca se publica
+    _JWKS = {"keys": []}
+
+# Contexto de encriptación para passwords: Argon2id para hashes nuevos;
+# bcrypt queda solo para verificar hashes existentes, que se migran a
+# Argon2id en el siguiente login exitoso (deprecated="auto")
+pwd_context = CryptContext(
+    schemes=["argon2", "bcrypt"],
+    deprecated="auto",
+    argon2__type="ID",
+    argon2__time_cost=settings.argon2_time_cost,
+    argon2__memory_cost=settings.argon2_memory_cost,
+    argon2__parallelism=settings.argon2_parallelism,
+    argon2__digest_size=32,
+    argon2__salt_size=16
+)
 
 # Configuración de Bearer token
 security = HTTPBearer()
 
+# Payloads de JWT ya verificados, indexados por hash del token
+_token_cache = TTLCache(maxsize=4096, ttl=ACCESS_TOKEN_EXPIRE_MINUTES * 60)
+
 
 # ============================================================
 # FUNCIONES DE HASHING DE CONTRASEÑAS
@@ -34,7 +111,7 @@ security = HTTPBearer()
 
 def hash_password(password: str) -> str:
     """
-    Hashea una contraseña usando bcrypt.
+    Hashea una contraseña usando Argon2id.
     
     Args:
         password: Contraseña en texto plano
@@ -59,6 +136,47 @@ def verify_password(plain_password: str, hashed_password: str) -> bool:
     return pwd_context.verify(plain_password, hashed_password)
 
 
+async def hash_password_async(password: str) -> str:
+    """
+    Variante de hash_password para rutas async.
+    
+    Argon2id es CPU y memory-bound; se ejecuta en el threadpool para no
+    bloquear el event loop.
+    """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(None, pwd_context.hash, password)
+
+
+async def verify_password_async(plain_password: str, hashed_password: str) -> bool:
+    """
+    Variante de verify_password para rutas async.
+    
+    Ejecuta la verificación en el threadpool para evitar bloquear
+    el event loop durante ráfagas de login.
+    """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(
+        None, pwd_context.verify, plain_password, hashed_password
+    )
+
+
+async def verify_and_update_password_async(
+    plain_password: str,
+    hashed_password: str
+) -> tuple[bool, Optional[str]]:
+    """
+    Verifica la contraseña y, si el hash usa un esquema o parámetros
+    obsoletos (p.ej. bcrypt), retorna también el nuevo hash Argon2id.
+    
+    Returns:
+        (es_valida, nuevo_hash o None)
+    """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(
+        None, pwd_context.verify_and_update, plain_password, hashed_password
+    )
+
+
 # ============================================================
 # FUNCIONES DE JWT
 # ============================================================
@@ -81,44 +199,127 @@ def create_access_token(data: dict, expires_delta: Optional[timedelta] = None) -
     else:
         expire = datetime.utcnow() + timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
     
-    to_encode.update({"exp": expire})
-    encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
+    to_encode["exp"] = calendar.timegm(expire.utctimetuple())
     
-    return encoded_jwt
+    if ALGORITHM == "EdDSA":
+        return pyjwt.encode(
+            to_encode,
+            _ED25519_PRIVATE_KEY,
+            algorithm="EdDSA",
+            headers={"kid": _JWT_KID}
+        )
+    
+    signing_input = (
+        _JWT_HEADER_B64 + b"." +
+        _b64url(json.dumps(to_encode, separators=(",", ":")).encode("utf-8"))
+    )
+    mac = _JWT_HMAC.copy()
+    mac.update(signing_input)
+    encoded_jwt = signing_input + b"." + _b64url(mac.digest())
+    
+    return encoded_jwt.decode("ascii")
+
+
+def get_jwks() -> dict:
+    """
+    Retorna el JWK Set público para verificar tokens fuera de esta API.
+    Con HS256 el conjunto está vacío.
+    """
+    return _JWKS
+
+
+def _token_cache_key(token: str) -> bytes:
+    return hashlib.blake2b(token.encode(), digest_size=16).digest()
 
 
 def decode_access_token(token: str) -> Optional[dict]:
     """
     Decodifica y valida un token JWT.
     
+    Los payloads válidos se guardan en cache hasta su `exp`, así un mismo
+    bearer token no repite la verificación de firma en cada request.
+    
     Args:
         token: Token JWT a decodificar
         
     Returns:
         Payload del token si es válido, None si no
     """
-    try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+    key = _token_cache_key(token)
+    payload = _token_cache.get(key)
+    if payload is not None:
         return payload
-    except JWTError:
+    
+    try:
+        if ALGORITHM == "EdDSA":
+            payload = pyjwt.decode(token, _ED25519_PUBLIC_KEY, algorithms=["EdDSA"])
+        else:
+            payload = jwt.decode(token, _JWT_KEY, algorithms=[ALGORITHM])
+    except (JWTError, pyjwt.InvalidTokenError):
         return None
+    
+    exp = payload.get("exp")
+    if exp is not None:
+        ttl = exp - time.time()
+        if ttl > 0:
+            _token_cache.set(key, payload, ttl=ttl)
+    return payload
 
 
 # ============================================================
 # DEPENDENCY PARA OBTENER USUARIO ACTUAL
 # ============================================================
 
-def get_current_user(
+# Usuarios por ID: cada petición autenticada resuelve su usuario y las
+# filas casi no cambian. Se guarda una tupla inmutable de columnas (sin
+# password_hash), no el objeto ORM, que pertenece a la sesión que lo cargó.
+# UserService invalida la entrada al modificar o borrar el usuario; en
+# otros workers el cambio se ve al expirar el TTL
+USER_CACHE_TTL_SECONDS = 60
+_user_cache = TTLCache(maxsize=10_000, ttl=USER_CACHE_TTL_SECONDS)
+_USER_CACHE_FIELDS = (
+    "user_id", "first_name", "middle_name", "first_surname", "second_surname",
+    "email", "is_active", "created_at", "updated_at"
+)
+
+
+async def get_user_cached(db: AsyncSession, user_id: int) -> Optional[User]:
+    """
+    Usuario por clave primaria, desde cache si está vigente.
+    
+    En un hit se arma un User transitorio (fuera de toda sesión) con las
+    columnas guardadas: sirve para leerlo, no para modificarlo con `db`.
+    """
+    snapshot = _user_cache.get(user_id)
+    if snapshot is not None:
+        return User(**dict(zip(_USER_CACHE_FIELDS, snapshot)))
+    user = await db.get(User, user_id)
+    if user is not None:
+        _user_cache.set(user_id, tuple(getattr(user, field) for field in _USER_CACHE_FIELDS))
+    return user
+
+
+def invalidate_user_cache(user_id: int) -> None:
+    """Descarta el usuario cacheado tras modificarlo o borrarlo."""
+    _user_cache.pop(user_id)
+
+
+async def get_current_user(
+    request: Request,
     credentials: HTTPAuthorizationCredentials = Depends(security),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_db)
 ) -> User:
     """
     Dependency para obtener el usuario autenticado actual.
     Valida el token JWT y retorna el usuario correspondiente.
     
+    El usuario se guarda en `request.state` para que otras dependencias
+    del mismo request no repitan la consulta.
+    
     Args:
+        request: Request actual
         credentials: Credenciales del header Authorization
-        db: Sesión de base de datos
+        db: Sesión async de base de datos
         
     Returns:
         Usuario autenticado
@@ -126,6 +327,10 @@ def get_current_user(
     Raises:
         HTTPException: Si el token es inválido o el usuario no existe
     """
+    cached_user = getattr(request.state, "current_user", None)
+    if cached_user is not None:
+        return cached_user
+    
     credentials_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
         detail="No se pudieron validar las credenciales",
@@ -146,8 +351,11 @@ def get_current_user(
     if user_id is None:
         raise credentials_exception
     
-    # Buscar usuario en la base de datos
-    user = db.query(User).filter(User.user_id == int(user_id)).first()
+    # Buscar usuario por clave primaria (cache de usuarios y luego la BD)
+    try:
+        user = await get_user_cached(db, int(user_id))
+    except ValueError:
+        raise credentials_exception
     
     if user is None:
         raise credentials_exception
@@ -159,6 +367,7 @@ def get_current_user(
             detail="Usuario inactivo"
         )
     
+    request.state.current_user = user
     return user
 
 
@@ -0,0 +1,20 @@
+# app/core/worker.py
+
+import os
+
+from uvicorn.workers import UvicornWorker
+
+
+class AppUvicornWorker(UvicornWorker):
+    """
+    Worker de gunicorn con uvloop + httptools explícitos (sin "auto": si
+    faltaran, el worker falla al arrancar en lugar de degradarse a asyncio
+    y h11 en silencio) y un tope de conexiones concurrentes por worker;
+    por encima del tope uvicorn responde 503 en lugar de encolar sin fin.
+    """
+
+    CONFIG_KWARGS = {
+        "loop": "uvloop",
+        "http": "httptools",
+        "limit_concurrency": int(os.getenv("LIMIT_CONCURRENCY", "1000")),
+    }
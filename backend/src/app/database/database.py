@@ -1,5 +1,8 @@
 # app/database/database.py
-from sqlalchemy import create_engine
+import logging
+import orjson
+from sqlalchemy import create_engine, event
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
 from sqlalchemy.orm import sessionmaker, declarative_base
 from .db_config import settings
 
@@ -8,13 +11,158 @@ DATABASE_URL = (
     f"{settings.db_host}:{settings.db_port}/{settings.db_name}"
 )
 
-engine = create_engine(DATABASE_URL, echo=True)
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+# Misma base de datos a través del driver async de psycopg v3
+ASYNC_DATABASE_URL = (
+    f"postgresql+psycopg://{settings.db_user}:{settings.db_password}@"
+    f"{settings.db_host}:{settings.db_port}/{settings.db_name}"
+)
+
+
+def _json_serializer(value) -> str:
+    """JSON/JSONB con orjson: más rápido y serializa date/datetime/UUID"""
+    return orjson.dumps(value).decode()
+
+
+# Opciones de pool compartidas por ambos engines.
+# - LIFO: reutiliza la conexión más reciente y deja que las ociosas expiren,
+#   manteniendo un conjunto pequeño de conexiones "calientes" en Neon.
+# - Sin pre_ping (evita un SELECT 1 extra en cada checkout); las conexiones
+#   muertas se detectan con keepalives TCP y se reciclan cada pocos minutos.
+# - Cache de compilación más grande que el default (500) para que las
+#   sentencias de las rutas calientes no se recompilen a SQL.
+ENGINE_OPTIONS = dict(
+    echo=settings.db_echo,
+    json_serializer=_json_serializer,
+    json_deserializer=orjson.loads,
+    query_cache_size=1200,
+    pool_size=settings.db_pool_size,
+    max_overflow=settings.db_max_overflow,
+    pool_use_lifo=True,
+    pool_pre_ping=False,
+    pool_recycle=settings.db_pool_recycle,
+    connect_args={
+        "keepalives": 1,
+        "keepalives_idle": 30,
+        "keepalives_interval": 10,
+        "keepalives_count": 3,
+        "sslmode": settings.db_sslmode,
+    },
+)
+
+# Los engines se crean en el primer uso dentro de cada worker, no al
+# importar: así ningún proceso hijo de gunicorn hereda sockets del padre.
+_engine = None
+_async_engine = None
+
 Base = declarative_base()
 
-def get_db():
+logger = logging.getLogger(__name__)
+
+# ============================================================
+# ENGINE SYNC (create_all y scripts como generate_embeddings)
+# ============================================================
+
+# Se enlaza al engine en get_engine()
+SessionLocal = sessionmaker(autocommit=False, autoflush=False)
+
+
+def get_engine():
+    """Retorna el engine sync, creándolo en el primer uso."""
+    global _engine
+    if _engine is None:
+        _engine = create_engine(DATABASE_URL, **ENGINE_OPTIONS)
+        SessionLocal.configure(bind=_engine)
+    return _engine
+
+
+def get_sync_db():
+    get_engine()
     db = SessionLocal()
     try:
         yield db
     finally:
         db.close()
+
+
+# ============================================================
+# ENGINE ASYNC (todas las rutas: no bloquean el event loop)
+# ============================================================
+
+# Se enlaza al engine en get_async_engine()
+AsyncSessionLocal = async_sessionmaker(
+    autoflush=False,
+    expire_on_commit=False
+)
+
+
+async def _register_vector(connection) -> None:
+    """
+    Registra en la conexión psycopg el tipo de pgvector de las columnas de
+    embeddings (EMBEDDING_TYPE): los vectores se envían en formato binario
+    (float4 para `vector`, float2 para `halfvec`) en lugar de un literal de
+    texto que PostgreSQL tiene que parsear. Solo se consulta ese tipo (un
+    viaje por conexión nueva del pool, no uno por consulta).
+    """
+    from psycopg.types import TypeInfo
+
+    info = await TypeInfo.fetch(connection, settings.embedding_type)
+    if settings.embedding_type == "halfvec":
+        from pgvector.psycopg.halfvec import register_halfvec_info
+        register_halfvec_info(connection, info)
+    else:
+        from pgvector.psycopg.vector import register_vector_info
+        register_vector_info(connection, info)
+
+
+def _on_async_connect(dbapi_connection, connection_record) -> None:
+    try:
+        dbapi_connection.run_async(_register_vector)
+    except Exception as e:
+        # Sin la extensión solo falla la búsqueda vectorial, no la conexión
+        logger.warning(f"No se pudo registrar el tipo vector de pgvector: {e}")
+
+
+def get_async_engine():
+    """Retorna el engine async, creándolo en el primer uso."""
+    global _async_engine
+    if _async_engine is None:
+        _async_engine = create_async_engine(ASYNC_DATABASE_URL, **ENGINE_OPTIONS)
+        event.listen(_async_engine.sync_engine, "connect", _on_async_connect)
+        AsyncSessionLocal.configure(bind=_async_engine)
+    return _async_engine
+
+
+def new_async_session() -> AsyncSession:
+    """Crea una AsyncSession fuera de la inyección de dependencias."""
+    get_async_engine()
+    return AsyncSessionLocal()
+
+
+async def get_db():
+    async with new_async_session() as db:
+        yield db
+
+
+# ============================================================
+# CICLO DE VIDA
+# ============================================================
+
+def reset_engines_after_fork():
+    """
+    Descarta los pools heredados tras un fork (gunicorn --preload).
+    
+    `close=False` evita cerrar sockets que siguen en uso por el proceso
+    padre; el hijo abrirá conexiones propias en el siguiente checkout.
+    """
+    if _engine is not None:
+        _engine.dispose(close=False)
+    if _async_engine is not None:
+        _async_engine.sync_engine.dispose(close=False)
+
+
+async def dispose_engines():
+    """Cierra los pools de conexiones al apagar la aplicación."""
+    if _async_engine is not None:
+        await _async_engine.dispose()
+    if _engine is not None:
+        _engine.dispose()
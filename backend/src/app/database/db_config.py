@@ -1,5 +1,7 @@
 import os
+from functools import lru_cache
 from pathlib import Path
+from typing import Literal, Optional
 from pydantic_settings import BaseSettings, SettingsConfigDict
 
 # Encontrar la raíz del proyecto (donde está el .env)
@@ -14,10 +16,35 @@ class Settings(BaseSettings):
     db_name: str
     db_user: str
     db_password: str
+    # Pool por worker: con varios workers de gunicorn el total es
+    # workers * (pool_size + max_overflow) por engine; mantenerlo bajo el
+    # límite de conexiones de Neon
+    db_pool_size: int = 5
+    db_max_overflow: int = 5
+    db_pool_recycle: int = 300
+    db_sslmode: str = "prefer"
+    # Loguear cada sentencia SQL (costoso; solo para depuración)
+    db_echo: bool = False
+    # Ejecutar Base.metadata.create_all al arrancar (solo desarrollo)
+    auto_create_tables: bool = False
     
     # === CONFIGURACIÓN DE SEGURIDAD ===
     secret_key: str
     app_env: str = "production"
+    # JWT: HS256 firma con SECRET_KEY; EdDSA firma con una clave Ed25519
+    # (PEM PKCS8 en JWT_PRIVATE_KEY) y publica la pública en el JWKS
+    jwt_algorithm: str = "HS256"
+    jwt_expiration_minutes: int = 30
+    jwt_private_key: Optional[str] = None
+    # CORS: orígenes exactos separados por coma ("*" = todos) y/o un regex.
+    # El frontend se sirve desde el mismo origen, así que por defecto no se
+    # habilita ningún origen externo
+    cors_origins: str = ""
+    cors_origin_regex: Optional[str] = None
+    # Parámetros de Argon2id (memoria en KiB); en dev/tests se pueden bajar
+    argon2_time_cost: int = 2
+    argon2_memory_cost: int = 65536
+    argon2_parallelism: int = 2
     
     # === CONFIGURACIÓN DEL LLM ===
     openai_api_key: str
@@ -25,25 +52,56 @@ class Settings(BaseSettings):
     llm_temperature: float = 0.1
     llm_max_tokens: int = 500
     llm_timeout: int = 30
+    # Reintentos del SDK de OpenAI (429, 5xx, timeouts y errores de red,
+    # con backoff exponencial y jitter) y peticiones simultáneas por worker
+    llm_max_retries: int = 2
+    llm_max_concurrency: int = 10
+    # Tokens de entrada por petición (contexto + pregunta); la respuesta
+    # (max_completion_tokens) se descuenta de aquí antes de armar el contexto
+    llm_max_context_tokens: int = 16000
+    # Mismo modelo para indexar (generate_embeddings) y para las preguntas:
+    # vectores de modelos distintos no son comparables
+    embedding_model: str = "text-embedding-ada-002"
+    # Tipo de las columnas de embeddings: "halfvec" después de aplicar
+    # 06-halfvec-embeddings.sql (mitad de bytes por vector)
+    embedding_type: Literal["vector", "halfvec"] = "vector"
     
     # Configuración de Pydantic
     model_config = SettingsConfigDict(
         env_file=str(ENV_PATH) if ENV_PATH.exists() else None,
         env_file_encoding="utf-8",
         case_sensitive=False,
-        extra='ignore'  #  CRÍTICO: Ignora campos extra del .env
+        extra='ignore',  #  CRÍTICO: Ignora campos extra del .env
+        frozen=True  # Configuración inmutable una vez cargada
     )
     
+    @property
+    def cors_origin_set(self) -> frozenset[str]:
+        """Orígenes CORS exactos como frozenset (búsqueda O(1))"""
+        return frozenset(o.strip() for o in self.cors_origins.split(",") if o.strip())
+    
     @property
     def database_url(self) -> str:
         """Construye la URL de conexión a PostgreSQL"""
         return f"postgresql://{self.db_user}:{self.db_password}@{self.db_host}:{self.db_port}/{self.db_name}"
 
-# Mostrar advertencia si no encuentra el .env
-if not ENV_PATH.exists():
-    print(f"  Archivo .env no encontrado en: {ENV_PATH}")
-    print(f"   Crea el archivo .env en la raíz del proyecto")
-else:
-    print(f" Archivo .env encontrado en: {ENV_PATH}")
 
-settings = Settings()
+@lru_cache(maxsize=1)
+def get_settings() -> Settings:
+    """
+    Carga la configuración una sola vez por proceso.
+    
+    Las variables de entorno y el .env se leen y validan en la primera
+    llamada; las siguientes retornan la misma instancia.
+    """
+    # Mostrar advertencia si no encuentra el .env
+    if not ENV_PATH.exists():
+        print(f"  Archivo .env no encontrado en: {ENV_PATH}")
+        print(f"   Crea el archivo .env en la raíz del proyecto")
+    else:
+        print(f" Archivo .env encontrado en: {ENV_PATH}")
+
+    return Settings()
+
+
+settings = get_settings()
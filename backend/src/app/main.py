@@ -2,18 +2,25 @@
 
 from fastapi import FastAPI, Request, status
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse, FileResponse, RedirectResponse
+from fastapi.responses import FileResponse, ORJSONResponse, RedirectResponse, Response
 from fastapi.staticfiles import StaticFiles
 from fastapi.exceptions import RequestValidationError
 from starlette.exceptions import HTTPException as StarletteHTTPException
+import asyncio
+import importlib
 import logging
 import time
 import os
+from email.utils import formatdate
 from pathlib import Path
 
 from .routers import auth, user, query, websocket_chat, history , catalog 
-from .database.database import Base, engine
+from .database.database import Base, get_engine, get_async_engine, dispose_engines
 from .database.db_config import settings
+from .core.middleware import AppMiddleware
+from .core.security import get_jwks
+from .services.llm_service import llm_service
+from .services.audit_writer import audit_writer
 
 # Configuración de logging
 logging.basicConfig(
@@ -22,14 +29,6 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-# Crear tablas en la base de datos
-try:
-    Base.metadata.create_all(bind=engine)
-    logger.info("Tablas de base de datos creadas exitosamente")
-except Exception as e:
-    logger.error(f"Error creando tablas: {str(e)}")
-    raise
-
 # ============================================================
 # CREAR APLICACIÓN
 # ============================================================
@@ -40,82 +39,82 @@ app = FastAPI(
     docs_url="/docs",
     redoc_url="/redoc",
     openapi_url="/openapi.json",
+    # Respuestas serializadas con orjson (más rápido que json.dumps)
+    default_response_class=ORJSONResponse,
     swagger_ui_parameters={
         "syntaxHighlight.theme": "monokai",
         "tryItOutEnabled": True
-    }
+    },
+    # Un solo schema por modelo en OpenAPI (sin variantes -Input/-Output)
+    separate_input_output_schemas=False
 )
 
 # ============================================================
 # MIDDLEWARES
 # ============================================================
 
+# Starlette solo usa `in` sobre allow_origins, así que un frozenset sirve
+# directamente; el regex se compila una vez al crear el middleware
+cors_origin_regex = settings.cors_origin_regex
+if cors_origin_regex is None and settings.app_env == "development":
+    cors_origin_regex = r"https?://(localhost|127\.0\.0\.1)(:\d+)?"
+
 app.add_middleware(
     CORSMiddleware,
-    allow_origins=["*"],
+    allow_origins=settings.cors_origin_set,
+    allow_origin_regex=cors_origin_regex,
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
 )
 
-@app.middleware("http")
-async def add_security_headers(request: Request, call_next):
-    response = await call_next(request)
-    if settings.app_env == "production":
-        response.headers["X-Content-Type-Options"] = "nosniff"
-        response.headers["X-Frame-Options"] = "DENY"
-        response.headers["X-XSS-Protection"] = "1; mode=block"
-        response.headers["Strict-Transport-Security"] = "max-age=31536000"
-    return response
-
-@app.middleware("http")
-async def log_requests(request: Request, call_next):
-    start_time = time.time()
-    logger.info(f"Request: {request.method} {request.url.path}")
-    response = await call_next(request)
-    process_time = time.time() - start_time
-    logger.info(f"Response: {response.status_code} Time: {process_time:.3f}s Path: {request.url.path}")
-    return response
+app.add_middleware(AppMiddleware)
 
 # ============================================================
 # EXCEPTION HANDLERS
 # ============================================================
 
-@app.exception_handler(StarletteHTTPException)
-async def http_exception_handler(request: Request, exc: StarletteHTTPException):
-    logger.warning(f"HTTP Exception: {exc.status_code} - {exc.detail}")
-    return JSONResponse(
-        status_code=exc.status_code,
-        content={
-            "status": "error",
-            "error": {
-                "code": f"HTTP_{exc.status_code}",
-                "message": exc.detail
+async def exception_handler(request: Request, exc: Exception):
+    """
+    Handler único con despacho por tipo.
+    
+    Los 4xx (HTTPException y errores de validación) se responden sin
+    formatear traceback; solo las excepciones no controladas se registran
+    con `exc_info`.
+    """
+    if isinstance(exc, StarletteHTTPException):
+        logger.warning("HTTP Exception: %s - %s", exc.status_code, exc.detail)
+        return ORJSONResponse(
+            status_code=exc.status_code,
+            content={
+                "status": "error",
+                "error": {
+                    "code": f"HTTP_{exc.status_code}",
+                    "message": exc.detail
+                }
             }
-        }
-    )
-
-@app.exception_handler(RequestValidationError)
-async def validation_exception_handler(request: Request, exc: RequestValidationError):
-    logger.warning(f"Validation Error: {exc.errors()}")
-    return JSONResponse(
-        status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
-        content={
-            "status": "error",
-            "error": {
-                "code": "VALIDATION_ERROR",
-                "message": "Error de validación en los datos enviados",
-                "details": exc.errors()
+        )
+    
+    if isinstance(exc, RequestValidationError):
+        errors = exc.errors()
+        logger.warning("Validation Error: %s", errors)
+        return ORJSONResponse(
+            status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+            content={
+                "status": "error",
+                "error": {
+                    "code": "VALIDATION_ERROR",
+                    "message": "Error de validación en los datos enviados",
+                    "details": errors
+                }
             }
-        }
-    )
-
-@app.exception_handler(Exception)
-async def general_exception_handler(request: Request, exc: Exception):
-    logger.error(f"Unhandled Exception: {type(exc).__name__}: {str(exc)}", exc_info=True)
+        )
+    
+    if logger.isEnabledFor(logging.ERROR):
+        logger.error("Unhandled Exception: %s: %s", type(exc).__name__, exc, exc_info=True)
     
     if settings.app_env == "development":
-        return JSONResponse(
+        return ORJSONResponse(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
             content={
                 "status": "error",
@@ -127,7 +126,7 @@ async def general_exception_handler(request: Request, exc: Exception):
             }
         )
     
-    return JSONResponse(
+    return ORJSONResponse(
         status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
         content={
             "status": "error",
@@ -138,6 +137,13 @@ async def general_exception_handler(request: Request, exc: Exception):
         }
     )
 
+
+# Starlette atiende HTTPException y RequestValidationError en
+# ExceptionMiddleware y `Exception` en ServerErrorMiddleware, por eso la
+# misma función se registra para los tres tipos
+for _exc_type in (StarletteHTTPException, RequestValidationError, Exception):
+    app.add_exception_handler(_exc_type, exception_handler)
+
 # ============================================================
 # ROUTERS DE LA API
 # ============================================================
@@ -166,13 +172,17 @@ else:
     FRONTEND_DIR = Path("/app/frontend")
     logger.info(f"🔧 Usando ruta por defecto: {FRONTEND_DIR}")
 
+# El contenido del frontend no cambia en runtime: se verifica una sola vez
+FRONTEND_DIR = FRONTEND_DIR.resolve()
+FRONTEND_EXISTS = FRONTEND_DIR.is_dir()
+
 # Logs de diagnóstico
 logger.info("=" * 60)
 logger.info(" DIAGNÓSTICO DE RUTAS DEL FRONTEND")
 logger.info(f" FRONTEND_DIR: {FRONTEND_DIR}")
-logger.info(f" Frontend existe: {FRONTEND_DIR.exists()}")
+logger.info(f" Frontend existe: {FRONTEND_EXISTS}")
 
-if FRONTEND_DIR.exists():
+if FRONTEND_EXISTS:
     try:
         contenido = [item.name for item in FRONTEND_DIR.iterdir()]
         logger.info(f" Contenido: {contenido}")
@@ -187,19 +197,19 @@ logger.info("=" * 60)
 # MONTAR ARCHIVOS ESTÁTICOS Y FRONTEND
 # ============================================================
 
-if FRONTEND_DIR.exists():
+if FRONTEND_EXISTS:
     static_dir = FRONTEND_DIR / "static"
     public_dir = FRONTEND_DIR / "public"
     
     # Montar archivos estáticos
-    if static_dir.exists():
+    if static_dir.is_dir():
         app.mount("/static", StaticFiles(directory=str(static_dir)), name="static")
         logger.info(f" Archivos estáticos montados: {static_dir}")
     else:
         logger.warning(f"  Carpeta static no encontrada: {static_dir}")
     
     # Verificar carpeta public
-    if public_dir.exists():
+    if public_dir.is_dir():
         logger.info(f" Carpeta public encontrada: {public_dir}")
         FRONTEND_MOUNTED = True
         
@@ -227,41 +237,57 @@ if FRONTEND_MOUNTED:
         """Redirige a la página de login"""
         return RedirectResponse(url="/login", status_code=302)
     
-    @app.get("/login", tags=["Frontend"])
-    async def serve_login():
-        """Sirve la página de login"""
-        login_path = public_dir / "login.html"
-        if login_path.exists():
-            logger.info(f" Sirviendo login desde: {login_path}")
-            return FileResponse(str(login_path))
-        logger.error(f" Login no encontrado en: {login_path}")
-        raise StarletteHTTPException(status_code=404, detail="Página de login no encontrada")
-    
-    @app.get("/chat", tags=["Frontend"])
-    async def serve_chat():
-        """Sirve la aplicación de chat"""
-        index_path = public_dir / "index.html"
-        if index_path.exists():
-            logger.info(f" Sirviendo chat desde: {index_path}")
-            return FileResponse(str(index_path))
-        logger.error(f" Chat no encontrado en: {index_path}")
-        raise StarletteHTTPException(status_code=404, detail="Frontend no encontrado")
-    
-    @app.get("/register", tags=["Frontend"])
-    async def serve_register():
-        """Sirve la página de registro"""
-        register_path = public_dir / "register.html"
-        if register_path.exists():
-            return FileResponse(str(register_path))
-        raise StarletteHTTPException(status_code=404, detail="Página de registro no encontrada")
-    
-    @app.get("/unauthorized", tags=["Frontend"])
-    async def serve_unauthorized():
-        """Sirve la página de no autorizado"""
-        unauthorized_path = public_dir / "unauthorized.html"
-        if unauthorized_path.exists():
-            return FileResponse(str(unauthorized_path))
-        raise StarletteHTTPException(status_code=404, detail="Página no encontrada")
+    def _html_page(filename: str, not_found_detail: str):
+        """
+        Crea el handler de una página HTML del frontend.
+
+        El archivo se resuelve y se le hace `stat` una sola vez al registrar
+        la ruta; con mtime y tamaño se arma un ETag débil (mismo esquema que
+        nginx) para responder 304 a los GET condicionales del navegador.
+        """
+        path = public_dir / filename
+        try:
+            st = path.stat()
+        except OSError:
+            logger.error(f" {filename} no encontrado en: {path}")
+
+            async def missing_page():
+                raise StarletteHTTPException(status_code=404, detail=not_found_detail)
+
+            return missing_page
+
+        etag = f'W/"{int(st.st_mtime):x}-{st.st_size:x}"'
+        last_modified = formatdate(st.st_mtime, usegmt=True)
+        cache_headers = {
+            "ETag": etag,
+            "Last-Modified": last_modified,
+            "Cache-Control": "public, max-age=60, must-revalidate",
+        }
+
+        async def serve_page(request: Request):
+            if_none_match = request.headers.get("if-none-match")
+            if if_none_match is not None:
+                not_modified = etag in if_none_match or if_none_match.strip() == "*"
+            else:
+                not_modified = request.headers.get("if-modified-since") == last_modified
+            if not_modified:
+                return Response(status_code=304, headers=cache_headers)
+            return FileResponse(str(path), stat_result=st, headers=cache_headers)
+
+        return serve_page
+
+    app.get("/login", tags=["Frontend"], name="serve_login", summary="Sirve la página de login")(
+        _html_page("login.html", "Página de login no encontrada")
+    )
+    app.get("/chat", tags=["Frontend"], name="serve_chat", summary="Sirve la aplicación de chat")(
+        _html_page("index.html", "Frontend no encontrado")
+    )
+    app.get("/register", tags=["Frontend"], name="serve_register", summary="Sirve la página de registro")(
+        _html_page("register.html", "Página de registro no encontrada")
+    )
+    app.get("/unauthorized", tags=["Frontend"], name="serve_unauthorized", summary="Sirve la página de no autorizado")(
+        _html_page("unauthorized.html", "Página no encontrada")
+    )
     
     logger.info(" Endpoints del frontend registrados correctamente")
 
@@ -315,32 +341,36 @@ def api_info():
         }
     }
 
+# Cache del probe de base de datos: acota las consultas a un SELECT 1 cada
+# _HEALTH_TTL segundos sin importar cuántos readiness probes lleguen
+_HEALTH_TTL = 2.0
+_HEALTH_CACHE = {"ts": 0.0, "status": "unknown", "err": None}
+
+
+async def _probe_database():
+    """Ejecuta SELECT 1 con una conexión del pool async."""
+    async with get_async_engine().connect() as conn:
+        await conn.exec_driver_sql("SELECT 1")
+
+
 @app.get("/health", tags=["Health"])
-def health():
+async def health():
     """Health check endpoint"""
-    db_status = "disconnected"
-    error_details = None
-    
-    try:
-        from .database.database import SessionLocal
-        from sqlalchemy import text
-        
-        db = SessionLocal()
+    now = time.monotonic()
+    if now - _HEALTH_CACHE["ts"] >= _HEALTH_TTL:
         try:
-            result = db.execute(text("SELECT 1"))
-            result.scalar()
-            db_status = "connected"
+            await _probe_database()
+            _HEALTH_CACHE["status"] = "connected"
+            _HEALTH_CACHE["err"] = None
         except Exception as db_error:
-            db_status = "disconnected"
-            error_details = str(db_error)
+            _HEALTH_CACHE["status"] = "disconnected"
+            _HEALTH_CACHE["err"] = str(db_error)
             logger.error(f"Database health check failed: {db_error}")
-        finally:
-            db.close()
-    except Exception as e:
-        db_status = "error"
-        error_details = str(e)
-        logger.error(f"Database health check error: {e}")
-    
+        _HEALTH_CACHE["ts"] = now
+
+    db_status = _HEALTH_CACHE["status"]
+    error_details = _HEALTH_CACHE["err"]
+
     is_healthy = db_status == "connected"
     
     response = {
@@ -362,10 +392,25 @@ def health():
     
     return response
 
+@app.get("/.well-known/jwks.json", tags=["Health"], include_in_schema=False)
+def jwks():
+    """Claves públicas para verificar los JWT emitidos (solo EdDSA)"""
+    return get_jwks()
+
 # ============================================================
 # STARTUP/SHUTDOWN EVENTS
 # ============================================================
 
+async def _warm_up_llm(openai_import: asyncio.Future) -> None:
+    """Calienta el cliente de OpenAI (chat y embeddings) sin fallar el arranque."""
+    try:
+        await openai_import
+        await llm_service.warm_up()
+        logger.info("Conexiones con la API de OpenAI listas")
+    except Exception as e:
+        logger.warning(f"No se pudo precalentar la conexión con OpenAI: {type(e).__name__}")
+
+
 @app.on_event("startup")
 async def startup_event():
     logger.info("=" * 60)
@@ -378,6 +423,53 @@ async def startup_event():
     logger.info(f" Documentación disponible en: /docs y /redoc")
     logger.info("=" * 60)
 
+    # Precargar en segundo plano los módulos pesados que las rutas importan
+    # de forma diferida (openai ~0.4s); /health responde mientras tanto
+    loop = asyncio.get_running_loop()
+    openai_import = loop.run_in_executor(None, importlib.import_module, "openai")
+
+    # Con openai ya importado, abrir las conexiones a la API en segundo
+    # plano para que la primera consulta no pague el handshake TLS
+    app.state.llm_warm_up = asyncio.create_task(_warm_up_llm(openai_import))
+
+    # audit_logs se escriben por lotes desde una tarea del worker
+    audit_writer.start()
+
+    # Crear tablas solo si se habilita explícitamente (dev); en producción
+    # el esquema lo gestionan los scripts DDL / migraciones
+    if settings.auto_create_tables:
+        try:
+            await loop.run_in_executor(None, Base.metadata.create_all, get_engine())
+            logger.info("Tablas de base de datos creadas exitosamente")
+        except Exception as e:
+            logger.error(f"Error creando tablas: {str(e)}")
+            raise
+
 @app.on_event("shutdown")
 async def shutdown_event():
-    logger.info(" SmartHealth API cerrando")
\ No newline at end of file
+    logger.info(" SmartHealth API cerrando")
+    app.state.llm_warm_up.cancel()
+    # Los registros encolados se escriben antes de cerrar los pools
+    await audit_writer.stop()
+    await dispose_engines()
+
+
+# ============================================================
+# EJECUCIÓN DIRECTA (python -m app.main)
+# ============================================================
+
+if __name__ == "__main__":
+    import uvicorn
+
+    # uvloop (event loop sobre libuv) + httptools (parser HTTP en C).
+    # Workers: WEB_CONCURRENCY o la recomendación 2 * núcleos + 1
+    uvicorn.run(
+        "app.main:app",
+        host="0.0.0.0",
+        port=int(os.getenv("PORT", "8000")),
+        loop="uvloop",
+        http="httptools",
+        workers=int(os.getenv("WEB_CONCURRENCY", (os.cpu_count() or 1) * 2 + 1)),
+        limit_concurrency=int(os.getenv("LIMIT_CONCURRENCY", "1000")),
+        timeout_keep_alive=30,
+    )
@@ -20,5 +20,6 @@ class AuditLog(Base):
     response_json = Column(JSONB, nullable=False)
     created_at = Column(TIMESTAMP, server_default=func.now())
 
-    # relación con users
-    user = relationship("User", back_populates="audit_logs")
\ No newline at end of file
+    # relación con users; lazy="raise": cargarla exige selectinload explícito
+    # (un acceso perezoso por fila sería un N+1 y en async ni siquiera funciona)
+    user = relationship("User", back_populates="audit_logs", lazy="raise")
\ No newline at end of file
@@ -0,0 +1,13 @@
+from sqlalchemy import Column, Integer
+from sqlalchemy.dialects.postgresql import UUID
+from ..database.database import Base
+
+
+# Último sequence_chat_id asignado por sesión de chat; en bases existentes
+# la tabla la crea 07-create-chat-session-counters.sql
+class ChatSessionCounter(Base):
+    __tablename__ = "chat_session_counters"
+    __table_args__ = {"schema": "smart_health"}
+
+    session_id = Column(UUID(as_uuid=True), primary_key=True)
+    last_seq = Column(Integer, nullable=False)
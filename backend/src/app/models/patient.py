@@ -1,6 +1,6 @@
 # src/app/models/patient.py
-from sqlalchemy import Column, Integer, String, Date, Boolean, TIMESTAMP, CheckConstraint
-from sqlalchemy.orm import relationship
+from sqlalchemy import Column, Integer, String, Date, Boolean, TIMESTAMP, CheckConstraint, func
+from sqlalchemy.orm import column_property, relationship
 from app.database.database import Base
 from datetime import datetime
 
@@ -22,6 +22,12 @@ class Patient(Base):
     active = Column(Boolean, default=True)
     blood_type = Column(String(5))
 
+    # Nombre para mostrar (primer nombre, primer y segundo apellido) armado
+    # por PostgreSQL en la misma consulta; concat_ws omite los NULL
+    full_name = column_property(
+        func.concat_ws(' ', first_name, first_surname, func.nullif(second_surname, ''))
+    )
+
     #  Relationships usando strings para evitar imports circulares
     # appointments = relationship("Appointment", back_populates="patient")
     # medical_records = relationship("MedicalRecord", back_populates="patient")
\ No newline at end of file
@@ -1,7 +1,7 @@
 # app/models/user.py
 
 from sqlalchemy import Column, Integer, String, Boolean, DateTime
-from sqlalchemy.orm import relationship
+from sqlalchemy.orm import deferred, relationship
 from sqlalchemy.sql import func
 from ..database.database import Base
 
@@ -16,13 +16,15 @@ class User(Base):
     first_surname = Column(String(50), nullable=False)
     second_surname = Column(String(50), nullable=True)
     email = Column(String(100), unique=True, nullable=False, index=True)
-    password_hash = Column(String(255), nullable=False)
+    # Diferido: solo el login lo necesita y lo selecciona como columna
+    # (get_login_credentials); raiseload evita lazy loads accidentales
+    password_hash = deferred(Column(String(255), nullable=False), raiseload=True)
     is_active = Column(Boolean, default=True, nullable=False)
     created_at = Column(DateTime(timezone=True), server_default=func.now(), nullable=False)
     updated_at = Column(DateTime(timezone=True), server_default=func.now(), onupdate=func.now(), nullable=False)
 
-    # Relación con audit_logs
-    audit_logs = relationship("AuditLog", back_populates="user")
+    # Relación con audit_logs; lazy="raise" igual que en AuditLog.user
+    audit_logs = relationship("AuditLog", back_populates="user", lazy="raise")
 
     def __repr__(self):
         return f"<User {self.email}>"
\ No newline at end of file
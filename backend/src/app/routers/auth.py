@@ -1,11 +1,15 @@
 # src/app/routers/auth.py
 
+import logging
+
 from fastapi import APIRouter, Depends, HTTPException, status
-from sqlalchemy.orm import Session
+from sqlalchemy.ext.asyncio import AsyncSession
 from app.schemas.user import UserCreate, UserLogin, UserResponse, TokenResponse
 from app.database.database import get_db
 from app.services.auth_service import AuthService  # ← Import directo
 
+logger = logging.getLogger(__name__)
+
 router = APIRouter(
     prefix="/auth",
     tags=["Authentication"]
@@ -19,7 +23,7 @@ router = APIRouter(
     summary="Registrar nuevo usuario",
     description="Crea un nuevo usuario en el sistema con los datos proporcionados"
 )
-def register_user(user_data: UserCreate, db: Session = Depends(get_db)):
+async def register_user(user_data: UserCreate, db: AsyncSession = Depends(get_db)):
     """
     Registra un nuevo usuario en el sistema.
     
@@ -34,11 +38,12 @@ def register_user(user_data: UserCreate, db: Session = Depends(get_db)):
         UserResponse: Datos del usuario creado (sin contraseña)
     
     Raises:
-        HTTPException 400: Si el email ya está registrado o la contraseña es inválida
+        HTTPException 400: Si el email ya está registrado
+        HTTPException 422: Si los datos no cumplen el schema (email, longitudes)
         HTTPException 500: Error interno del servidor
     """
     try:
-        new_user = AuthService.register_user(db, user_data)
+        new_user = await AuthService.register_user(db, user_data)
         return new_user
     except ValueError as e:
         raise HTTPException(
@@ -58,7 +63,7 @@ def register_user(user_data: UserCreate, db: Session = Depends(get_db)):
     summary="Iniciar sesión",
     description="Autentica al usuario y devuelve un token JWT"
 )
-def login_user(login_data: UserLogin, db: Session = Depends(get_db)):
+async def login_user(login_data: UserLogin, db: AsyncSession = Depends(get_db)):
     """
     Inicia sesión y devuelve un token de acceso.
     
@@ -78,7 +83,7 @@ def login_user(login_data: UserLogin, db: Session = Depends(get_db)):
     ```
     """
     try:
-        token_data = AuthService.login(db, login_data.email, login_data.password)
+        token_data = await AuthService.login(db, login_data.email, login_data.password)
         return TokenResponse(**token_data)
     except ValueError as e:
         raise HTTPException(
@@ -87,8 +92,6 @@ def login_user(login_data: UserLogin, db: Session = Depends(get_db)):
             headers={"WWW-Authenticate": "Bearer"}
         )
     except Exception as e:
-        import logging
-        logger = logging.getLogger(__name__)
         logger.error(f"Error en login: {type(e).__name__}: {str(e)}", exc_info=True)
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
@@ -1,7 +1,7 @@
 # src/app/routers/catalog.py
 
 from fastapi import APIRouter, Depends, HTTPException, status
-from sqlalchemy.orm import Session
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy import text
 from typing import List
 import logging
@@ -23,14 +23,14 @@ logger = logging.getLogger(__name__)
     summary="Obtener todos los tipos de documento",
     description="Retorna la lista completa de tipos de documento disponibles en el sistema"
 )
-def get_document_types(db: Session = Depends(get_db)):
+async def get_document_types(db: AsyncSession = Depends(get_db)):
     """
     Obtiene todos los tipos de documento disponibles en la base de datos.
     No requiere autenticación ya que es información pública del catálogo.
     """
     try:
         # Consultar tipos de documento desde la base de datos
-        result = db.execute(text("""
+        result = await db.execute(text("""
             SELECT 
                 document_type_id,
                 type_name,
@@ -1,8 +1,9 @@
 # src/app/routers/history.py
 
 from fastapi import APIRouter, Depends, HTTPException, status
-from sqlalchemy.orm import Session
-from sqlalchemy import desc
+from fastapi.responses import ORJSONResponse
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy import desc, select
 from typing import List
 from datetime import datetime
 from app.database.database import get_db
@@ -34,23 +35,33 @@ class HistoryItemResponse(BaseModel):
     response_model=List[HistoryItemResponse],
     summary="Obtener historial de consultas del usuario"
 )
-def get_user_history(
+async def get_user_history(
     limit: int = 50,
     current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_db)
 ):
     """
     Obtiene el historial de consultas del usuario autenticado.
     Requiere token JWT válido.
     """
     try:
-        history = (
-            db.query(AuditLog)
-            .filter(AuditLog.user_id == current_user.user_id)
+        # Solo las columnas de la respuesta: filas livianas en vez de
+        # objetos AuditLog (response_json puede ser grande y aquí no se usa)
+        rows = await db.execute(
+            select(
+                AuditLog.audit_log_id,
+                AuditLog.session_id,
+                AuditLog.sequence_chat_id,
+                AuditLog.question,
+                AuditLog.created_at,
+                AuditLog.document_type_id,
+                AuditLog.document_number
+            )
+            .where(AuditLog.user_id == current_user.user_id)
             .order_by(desc(AuditLog.created_at))
             .limit(limit)
-            .all()
         )
+        history = rows.all()
         
         # Convertir session_id a string
         result = []
@@ -77,10 +88,10 @@ def get_user_history(
     "/session/{session_id}",
     summary="Obtener consultas de una sesión específica"
 )
-def get_session_history(
+async def get_session_history(
     session_id: str,
     current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_db)
 ):
     """
     Obtiene todas las consultas de una sesión específica con sus respuestas.
@@ -89,15 +100,24 @@ def get_session_history(
     try:
         session_uuid = UUID(session_id)
         
-        history = (
-            db.query(AuditLog)
-            .filter(
+        rows = await db.execute(
+            select(
+                AuditLog.audit_log_id,
+                AuditLog.session_id,
+                AuditLog.sequence_chat_id,
+                AuditLog.question,
+                AuditLog.response_json,
+                AuditLog.created_at,
+                AuditLog.document_type_id,
+                AuditLog.document_number
+            )
+            .where(
                 AuditLog.user_id == current_user.user_id,
                 AuditLog.session_id == session_uuid
             )
             .order_by(AuditLog.sequence_chat_id.asc())
-            .all()
         )
+        history = rows.all()
         
         if not history:
             raise HTTPException(
@@ -105,21 +125,24 @@ def get_session_history(
                 detail="Sesión no encontrada o no tienes acceso a ella"
             )
         
-        # Retornar con respuestas
-        result = []
-        for item in history:
-            result.append({
+        # Retornar con respuestas. orjson serializa UUID y datetime de forma
+        # nativa, así que se evitan los str()/isoformat() y el recorrido de
+        # jsonable_encoder sobre cada response_json
+        result = [
+            {
                 "audit_log_id": item.audit_log_id,
-                "session_id": str(item.session_id),
+                "session_id": item.session_id,
                 "sequence_chat_id": item.sequence_chat_id,
                 "question": item.question,
                 "response": item.response_json,
-                "created_at": item.created_at.isoformat(),
+                "created_at": item.created_at,
                 "document_type_id": item.document_type_id,
                 "document_number": item.document_number
-            })
+            }
+            for item in history
+        ]
         
-        return result
+        return ORJSONResponse(result)
     except ValueError:
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
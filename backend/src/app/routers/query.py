@@ -1,18 +1,40 @@
 # src/app/routers/query.py
-from fastapi import APIRouter, Depends, HTTPException
-from pydantic import BaseModel, Field
-from typing import List, Dict, Optional
-from sqlalchemy.orm import Session
-from datetime import datetime, timezone
+from fastapi import APIRouter, Depends, HTTPException, Request
+from fastapi.exceptions import RequestValidationError
+from fastapi.responses import ORJSONResponse, StreamingResponse
+from pydantic import BaseModel, Field, ValidationError
+from typing import AsyncIterator, List, Dict, Optional
+from sqlalchemy import bindparam
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.ext.asyncio import AsyncSession
+from datetime import date, datetime, timezone
 import logging
+import orjson
 import time
 import asyncio
+import hashlib
 import re
+from functools import lru_cache
+from itertools import islice
+from uuid import UUID
+from operator import attrgetter
 
-from app.services.llm_service import llm_service
-from app.services.clinical_service import fetch_patient_and_records
-from app.services.vector_search import search_similar_chunks
-from app.database.database import get_db
+from app.services.llm_service import llm_service, prompt_cache_key
+from app.services.clinical_service import (
+    MAX_APPOINTMENTS,
+    MAX_DIAGNOSES,
+    MAX_MEDICAL_RECORDS,
+    MAX_PRESCRIPTIONS,
+    fetch_clinical_records,
+    get_patient_by_document,
+)
+from app.services.vector_search import VectorStoreError, get_question_embedding, search_similar_chunks
+from app.database.database import get_db, new_async_session
+from app.database.db_config import settings
+from app.models.audit_logs import AuditLog
+from app.models.chat_session_counter import ChatSessionCounter
+from app.services.audit_writer import audit_writer
+from app.core.cache import TTLCache
 from app.schemas.clinical import PatientInfo, ClinicalRecords
 
 router = APIRouter(prefix="/query", tags=["RAG Query"])
@@ -20,9 +42,52 @@ logger = logging.getLogger(__name__)
 
 # === CONFIGURACIÓN DE TIMEOUTS ===
 LLM_TIMEOUT_SECONDS = 30
+LLM_MAX_ATTEMPTS = 2  # el segundo intento solo ante errores de red
 VECTOR_SEARCH_TIMEOUT_SECONDS = 10
+VECTOR_SEARCH_ATTEMPTS = 2
 TOTAL_REQUEST_TIMEOUT_SECONDS = 45
 
+# === CACHE DE RESPUESTAS ===
+# Respuestas exitosas del LLM por (paciente, pregunta normalizada). Los
+# registros clínicos cambian poco, así que una misma pregunta dentro del
+# TTL reutiliza la respuesta sin repetir búsqueda ni inferencia
+QUERY_CACHE_TTL_SECONDS = 600
+_response_cache = TTLCache(maxsize=1024, ttl=QUERY_CACHE_TTL_SECONDS)
+
+# === CACHE DEL CONTEXTO CLÍNICO ===
+# Preguntas de seguimiento sobre el mismo paciente reutilizan el contexto ya
+# formateado de sus registros (y sus sources); solo se arma de nuevo la
+# sección semántica
+CONTEXT_PREFIX_TTL_SECONDS = 300
+_context_prefix_cache = TTLCache(maxsize=1024, ttl=CONTEXT_PREFIX_TTL_SECONDS)
+
+# === PRESUPUESTO DE TOKENS DEL CONTEXTO ===
+# Lo que puede ocupar el contexto: la entrada configurada menos la respuesta
+# reservada y un margen para el prompt de sistema y la pregunta (<= 1000
+# caracteres). Pasarse se paga en tokens o termina en un 400 de la API
+_PROMPT_OVERHEAD_TOKENS = 1000
+CONTEXT_TOKEN_BUDGET = (
+    settings.llm_max_context_tokens - llm_service.max_tokens - _PROMPT_OVERHEAD_TOKENS
+)
+
+
+@lru_cache(maxsize=1)
+def _encoder():
+    """
+    Tokenizador del modelo del LLM, cargado una sola vez por proceso (el
+    import de tiktoken se difiere al primer contexto que se arma).
+    """
+    import tiktoken
+    try:
+        return tiktoken.encoding_for_model(llm_service.model)
+    except KeyError:
+        return tiktoken.get_encoding("cl100k_base")
+
+
+def _count_tokens(text: str) -> int:
+    # encode_ordinary: el texto clínico no lleva tokens especiales
+    return len(_encoder().encode_ordinary(text))
+
 # === SCHEMAS ===
 
 class QueryInput(BaseModel):
@@ -33,8 +98,56 @@ class QueryInput(BaseModel):
     question: str
 
 
+async def _parse_query_input(request: Request) -> QueryInput:
+    """
+    Cuerpo de la consulta validado directo desde los bytes: pydantic parsea
+    y valida en una sola pasada, sin json.loads ni el dict intermedio que
+    arma FastAPI. Los errores se reportan igual que los de FastAPI (422).
+    """
+    try:
+        return QueryInput.model_validate_json(await request.body())
+    except ValidationError as e:
+        errors = []
+        for error in e.errors(include_url=False):
+            # Con JSON mal formado `input` son los bytes crudos del cuerpo
+            if isinstance(error.get("input"), bytes):
+                error["input"] = error["input"].decode("utf-8", "replace")
+            error["loc"] = ("body", *error["loc"])
+            errors.append(error)
+        raise RequestValidationError(errors)
+
+
+# El cuerpo lo lee _parse_query_input, así que se documenta a mano
+_QUERY_INPUT_OPENAPI = {
+    "requestBody": {
+        "required": True,
+        "content": {"application/json": {"schema": QueryInput.model_json_schema()}},
+    }
+}
+
+
 # === FUNCIONES DE VALIDACIÓN Y SANITIZACIÓN ===
 
+_VALID_DOC_TYPES = frozenset(range(1, 9))
+_DOC_NUMBER_INVALID_CHARS_RE = re.compile(r'[^A-Za-z0-9\-]')
+
+# Patrones de inyección SQL. Cada uno es un grupo de la alternación
+# compilada, así que la entrada se recorre una sola vez y match.lastindex
+# indica cuál coincidió (para el log)
+_DANGEROUS_PATTERNS = (
+    r"(\bOR\b.*=.*)",
+    r"(\bAND\b.*=.*)",
+    r"(DROP\s+TABLE)",
+    r"(DELETE\s+FROM)",
+    r"(INSERT\s+INTO)",
+    r"(UPDATE\s+\w+\s+SET)",
+    r"(--\s*$)",
+    r"(;.*SELECT)",
+    r"(\bUNION\b.*\bSELECT\b)",
+)
+_DANGEROUS_PATTERNS_RE = re.compile("|".join(_DANGEROUS_PATTERNS), re.IGNORECASE)
+
+
 def sanitize_document_number(doc_number: str) -> str:
     """
     Sanitiza el número de documento eliminando caracteres peligrosos.
@@ -44,7 +157,7 @@ def sanitize_document_number(doc_number: str) -> str:
     doc_number = doc_number.strip()
     
     # Solo permitir: letras (A-Z, a-z), números (0-9), guiones (-), sin espacios
-    sanitized = re.sub(r'[^A-Za-z0-9\-]', '', doc_number)
+    sanitized = _DOC_NUMBER_INVALID_CHARS_RE.sub('', doc_number)
     
     # Limitar longitud máxima
     if len(sanitized) > 50:
@@ -62,8 +175,7 @@ def validate_query_input(input_data: QueryInput) -> tuple[bool, Optional[str]]:
         (is_valid, error_message)
     """
     # Validar document_type_id
-    valid_doc_types = [1, 2, 3, 4, 5, 6, 7, 8]
-    if input_data.document_type_id not in valid_doc_types:
+    if input_data.document_type_id not in _VALID_DOC_TYPES:
         return False, f"Tipo de documento inválido: {input_data.document_type_id}"
     
     # Validar document_number
@@ -84,24 +196,13 @@ def validate_query_input(input_data: QueryInput) -> tuple[bool, Optional[str]]:
     if len(input_data.question) > 1000:
         return False, "La pregunta no puede exceder 1000 caracteres"
     
-    # Detectar intentos de inyección SQL básicos
-    dangerous_patterns = [
-        r"(\bOR\b.*=.*)",
-        r"(\bAND\b.*=.*)",
-        r"(DROP\s+TABLE)",
-        r"(DELETE\s+FROM)",
-        r"(INSERT\s+INTO)",
-        r"(UPDATE\s+\w+\s+SET)",
-        r"(--\s*$)",
-        r"(;.*SELECT)",
-        r"(\bUNION\b.*\bSELECT\b)",
-    ]
-    
+    # Detectar intentos de inyección SQL básicos (una sola pasada)
     combined_input = f"{input_data.document_number} {input_data.question}"
-    for pattern in dangerous_patterns:
-        if re.search(pattern, combined_input, re.IGNORECASE):
-            logger.warning(f" Posible intento de inyección SQL detectado: {pattern}")
-            return False, "Query contiene patrones potencialmente peligrosos"
+    match = _DANGEROUS_PATTERNS_RE.search(combined_input)
+    if match:
+        pattern = _DANGEROUS_PATTERNS[match.lastindex - 1]
+        logger.warning(f" Posible intento de inyección SQL detectado: {pattern}")
+        return False, "Query contiene patrones potencialmente peligrosos"
     
     return True, None
 
@@ -111,14 +212,313 @@ def get_iso_timestamp() -> str:
     return datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
 
 
-def build_context_from_real_data(
+def _error_response(
+    input_data: QueryInput,
+    sequence_chat_id: int,
+    code: str,
+    message: str,
+    details: str
+) -> dict:
+    """
+    Respuesta de error de /query/ (misma forma en todas las ramas). Se arma
+    como dict literal, sin pasar por un modelo de pydantic: la rama de
+    PATIENT_NOT_FOUND se ejecuta con cada documento mal digitado.
+    """
+    return {
+        "status": "error",
+        "session_id": input_data.session_id,
+        "sequence_chat_id": sequence_chat_id,
+        "timestamp": get_iso_timestamp(),
+        "error": {"code": code, "message": message, "details": details}
+    }
+
+
+def _elapsed_ms(start: float) -> int:
+    """Milisegundos desde `start` (time.perf_counter: monótono, no le afectan ajustes del reloj)"""
+    return int((time.perf_counter() - start) * 1000)
+
+
+# Encabezados fijos de las secciones del contexto
+_HEADER_APPOINTMENTS = "### CITAS MÉDICAS RECIENTES\n"
+_HEADER_MEDICAL_RECORDS = "### REGISTROS MÉDICOS\n"
+_HEADER_PRESCRIPTIONS = "### MEDICAMENTOS Y PRESCRIPCIONES\n"
+_HEADER_DIAGNOSES = "### DIAGNÓSTICOS\n"
+_HEADER_SIMILAR_CHUNKS = "### INFORMACIÓN ADICIONAL RELEVANTE (BÚSQUEDA SEMÁNTICA)\n"
+
+# Plantillas de cada bloque, parseadas una sola vez (str.format ligado)
+_FORMAT_BASIC_INFO = (
+    "\n### INFORMACIÓN BÁSICA DEL PACIENTE\n"
+    "Nombre: {} {}\n"
+    "Edad: {}\n"
+    "Documento: {}\n"
+    "Género: {}\n"
+    "Email: {}\n\n"
+).format
+_FORMAT_APPOINTMENT = (
+    "**Cita {}**\n"
+    "- Tipo: {}\n"
+    "- Estado: {}\n"
+    "- Motivo: {}\n"
+).format
+_FORMAT_MEDICAL_RECORD = (
+    "- Fecha: {}\n"
+    "  Tipo: {}\n"
+    "  Descripción: {}\n\n"
+).format
+_FORMAT_DIAGNOSIS = (
+    "**{}**\n"
+    "- Código ICD-10: {}\n"
+    "- Tipo: {}\n"
+).format
+_FORMAT_DOCTOR_SPECIALTY = "- Doctor: {} ({})\n\n".format
+_FORMAT_DOCTOR = "- Doctor: {}\n\n".format
+_FORMAT_DOSE = "- Dosis: {} {}\n".format
+_FORMAT_SIMILAR_CHUNK = (
+    "- [Relevancia: {:.2f}] {}\n"
+    "  Fuente: {} - Fecha: {}\n\n"
+).format
+
+
+def _field_reader(*fields: tuple):
+    """
+    Lector de varios atributos con un solo attrgetter. Si al objeto le
+    falta alguno (no es un DTO) cae a getattr con el default de cada campo.
+    """
+    getter = attrgetter(*(name for name, _ in fields))
+
+    def read(obj) -> tuple:
+        try:
+            return getter(obj)
+        except AttributeError:
+            return tuple(getattr(obj, name, default) for name, default in fields)
+
+    return read
+
+
+# Campos leídos una sola vez por fila: el contexto y las sources salen del
+# mismo recorrido de cada lista
+_read_patient = _field_reader(
+    ("first_name", "Nombre"), ("first_surname", "Apellido"),
+    ("document_number", "No disponible"), ("gender", None), ("email", None)
+)
+_read_appointment = _field_reader(
+    ("appointment_id", None), ("appointment_date", None), ("status", None),
+    ("reason", None), ("appointment_type", None), ("doctor_name", None),
+    ("specialty_name", None), ("medical_license_number", None)
+)
+_read_medical_record = _field_reader(
+    ("registration_datetime", "Fecha no disponible"),
+    ("record_type", "Tipo no especificado"),
+    ("summary_text", None)
+)
+_read_prescription = _field_reader(
+    ("prescription_id", None), ("medication_name", None), ("dosage", ""), ("frequency", ""),
+    ("duration", None), ("instruction", None), ("prescription_date", None)
+)
+_read_diagnosis = _field_reader(
+    ("diagnosis_id", None), ("description", None), ("icd_code", None),
+    ("diagnosis_type", "Tipo no especificado"), ("note", None), ("diagnosis_date", None)
+)
+_read_chunk = _field_reader(
+    ("source_id", None), ("chunk_text", "Texto no disponible"), ("relevance_score", 0.0),
+    ("source_type", None), ("date", None)
+)
+
+
+def _records_fingerprint(clinical_records: ClinicalRecords) -> tuple:
+    """
+    Huella barata de los registros clínicos: tamaño de cada lista y el id
+    más alto de cada una, suficiente para notar registros nuevos o borrados.
+    """
+    fingerprint = []
+    for items, id_field in (
+        (clinical_records.appointments, "appointment_id"),
+        (clinical_records.medical_records, "medical_record_id"),
+        (clinical_records.prescriptions, "prescription_id"),
+        (clinical_records.diagnoses, "record_diagnosis_id"),
+    ):
+        items = items or ()
+        fingerprint.append(len(items))
+        fingerprint.append(max((getattr(item, id_field, 0) or 0 for item in items), default=0))
+    return tuple(fingerprint)
+
+
+def _appointment_source(apt_id, apt_date, apt_reason, doctor_name, specialty_name, medical_license) -> Optional[Dict]:
+    if not apt_id:
+        return None
+    
+    source = {
+        "source_id": None,
+        "type": "appointment",
+        "appointment_id": int(apt_id),
+        "date": apt_date or None,
+        "relevance_score": 0.98
+    }
+    
+    if doctor_name or specialty_name:
+        doctor_info = {}
+        if doctor_name:
+            doctor_info["name"] = doctor_name
+        if specialty_name:
+            doctor_info["specialty"] = specialty_name
+        if medical_license:
+            doctor_info["medical_license"] = medical_license
+        
+        if doctor_info:
+            source["doctor"] = doctor_info
+    
+    if apt_reason:
+        source["reason"] = apt_reason
+    return source
+
+
+def _diagnosis_source(diag_id, diag_desc, icd_code, diag_date) -> Optional[Dict]:
+    if not diag_id:
+        return None
+    
+    source = {
+        "source_id": None,
+        "type": "diagnosis",
+        "diagnosis_id": int(diag_id),
+        "description": diag_desc or "Sin descripción",
+        "relevance_score": 0.95
+    }
+    
+    if icd_code:
+        source["icd_code"] = icd_code
+    if diag_date:
+        source["date"] = diag_date.date() if isinstance(diag_date, datetime) else diag_date
+    return source
+
+
+def _prescription_source(presc_id, medication, presc_date, dosage, frequency) -> Optional[Dict]:
+    if not presc_id:
+        return None
+    
+    source = {
+        "source_id": None,
+        "type": "prescription",
+        "prescription_id": int(presc_id),
+        "medication": medication or "Medicamento no especificado",
+        "date": presc_date or None,
+        "relevance_score": 0.92
+    }
+    
+    if dosage:
+        source["dosage"] = dosage
+    if frequency:
+        source["frequency"] = frequency
+    return source
+
+
+def _chunk_source(source_id, source_type, relevance, chunk_date) -> Optional[Dict]:
+    if not source_id:
+        return None
+    
+    return {
+        "source_id": None,
+        "type": "vector_search",
+        "original_source_id": str(source_id),
+        "source_type": source_type or "unknown",
+        "relevance_score": float(relevance),
+        "date": chunk_date or None
+    }
+
+
+def _try_source(name: str, builder, *fields) -> Optional[Dict]:
+    """Un error en una fila solo omite su source; el contexto sigue intacto."""
+    try:
+        return builder(*fields)
+    except Exception as e:
+        logger.warning(f"Error construyendo source de {name}: {e}")
+        return None
+
+
+def build_context_and_sources(
     patient_info: PatientInfo,
     clinical_records: ClinicalRecords,
-    similar_chunks: List
-) -> str:
-    """Construye el contexto clínico de manera segura"""
+    similar_chunks: List,
+    sequence_counter: int = 1
+) -> tuple[str, List[Dict]]:
+    """
+    Construye el contexto clínico y la lista de fuentes recorriendo cada
+    lista una sola vez (los campos de cada fila se leen una vez para ambos).
     
-    from datetime import date, datetime
+    Las sources siguen el formato EXACTO de la especificación. Las fechas
+    quedan como date/datetime: orjson las serializa en ISO 8601 (respuesta
+    HTTP, NDJSON, WebSocket y el JSONB de audit_logs).
+    """
+
+    # Lo que no depende de la pregunta (datos básicos, registros y sus
+    # sources) se cachea; la fecha entra en la clave porque la edad cambia
+    cache_key = (
+        getattr(patient_info, "patient_id", None),
+        date.today().toordinal(),
+        _records_fingerprint(clinical_records),
+    )
+    cached = _context_prefix_cache.get(cache_key)
+    if cached is None:
+        cached = _fit_clinical_context(*_build_clinical_context(patient_info, clinical_records))
+        _context_prefix_cache.set(cache_key, cached)
+    prefix, record_sources, prefix_tokens = cached
+
+    # Copias: la numeración no debe tocar las sources guardadas en cache
+    sources = [dict(source) for source in record_sources]
+
+    # === VECTOR SEARCH ===
+    # Los chunks llegan por relevancia descendente: con el presupuesto
+    # agotado quedan fuera los menos relevantes (y sus sources)
+    remaining = CONTEXT_TOKEN_BUDGET - prefix_tokens - _count_tokens(_HEADER_SIMILAR_CHUNKS)
+    if similar_chunks and remaining > 0:
+        parts: List[str] = [prefix, _HEADER_SIMILAR_CHUNKS]
+        append = parts.append
+        for chunk in islice(similar_chunks, 5):
+            source_id, chunk_text, relevance, source_type, chunk_date = _read_chunk(chunk)
+
+            chunk_context = _FORMAT_SIMILAR_CHUNK(
+                relevance, chunk_text, source_type or "Desconocida", chunk_date or "Sin fecha"
+            )
+            remaining -= _count_tokens(chunk_context)
+            if remaining < 0:
+                logger.info("Presupuesto de tokens agotado: se omiten los chunks restantes")
+                break
+            append(chunk_context)
+            source = _try_source("vector chunks", _chunk_source, source_id, source_type, relevance, chunk_date)
+            if source is not None:
+                sources.append(source)
+        context = "".join(parts)
+    else:
+        context = prefix
+
+    # Numeración en una sola pasada (source_id ya ocupa la primera clave)
+    for sequence, source in enumerate(sources, start=sequence_counter):
+        source["source_id"] = sequence
+
+    return context, sources
+
+
+def _fit_clinical_context(prefix: str, record_sources: tuple) -> tuple[str, tuple, int]:
+    """
+    Ajusta la parte fija del contexto al presupuesto de tokens y retorna
+    también su conteo. Cada sección lista sus registros del más reciente
+    al más antiguo, así que el recorte del final descarta primero los
+    diagnósticos más viejos.
+    """
+    tokens = _encoder().encode_ordinary(prefix)
+    if len(tokens) > CONTEXT_TOKEN_BUDGET:
+        logger.warning(
+            f"Contexto clínico de {len(tokens)} tokens recortado a {CONTEXT_TOKEN_BUDGET}"
+        )
+        tokens = tokens[:CONTEXT_TOKEN_BUDGET]
+        prefix = _encoder().decode(tokens)
+    return prefix, record_sources, len(tokens)
+
+
+def _build_clinical_context(patient_info: PatientInfo, clinical_records: ClinicalRecords) -> tuple[str, tuple]:
+    """
+    Parte del contexto que no depende de la pregunta (paciente y registros)
+    junto con las sources de citas, diagnósticos y prescripciones.
+    """
 
     # === Calcular edad ===
     age = "No disponible"
@@ -127,281 +527,136 @@ def build_context_from_real_data(
             birth_date = (
                 patient_info.birth_date
                 if isinstance(patient_info.birth_date, date)
-                else datetime.strptime(patient_info.birth_date, "%Y-%m-%d").date()
+                else date.fromisoformat(patient_info.birth_date)
             )
             today = date.today()
+            # mes*32+día ordena igual que (mes, día) sin crear tuplas
             age = today.year - birth_date.year - (
-                (today.month, today.day) < (birth_date.month, birth_date.day)
+                today.month * 32 + today.day < birth_date.month * 32 + birth_date.day
             )
         except Exception as e:
             logger.warning(f"Error calculando edad: {e}")
             age = "No disponible"
 
-    # Usar getattr para todos los campos de patient_info
-    first_name = getattr(patient_info, 'first_name', 'Nombre')
-    first_surname = getattr(patient_info, 'first_surname', 'Apellido')
-    document_number = getattr(patient_info, 'document_number', 'No disponible')
-    gender = getattr(patient_info, 'gender', None) or "No registrado"
-    email = getattr(patient_info, 'email', None) or "No registrado"
+    first_name, first_surname, document_number, gender, email = _read_patient(patient_info)
+    gender = gender or "No registrado"
+    email = email or "No registrado"
 
-    context = f"""
-### INFORMACIÓN BÁSICA DEL PACIENTE
-Nombre: {first_name} {first_surname}
-Edad: {age}
-Documento: {document_number}
-Género: {gender}
-Email: {email}
-
-"""
+    parts: List[str] = [
+        _FORMAT_BASIC_INFO(first_name, first_surname, age, document_number, gender, email)
+    ]
+    append = parts.append
+    # Las sources conservan el orden de la especificación (citas,
+    # diagnósticos, prescripciones) aunque el contexto use otro
+    apt_sources: List[Dict] = []
+    diag_sources: List[Dict] = []
+    presc_sources: List[Dict] = []
 
-    # === CITAS ===
-    if clinical_records.appointments:
-        context += "### CITAS MÉDICAS RECIENTES\n"
-        for apt in clinical_records.appointments[:10]:
-            apt_date = getattr(apt, 'appointment_date', 'Fecha no disponible')
-            apt_status = getattr(apt, 'status', None) or 'No disponible'
-            apt_reason = getattr(apt, 'reason', None) or 'No especificado'
-            apt_type = getattr(apt, 'appointment_type', None) or 'Consulta'
-            doctor_name = getattr(apt, 'doctor_name', None)
-            specialty = getattr(apt, 'specialty_name', None)
+    # === CITAS === (contexto: 10, sources: 5)
+    appointments = clinical_records.appointments or ()
+    if appointments:
+        append(_HEADER_APPOINTMENTS)
+        for index, apt in enumerate(islice(appointments, MAX_APPOINTMENTS)):
+            (apt_id, apt_date, apt_status, apt_reason, apt_type,
+             doctor_name, specialty, medical_license) = _read_appointment(apt)
             
-            context += f"**Cita {apt_date}**\n"
-            context += f"- Tipo: {apt_type}\n"
-            context += f"- Estado: {apt_status}\n"
-            context += f"- Motivo: {apt_reason}\n"
-            if doctor_name:
-                context += f"- Doctor: {doctor_name}"
-                if specialty:
-                    context += f" ({specialty})"
-                context += "\n"
-            context += "\n"
+            append(_FORMAT_APPOINTMENT(
+                apt_date or "Fecha no disponible",
+                apt_type or 'Consulta',
+                apt_status or 'No disponible',
+                apt_reason or 'No especificado'
+            ))
+            # Línea del doctor y separador en un solo fragmento
+            if doctor_name and specialty:
+                append(_FORMAT_DOCTOR_SPECIALTY(doctor_name, specialty))
+            elif doctor_name:
+                append(_FORMAT_DOCTOR(doctor_name))
+            else:
+                append("\n")
+
+            if index < 5:
+                source = _try_source(
+                    "appointments", _appointment_source,
+                    apt_id, apt_date, apt_reason, doctor_name, specialty, medical_license
+                )
+                if source is not None:
+                    apt_sources.append(source)
 
     # === REGISTROS MÉDICOS ===
-    if clinical_records.medical_records:
-        context += "### REGISTROS MÉDICOS\n"
-        for rec in clinical_records.medical_records[:10]:
-            desc = (
-                getattr(rec, "summary_text", None) or
-                getattr(rec, "description", None) or
-                getattr(rec, "details", None) or
-                getattr(rec, "notes", None) or
-                "Sin descripción"
-            )
-            
-            rec_date = getattr(rec, 'registration_datetime', 'Fecha no disponible')
-            rec_type = getattr(rec, 'record_type', 'Tipo no especificado')
+    medical_records = clinical_records.medical_records or ()
+    if medical_records:
+        append(_HEADER_MEDICAL_RECORDS)
+        for rec in islice(medical_records, MAX_MEDICAL_RECORDS):
+            rec_date, rec_type, desc = _read_medical_record(rec)
+            desc = desc or "Sin descripción"
 
-            context += (
-                f"- Fecha: {rec_date}\n"
-                f"  Tipo: {rec_type}\n"
-                f"  Descripción: {desc}\n\n"
-            )
+            append(_FORMAT_MEDICAL_RECORD(rec_date, rec_type, desc))
 
-    # === PRESCRIPCIONES ===
-    if clinical_records.prescriptions:
-        context += "### MEDICAMENTOS Y PRESCRIPCIONES\n"
-        for presc in clinical_records.prescriptions[:15]:
-            medication = getattr(presc, 'medication_name', 'Medicamento sin nombre')
-            dosage = getattr(presc, 'dosage', '')
-            frequency = getattr(presc, 'frequency', '')
-            duration = getattr(presc, 'duration', None)
-            instruction = getattr(presc, 'instruction', None)
-            presc_date = getattr(presc, 'prescription_date', None)
+    # === PRESCRIPCIONES === (contexto: 15, sources: 3)
+    prescriptions = clinical_records.prescriptions or ()
+    if prescriptions:
+        append(_HEADER_PRESCRIPTIONS)
+        for index, presc in enumerate(islice(prescriptions, MAX_PRESCRIPTIONS)):
+            presc_id, medication, dosage, frequency, duration, instruction, presc_date = _read_prescription(presc)
             
-            context += f"**{medication}**\n"
+            append(f"**{medication or 'Medicamento sin nombre'}**\n")
             if dosage or frequency:
-                context += f"- Dosis: {dosage} {frequency}\n"
+                append(_FORMAT_DOSE(dosage, frequency))
             if duration:
-                context += f"- Duración: {duration}\n"
+                append(f"- Duración: {duration}\n")
             if instruction:
-                context += f"- Indicaciones: {instruction}\n"
+                append(f"- Indicaciones: {instruction}\n")
+            # Última línea y separador en un solo fragmento
             if presc_date:
-                context += f"- Fecha de prescripción: {presc_date}\n"
-            context += "\n"
+                append(f"- Fecha de prescripción: {presc_date}\n\n")
+            else:
+                append("\n")
 
-    # === DIAGNÓSTICOS ===
-    if clinical_records.diagnoses:
-        context += "### DIAGNÓSTICOS\n"
-        for diag in clinical_records.diagnoses[:15]:
-            diag_desc = getattr(diag, 'description', 'Diagnóstico sin descripción')
-            icd_code = getattr(diag, 'icd_code', 'Sin código')
-            diag_type = getattr(diag, 'diagnosis_type', 'Tipo no especificado')
-            note = getattr(diag, 'note', None)
-            diag_date = getattr(diag, 'diagnosis_date', None)
+            if index < 3:
+                source = _try_source(
+                    "prescriptions", _prescription_source,
+                    presc_id, medication, presc_date, dosage, frequency
+                )
+                if source is not None:
+                    presc_sources.append(source)
+
+    # === DIAGNÓSTICOS === (contexto: 15, sources: 5)
+    diagnoses = clinical_records.diagnoses or ()
+    if diagnoses:
+        append(_HEADER_DIAGNOSES)
+        for index, diag in enumerate(islice(diagnoses, MAX_DIAGNOSES)):
+            diag_id, diag_desc, icd_code, diag_type, note, diag_date = _read_diagnosis(diag)
             
-            context += f"**{diag_desc}**\n"
-            context += f"- Código ICD-10: {icd_code}\n"
-            context += f"- Tipo: {diag_type}\n"
+            append(_FORMAT_DIAGNOSIS(
+                diag_desc or "Diagnóstico sin descripción", icd_code or "Sin código", diag_type
+            ))
             if diag_date:
-                context += f"- Fecha: {diag_date}\n"
+                append(f"- Fecha: {diag_date}\n")
             if note:
-                context += f"- Nota: {note}\n"
-            context += "\n"
-
-    # === VECTOR SEARCH ===
-    if similar_chunks:
-        context += "### INFORMACIÓN ADICIONAL RELEVANTE (BÚSQUEDA SEMÁNTICA)\n"
-        for chunk in similar_chunks[:5]:
-            chunk_text = getattr(chunk, 'chunk_text', 'Texto no disponible')
-            relevance = getattr(chunk, 'relevance_score', 0.0)
-            source_type = getattr(chunk, 'source_type', 'Desconocida')
-            chunk_date = getattr(chunk, 'date', 'Sin fecha')
-            
-            context += f"- [Relevancia: {relevance:.2f}] {chunk_text}\n"
-            context += f"  Fuente: {source_type} - Fecha: {chunk_date}\n\n"
-
-    return context
-
-
-def build_sources_from_real_data(
-    clinical_records: ClinicalRecords, 
-    similar_chunks: List,
-    sequence_counter: int
-) -> List[Dict]:
-    """Construye lista de fuentes siguiendo el formato EXACTO de la especificación"""
-    sources = []
-    current_sequence = sequence_counter
-    
-    # CITAS
-    try:
-        for apt in clinical_records.appointments[:5]:
-            apt_id = getattr(apt, 'appointment_id', None)
-            if not apt_id:
-                continue
-                
-            apt_date = getattr(apt, 'appointment_date', None)
-            apt_reason = getattr(apt, 'reason', None)
-            doctor_name = getattr(apt, 'doctor_name', None)
-            specialty_name = getattr(apt, 'specialty_name', None)
-            medical_license = getattr(apt, 'medical_license_number', None)
-            
-            source = {
-                "source_id": current_sequence,
-                "type": "appointment",
-                "appointment_id": int(apt_id),
-                "date": str(apt_date) if apt_date else None,
-                "relevance_score": 0.98
-            }
-            
-            if doctor_name or specialty_name:
-                doctor_info = {}
-                if doctor_name:
-                    doctor_info["name"] = doctor_name
-                if specialty_name:
-                    doctor_info["specialty"] = specialty_name
-                if medical_license:
-                    doctor_info["medical_license"] = medical_license
-                
-                if doctor_info:
-                    source["doctor"] = doctor_info
-            
-            if apt_reason:
-                source["reason"] = apt_reason
-                
-            sources.append(source)
-            current_sequence += 1
-            
-    except Exception as e:
-        logger.warning(f"Error construyendo sources de appointments: {e}")
+                append(f"- Nota: {note}\n\n")
+            else:
+                append("\n")
 
-    # DIAGNÓSTICOS
-    try:
-        for diag in clinical_records.diagnoses[:5]:
-            diag_id = getattr(diag, 'diagnosis_id', None)
-            if not diag_id:
-                continue
-                
-            diag_desc = getattr(diag, 'description', 'Sin descripción')
-            icd_code = getattr(diag, 'icd_code', None)
-            diag_date = getattr(diag, 'diagnosis_date', None)
-            
-            source = {
-                "source_id": current_sequence,
-                "type": "diagnosis",
-                "diagnosis_id": int(diag_id),
-                "description": diag_desc,
-                "relevance_score": 0.95
-            }
-            
-            if icd_code:
-                source["icd_code"] = icd_code
-            if diag_date:
-                source["date"] = str(diag_date.date()) if hasattr(diag_date, 'date') else str(diag_date)
-                
-            sources.append(source)
-            current_sequence += 1
-            
-    except Exception as e:
-        logger.warning(f"Error construyendo sources de diagnoses: {e}")
+            if index < 5:
+                source = _try_source(
+                    "diagnoses", _diagnosis_source, diag_id, diag_desc, icd_code, diag_date
+                )
+                if source is not None:
+                    diag_sources.append(source)
 
-    # PRESCRIPCIONES
-    try:
-        for presc in clinical_records.prescriptions[:3]:
-            presc_id = getattr(presc, 'prescription_id', None)
-            if not presc_id:
-                continue
-                
-            medication = getattr(presc, 'medication_name', 'Medicamento no especificado')
-            presc_date = getattr(presc, 'prescription_date', None)
-            dosage = getattr(presc, 'dosage', None)
-            frequency = getattr(presc, 'frequency', None)
-            
-            source = {
-                "source_id": current_sequence,
-                "type": "prescription",
-                "prescription_id": int(presc_id),
-                "medication": medication,
-                "date": str(presc_date) if presc_date else None,
-                "relevance_score": 0.92
-            }
-            
-            if dosage:
-                source["dosage"] = dosage
-            if frequency:
-                source["frequency"] = frequency
-            
-            sources.append(source)
-            current_sequence += 1
-            
-    except Exception as e:
-        logger.warning(f"Error construyendo sources de prescriptions: {e}")
+    # Un solo join en lugar de += repetidos (cada += copia todo el buffer)
+    return "".join(parts), (*apt_sources, *diag_sources, *presc_sources)
 
-    # VECTOR CHUNKS
-    try:
-        for chunk in similar_chunks[:5]:
-            source_id = getattr(chunk, 'source_id', None)
-            if not source_id:
-                continue
-                
-            source_type = getattr(chunk, 'source_type', 'unknown')
-            relevance = getattr(chunk, 'relevance_score', 0.0)
-            chunk_date = getattr(chunk, 'date', None)
-            
-            source = {
-                "source_id": current_sequence,
-                "type": "vector_search",
-                "original_source_id": str(source_id),
-                "source_type": source_type,
-                "relevance_score": float(relevance),
-                "date": str(chunk_date) if chunk_date else None
-            }
-            
-            sources.append(source)
-            current_sequence += 1
-            
-    except Exception as e:
-        logger.warning(f"Error construyendo sources de vector chunks: {e}")
 
-    return sources
+# Nombres por ID (1..8); la posición 0 no se usa
+_DOCUMENT_TYPE_NAMES = ("CC", "CC", "CE", "TI", "PA", "RC", "MS", "AS", "CD")
 
 
 def get_document_type_name(document_type_id: int) -> str:
     """Mapea ID de tipo de documento a nombre"""
-    types = {
-        1: "CC", 2: "CE", 3: "TI", 4: "PA",
-        5: "RC", 6: "MS", 7: "AS", 8: "CD",
-    }
-    return types.get(document_type_id, "CC")
+    if 1 <= document_type_id <= 8:
+        return _DOCUMENT_TYPE_NAMES[document_type_id]
+    return "CC"
 
 
 def _generate_fallback_response(clinical_records: ClinicalRecords, question: str) -> str:
@@ -410,7 +665,7 @@ def _generate_fallback_response(clinical_records: ClinicalRecords, question: str
     
     if clinical_records.appointments:
         response_parts.append("*Citas Médicas Recientes:*\n")
-        for apt in clinical_records.appointments[:3]:
+        for apt in islice(clinical_records.appointments, 3):
             date = getattr(apt, 'appointment_date', 'Fecha no disponible')
             reason = getattr(apt, 'reason', 'No especificado')
             status = getattr(apt, 'status', 'No disponible')
@@ -418,14 +673,14 @@ def _generate_fallback_response(clinical_records: ClinicalRecords, question: str
     
     if clinical_records.diagnoses:
         response_parts.append("\n*Diagnósticos:*\n")
-        for diag in clinical_records.diagnoses[:3]:
+        for diag in islice(clinical_records.diagnoses, 3):
             desc = getattr(diag, 'description', 'Sin descripción')
             icd = getattr(diag, 'icd_code', '')
             response_parts.append(f"- {desc} (ICD: {icd})")
     
     if clinical_records.prescriptions:
         response_parts.append("\n*Medicamentos Prescritos:*\n")
-        for presc in clinical_records.prescriptions[:3]:
+        for presc in islice(clinical_records.prescriptions, 3):
             med = getattr(presc, 'medication_name', 'Medicamento no especificado')
             dosage = getattr(presc, 'dosage', '')
             response_parts.append(f"- {med} {dosage}")
@@ -440,35 +695,42 @@ def _generate_fallback_response(clinical_records: ClinicalRecords, question: str
 
 # === ENDPOINT PRINCIPAL ===
 
-@router.post("/")
-async def query_patient(input_data: QueryInput, db: Session = Depends(get_db)):
+@router.post("/", response_class=ORJSONResponse, openapi_extra=_QUERY_INPUT_OPENAPI)
+async def query_patient(
+    input_data: QueryInput = Depends(_parse_query_input),
+    db: AsyncSession = Depends(get_db)
+):
     """
     Endpoint principal de consulta RAG con validación de seguridad.
      FIX JAILBREAK: Validación estricta de inputs
+    
+    La respuesta ya es un dict JSON-nativo (el mismo que se guarda en
+    audit_logs), así que se serializa directo con orjson en lugar de
+    pasar por jsonable_encoder.
     """
-    start_time = time.time()
+    return ORJSONResponse(await _query_patient(input_data, db))
+
+
+async def _query_patient(input_data: QueryInput, db: AsyncSession) -> dict:
+    """Validación, timeout global y manejo de errores del endpoint"""
+    start_time = time.perf_counter()
     timestamp = get_iso_timestamp()
-    sequence_chat_id = 1
+    sequence_chat_id = 1  # una entrada rechazada no reserva número
 
     #  VALIDACIÓN DE SEGURIDAD
     is_valid, error_msg = validate_query_input(input_data)
     if not is_valid:
         logger.warning(f" Input inválido rechazado: {error_msg}")
-        return {
-            "status": "error",
-            "session_id": input_data.session_id,
-            "sequence_chat_id": sequence_chat_id,
-            "timestamp": get_iso_timestamp(),
-            "error": {
-                "code": "INVALID_INPUT",
-                "message": error_msg,
-                "details": "Verifica que los datos sean correctos"
-            }
-        }
+        return _error_response(
+            input_data, sequence_chat_id, "INVALID_INPUT",
+            error_msg,
+            "Verifica que los datos sean correctos"
+        )
     
     #  SANITIZAR NÚMERO DE DOCUMENTO
     sanitized_doc_number = sanitize_document_number(input_data.document_number)
     logger.info(f" Query para paciente: {input_data.document_type_id}-{sanitized_doc_number}")
+    sequence_chat_id = await _next_sequence(db, input_data.session_id)
 
     try:
         return await asyncio.wait_for(
@@ -478,17 +740,11 @@ async def query_patient(input_data: QueryInput, db: Session = Depends(get_db)):
     
     except asyncio.TimeoutError:
         logger.error(f"Request timeout después de {TOTAL_REQUEST_TIMEOUT_SECONDS}s")
-        return {
-            "status": "error",
-            "session_id": input_data.session_id,
-            "sequence_chat_id": sequence_chat_id,
-            "timestamp": get_iso_timestamp(),
-            "error": {
-                "code": "REQUEST_TIMEOUT",
-                "message": f"La solicitud excedió el tiempo máximo de {TOTAL_REQUEST_TIMEOUT_SECONDS} segundos",
-                "details": "Intente nuevamente con una pregunta más específica"
-            }
-        }
+        return _error_response(
+            input_data, sequence_chat_id, "REQUEST_TIMEOUT",
+            f"La solicitud excedió el tiempo máximo de {TOTAL_REQUEST_TIMEOUT_SECONDS} segundos",
+            "Intente nuevamente con una pregunta más específica"
+        )
     
     except asyncio.CancelledError:
         logger.warning("Request cancelado por el cliente")
@@ -496,22 +752,258 @@ async def query_patient(input_data: QueryInput, db: Session = Depends(get_db)):
     
     except Exception as e:
         logger.exception("Error inesperado en endpoint")
-        return {
-            "status": "error",
-            "session_id": input_data.session_id,
+        return _error_response(
+            input_data, sequence_chat_id, "INTERNAL_ERROR",
+            "Error interno del servidor",
+            str(e)
+        )
+
+
+async def _search_similar_chunks_safe(
+    patient_id: int,
+    question: str,
+    embedding_task: Optional[asyncio.Task] = None
+) -> List:
+    """
+    Vector search con timeout propio. Es opcional para la respuesta: ante
+    fallas transitorias reintenta una vez y, si se agota el tiempo, retorna
+    [] sin cancelar la carga clínica. El timeout cubre ambos intentos.
+    Otros errores (bugs) se propagan en lugar de ocultarse.
+    
+    `embedding_task` es el embedding de la pregunta ya en curso; el primer
+    intento lo reutiliza y el reintento lo vuelve a generar.
+    """
+    try:
+        async with asyncio.timeout(VECTOR_SEARCH_TIMEOUT_SECONDS):
+            for attempt in range(1, VECTOR_SEARCH_ATTEMPTS + 1):
+                try:
+                    query_embedding = None
+                    if embedding_task is not None and attempt == 1:
+                        query_embedding = await embedding_task
+                    return await search_similar_chunks(
+                        patient_id=patient_id,
+                        question=question,
+                        k=15,
+                        min_score=0.3,
+                        query_embedding=query_embedding
+                    )
+                except (ConnectionError, VectorStoreError) as e:
+                    logger.warning(f"Vector search degradado (intento {attempt}/{VECTOR_SEARCH_ATTEMPTS}): {e}")
+    except TimeoutError:
+        logger.warning(f"Vector search timeout después de {VECTOR_SEARCH_TIMEOUT_SECONDS}s")
+    return []
+
+
+def _response_cache_key(document_type_id: int, document_number: str, question: str) -> tuple:
+    """Clave del cache: paciente + hash de la pregunta normalizada"""
+    normalized = " ".join(question.lower().split())
+    digest = hashlib.blake2b(normalized.encode("utf-8"), digest_size=16).digest()
+    return (document_type_id, document_number, digest)
+
+
+# Reserva atómica del siguiente sequence_chat_id de la sesión: el upsert
+# toma el lock de una sola fila, así dos consultas simultáneas de la misma
+# sesión nunca reciben el mismo número
+_next_sequence_stmt = (
+    pg_insert(ChatSessionCounter)
+    .values(session_id=bindparam("session_id"), last_seq=1)
+    .on_conflict_do_update(
+        index_elements=[ChatSessionCounter.session_id],
+        set_={"last_seq": ChatSessionCounter.last_seq + 1},
+    )
+    .returning(ChatSessionCounter.last_seq)
+)
+
+
+async def _next_sequence(db: AsyncSession, session_id: str) -> int:
+    """
+    Siguiente sequence_chat_id de la sesión (1 si no se puede reservar).
+    
+    Se confirma en el acto: el lock de la fila del contador se libera antes
+    de la búsqueda y del LLM en lugar de retenerse toda la petición.
+    """
+    try:
+        result = await db.execute(_next_sequence_stmt, {"session_id": UUID(session_id)})
+        sequence = result.scalar_one()
+        await db.commit()
+        return sequence
+    except Exception as e:
+        logger.error(f"Error reservando sequence_chat_id: {type(e).__name__}: {e}")
+        await db.rollback()
+        return 1
+
+
+# Claves de la respuesta que no se guardan en response_json: session_id y
+# sequence_chat_id ya son columnas y patient_info sale del documento
+_AUDIT_DROPPED_KEYS = frozenset(("session_id", "sequence_chat_id", "patient_info"))
+
+
+def _audit_response(response: dict) -> dict:
+    """
+    Copia de la respuesta para response_json sin lo que ya está en las
+    columnas ni el tiempo de la consulta: filas (y WAL) más chicas. La
+    respuesta original no se toca, puede estar en el cache.
+    """
+    stored = {key: value for key, value in response.items() if key not in _AUDIT_DROPPED_KEYS}
+    metadata = stored.get("metadata")
+    if metadata:
+        stored["metadata"] = {key: value for key, value in metadata.items() if key != "query_time_ms"}
+    return stored
+
+
+async def _save_audit_log(
+    db: AsyncSession,
+    input_data: QueryInput,
+    sequence_chat_id: int,
+    sanitized_doc_number: str,
+    response: dict
+) -> None:
+    """
+    Guarda la consulta en audit_logs (Historial) sin fallar la petición.
+    
+    El registro se encola para el insert por lotes de audit_writer; solo
+    si la tarea no corre (o su cola está llena) se escribe aquí mismo.
+    """
+    try:
+        row = {
+            "user_id": int(input_data.user_id),
+            "session_id": UUID(input_data.session_id),
             "sequence_chat_id": sequence_chat_id,
-            "timestamp": get_iso_timestamp(),
-            "error": {
-                "code": "INTERNAL_ERROR",
-                "message": "Error interno del servidor",
-                "details": str(e)
-            }
+            "document_type_id": input_data.document_type_id,
+            "document_number": sanitized_doc_number,
+            "question": input_data.question,
+            "response_json": _audit_response(response)
         }
+        if audit_writer.submit(row):
+            return
+        audit_log = AuditLog(**row)
+        db.add(audit_log)
+        await db.commit()
+        logger.info(f"Consulta guardada en audit_logs: audit_log_id={audit_log.audit_log_id}")
+    except Exception as e:
+        logger.error(f"Error guardando en audit_logs: {type(e).__name__}: {e}")
+        # No fallar la petición si falla el guardado del log
+        await db.rollback()
+
+
+async def _fetch_patient_data(
+    db: AsyncSession,
+    document_type_id: int,
+    document_number: str,
+    question: str
+) -> tuple:
+    """
+    Busca el paciente y luego carga sus registros clínicos y la búsqueda
+    vectorial en paralelo (ambos solo dependen de patient_id).
+    
+    El embedding de la pregunta no depende del paciente, así que arranca
+    junto con la búsqueda del paciente y no después de ella.
+    
+    Viajes a la BD por petición: el paciente (0 si está en cache) y una
+    sola sentencia para las cuatro tablas clínicas; no hay carga perezosa
+    de relaciones. No se usa fetch_patient_and_records (paciente + registros
+    en una sentencia) porque la búsqueda vectorial necesita el patient_id
+    antes: con el embedding en cache, patient + max(registros, vector)
+    es menor que (patient + registros) + vector.
+    
+    Returns:
+        (patient_info, clinical_data, similar_chunks); patient_info None si
+        el paciente no existe
+    """
+    embedding_task = asyncio.create_task(get_question_embedding(question))
+    # Si nadie llega a esperarlo (paciente inexistente) su error no se reporta
+    embedding_task.add_done_callback(lambda t: t.cancelled() or t.exception())
+    try:
+        patient_info = await get_patient_by_document(
+            db=db,
+            document_type_id=document_type_id,
+            document_number=document_number
+        )
+    except BaseException:
+        embedding_task.cancel()
+        raise
+    if not patient_info:
+        embedding_task.cancel()
+        return None, None, []
+    
+    async with asyncio.TaskGroup() as tg:
+        clinical_task = tg.create_task(fetch_clinical_records(db, patient_info))
+        vector_task = tg.create_task(
+            _search_similar_chunks_safe(patient_info.patient_id, question, embedding_task)
+        )
+
+    # Lecturas terminadas: cerrar la transacción devuelve la conexión al
+    # pool en lugar de retenerla durante la llamada al LLM (segundos). El
+    # ROLLBACK se pagaba igual al devolverla; audit_logs toma otra después
+    await db.rollback()
+    return patient_info, clinical_task.result(), vector_task.result()
+
+
+def _patient_summary(patient_info: PatientInfo, document_type_id: int) -> dict:
+    """Bloque patient_info de la respuesta"""
+    # full_name llega armado desde la BD (y el paciente está cacheado), así
+    # que solo se concatena aquí si el objeto no lo trae
+    full_name = getattr(patient_info, 'full_name', None)
+    if not full_name:
+        full_name = " ".join(filter(None, (
+            getattr(patient_info, 'first_name', 'Nombre'),
+            getattr(patient_info, 'first_surname', 'Apellido'),
+            getattr(patient_info, 'second_surname', None)
+        )))
+    
+    return {
+        "patient_id": getattr(patient_info, 'patient_id', None),
+        "full_name": full_name,
+        "document_type": get_document_type_name(document_type_id),
+        "document_number": getattr(patient_info, 'document_number', 'No disponible')
+    }
+
+
+def _count_records(records: ClinicalRecords, similar_chunks: List) -> int:
+    """Registros clínicos + chunks analizados (total_records_analyzed)"""
+    return (
+        len(records.appointments) +
+        len(records.medical_records) +
+        len(records.prescriptions) +
+        len(records.diagnoses) +
+        len(similar_chunks)
+    )
+
+
+def _no_data_response(
+    input_data: QueryInput,
+    sequence_chat_id: int,
+    patient_summary: dict,
+    start_time: float
+) -> dict:
+    """
+    Respuesta de POST /query/ y /query/stream para un paciente sin
+    registros ni chunks: no llama al LLM y no se guarda en el cache de
+    respuestas (los registros que se agreguen después se ven de inmediato).
+    """
+    return {
+        "status": "success",
+        "session_id": input_data.session_id,
+        "sequence_chat_id": sequence_chat_id,
+        "timestamp": get_iso_timestamp(),
+        "patient_info": patient_summary,
+        "answer": {
+            "text": f"El paciente {patient_summary['full_name']} no tiene citas médicas registradas en el sistema.",
+            "confidence": 1.0,
+            "model_used": "gpt-4o-mini"
+        },
+        "sources": [],
+        "metadata": {
+            "total_records_analyzed": 0,
+            "query_time_ms": _elapsed_ms(start_time),
+            "sources_used": 0
+        }
+    }
 
 
 async def _process_query(
     input_data: QueryInput,
-    db: Session,
+    db: AsyncSession,
     start_time: float,
     timestamp: str,
     sequence_chat_id: int,
@@ -521,251 +1013,132 @@ async def _process_query(
     
     logger.info(f"Procesando query - Session: {input_data.session_id}")
 
-    # 1. BUSCAR PACIENTE (usando documento sanitizado)
-    try:
-        patient_info, clinical_data = fetch_patient_and_records(
-            db=db,
-            document_type_id=input_data.document_type_id,
-            document_number=sanitized_doc_number  #  Sanitizado
-        )
-    except Exception as e:
-        logger.error(f"Error en búsqueda de paciente: {type(e).__name__}")
-        return {
-            "status": "error",
-            "session_id": input_data.session_id,
-            "sequence_chat_id": sequence_chat_id,
-            "timestamp": get_iso_timestamp(),
-            "error": {
-                "code": "DATABASE_ERROR",
-                "message": "Error al buscar datos del paciente",
-                "details": str(e)
-            }
-        }
-
-    if not patient_info:
-        doc_type = get_document_type_name(input_data.document_type_id)
-        return {
-            "status": "error",
+    # 0. CACHE: misma pregunta sobre el mismo paciente dentro del TTL
+    cache_key = _response_cache_key(input_data.document_type_id, sanitized_doc_number, input_data.question)
+    cached = _response_cache.get(cache_key)
+    if cached is not None:
+        response = {
+            **cached,
             "session_id": input_data.session_id,
             "sequence_chat_id": sequence_chat_id,
             "timestamp": get_iso_timestamp(),
-            "error": {
-                "code": "PATIENT_NOT_FOUND",
-                "message": f"No se encontró paciente con documento {doc_type} {sanitized_doc_number}",
-                "details": "Verifique el tipo y número de documento"
+            "metadata": {
+                **cached["metadata"],
+                "query_time_ms": _elapsed_ms(start_time)
             }
         }
+        logger.info("Respuesta servida desde cache")
+        await _save_audit_log(db, input_data, sequence_chat_id, sanitized_doc_number, response)
+        return response
 
-    # 2. VECTOR SEARCH CON TIMEOUT
-    similar_chunks = []
+    # 1. BUSCAR PACIENTE (usando documento sanitizado)
+    # 2. REGISTROS CLÍNICOS + VECTOR SEARCH EN PARALELO
+    # Ambos solo dependen de patient_id, así que corren en un TaskGroup
     try:
-        similar_chunks = await asyncio.wait_for(
-            search_similar_chunks(
-                patient_id=getattr(patient_info, 'patient_id', None),
-                question=input_data.question,
-                k=15,
-                min_score=0.3
-            ),
-            timeout=VECTOR_SEARCH_TIMEOUT_SECONDS
+        patient_info, clinical_data, similar_chunks = await _fetch_patient_data(
+            db, input_data.document_type_id, sanitized_doc_number, input_data.question
         )
-    except asyncio.TimeoutError:
-        logger.warning(f"Vector search timeout después de {VECTOR_SEARCH_TIMEOUT_SECONDS}s")
     except Exception as e:
-        logger.warning(f"Vector search falló: {type(e).__name__}")
+        if isinstance(e, ExceptionGroup):
+            e = e.exceptions[0]
+        logger.error(f"Error en búsqueda de paciente: {type(e).__name__}")
+        return _error_response(
+            input_data, sequence_chat_id, "DATABASE_ERROR",
+            "Error al buscar datos del paciente",
+            str(e)
+        )
+
+    if not patient_info:
+        doc_type = get_document_type_name(input_data.document_type_id)
+        return _error_response(
+            input_data, sequence_chat_id, "PATIENT_NOT_FOUND",
+            f"No se encontró paciente con documento {doc_type} {sanitized_doc_number}",
+            "Verifique el tipo y número de documento"
+        )
 
-    # 3. CONSTRUIR CONTEXTO
+    # 3. CONSTRUIR CONTEXTO Y SOURCES (un solo recorrido de los registros)
     try:
-        context = build_context_from_real_data(
+        context, sources = build_context_and_sources(
             patient_info=patient_info,
             clinical_records=clinical_data.records,
-            similar_chunks=similar_chunks
+            similar_chunks=similar_chunks,
+            sequence_counter=1
         )
     except Exception as e:
         logger.error(f"Error construyendo contexto: {type(e).__name__}")
-        return {
-            "status": "error",
-            "session_id": input_data.session_id,
-            "sequence_chat_id": sequence_chat_id,
-            "timestamp": get_iso_timestamp(),
-            "error": {
-                "code": "CONTEXT_BUILD_ERROR",
-                "message": "Error al construir contexto clínico",
-                "details": str(e)
-            }
-        }
+        return _error_response(
+            input_data, sequence_chat_id, "CONTEXT_BUILD_ERROR",
+            "Error al construir contexto clínico",
+            str(e)
+        )
 
     # Extraer info del paciente
-    patient_id = getattr(patient_info, 'patient_id', None)
-    first_name = getattr(patient_info, 'first_name', 'Nombre')
-    first_surname = getattr(patient_info, 'first_surname', 'Apellido')
-    second_surname = getattr(patient_info, 'second_surname', '')
-    document_number = getattr(patient_info, 'document_number', 'No disponible')
-    doc_type = get_document_type_name(input_data.document_type_id)
-    
-    full_name = f"{first_name} {first_surname}"
-    if second_surname:
-        full_name += f" {second_surname}"
+    patient_summary = _patient_summary(patient_info, input_data.document_type_id)
 
     # 4. VERIFICAR SI HAY DATOS (Caso: sin datos)
-    total_records = (
-        len(clinical_data.records.appointments) +
-        len(clinical_data.records.medical_records) +
-        len(clinical_data.records.prescriptions) +
-        len(clinical_data.records.diagnoses) +
-        len(similar_chunks)
-    )
+    # Conteo único; se reutiliza en todas las ramas de respuesta
+    records = clinical_data.records
+    total_records = _count_records(records, similar_chunks)
 
     if total_records == 0:
-        return {
-            "status": "success",
-            "session_id": input_data.session_id,
-            "sequence_chat_id": sequence_chat_id,
-            "timestamp": get_iso_timestamp(),
-            "patient_info": {
-                "patient_id": patient_id,
-                "full_name": full_name,
-                "document_type": doc_type,
-                "document_number": document_number
-            },
-            "answer": {
-                "text": f"El paciente {full_name} no tiene citas médicas registradas en el sistema.",
-                "confidence": 1.0,
-                "model_used": "gpt-4o-mini"
-            },
-            "sources": [],
-            "metadata": {
-                "total_records_analyzed": 0,
-                "query_time_ms": int((time.time() - start_time) * 1000),
-                "sources_used": 0
-            }
-        }
+        return _no_data_response(input_data, sequence_chat_id, patient_summary, start_time)
 
-    # 5. LLAMAR AL LLM CON TIMEOUT Y RETRY
+    # 5. LLAMAR AL LLM CON TIMEOUT
+    # Solo los errores de red se reintentan (una vez); un timeout u otro
+    # error pasa directo al fallback sin pagar una segunda inferencia
     llm_response = None
-    llm_attempts = 0
-    max_attempts = 2
-    
-    while llm_attempts < max_attempts and not llm_response:
-        llm_attempts += 1
+    for attempt in range(1, LLM_MAX_ATTEMPTS + 1):
         try:
-            logger.info(f"Intento {llm_attempts}/{max_attempts} de llamada al LLM")
-            
+            logger.info(f"Intento {attempt}/{LLM_MAX_ATTEMPTS} de llamada al LLM")
             llm_response = await asyncio.wait_for(
                 llm_service.run_llm(
                     question=input_data.question,
-                    context=context
+                    context=context,
+                    cache_key=prompt_cache_key(patient_info.patient_id, input_data.session_id)
                 ),
                 timeout=LLM_TIMEOUT_SECONDS
             )
-            
-            if not llm_response or not hasattr(llm_response, 'text') or not llm_response.text:
-                if llm_attempts < max_attempts:
-                    logger.warning(f"Respuesta LLM inválida, reintentando...")
-                    await asyncio.sleep(0.5)
-                    continue
-                else:
-                    raise ValueError("Respuesta del LLM vacía")
-            
-            if len(llm_response.text.strip()) < 10:
-                if llm_attempts < max_attempts:
-                    logger.warning(f"Respuesta LLM muy corta, reintentando...")
-                    await asyncio.sleep(0.5)
-                    continue
-                else:
-                    raise ValueError("Respuesta del LLM demasiado corta")
-            
             break
-        
+        except ConnectionError as e:
+            logger.warning(f"Error de red en intento {attempt} del LLM: {e}")
         except asyncio.TimeoutError:
-            logger.error(f"⏱ LLM timeout en intento {llm_attempts}")
-            if llm_attempts >= max_attempts:
-                fallback_text = _generate_fallback_response(clinical_data.records, input_data.question)
-                
-                return {
-                    "status": "success",
-                    "session_id": input_data.session_id,
-                    "sequence_chat_id": sequence_chat_id,
-                    "timestamp": get_iso_timestamp(),
-                    "patient_info": {
-                        "patient_id": patient_id,
-                        "full_name": full_name,
-                        "document_type": doc_type,
-                        "document_number": document_number
-                    },
-                    "answer": {
-                        "text": fallback_text,
-                        "confidence": 0.65,
-                        "model_used": "fallback-system"
-                    },
-                    "sources": [],
-                    "metadata": {
-                        "total_records_analyzed": total_records,
-                        "query_time_ms": int((time.time() - start_time) * 1000),
-                        "sources_used": 0,
-                        "context_tokens": 0
-                    }
-                }
-            else:
-                await asyncio.sleep(0.5)
-                continue
-        
+            logger.error(f"⏱ LLM timeout después de {LLM_TIMEOUT_SECONDS}s")
+            break
         except Exception as e:
-            logger.error(f"Error en intento {llm_attempts} del LLM: {e}")
-            
-            if llm_attempts >= max_attempts:
-                fallback_text = _generate_fallback_response(clinical_data.records, input_data.question)
-                
-                return {
-                    "status": "success",
-                    "session_id": input_data.session_id,
-                    "sequence_chat_id": sequence_chat_id,
-                    "timestamp": get_iso_timestamp(),
-                    "patient_info": {
-                        "patient_id": patient_id,
-                        "full_name": full_name,
-                        "document_type": doc_type,
-                        "document_number": document_number
-                    },
-                    "answer": {
-                        "text": fallback_text,
-                        "confidence": 0.65,
-                        "model_used": "fallback-system"
-                    },
-                    "sources": [],
-                    "metadata": {
-                        "total_records_analyzed": total_records,
-                        "query_time_ms": int((time.time() - start_time) * 1000),
-                        "sources_used": 0,
-                        "context_tokens": 0
-                    }
-                }
-            else:
-                await asyncio.sleep(0.5)
-                continue
+            logger.error(f"Error en la llamada al LLM: {e}")
+            break
 
-    # 6. CONSTRUIR SOURCES
-    try:
-        sources = build_sources_from_real_data(
-            clinical_data.records, 
-            similar_chunks,
-            sequence_counter=1
-        )
-    except Exception as e:
-        logger.warning(f"Error construyendo sources: {type(e).__name__}")
-        sources = []
+    if llm_response is None:
+        fallback_text = _generate_fallback_response(clinical_data.records, input_data.question)
+        
+        return {
+            "status": "success",
+            "session_id": input_data.session_id,
+            "sequence_chat_id": sequence_chat_id,
+            "timestamp": get_iso_timestamp(),
+            "patient_info": patient_summary,
+            "answer": {
+                "text": fallback_text,
+                "confidence": 0.65,
+                "model_used": "fallback-system"
+            },
+            "sources": [],
+            "metadata": {
+                "total_records_analyzed": total_records,
+                "query_time_ms": _elapsed_ms(start_time),
+                "sources_used": 0,
+                "context_tokens": 0
+            }
+        }
 
-    # 7. RESPUESTA EXITOSA (Formato EXACTO según especificación)
+    # 6. RESPUESTA EXITOSA (Formato EXACTO según especificación)
+    query_time_ms = _elapsed_ms(start_time)
     response = {
         "status": "success",
         "session_id": input_data.session_id,
         "sequence_chat_id": sequence_chat_id,
         "timestamp": get_iso_timestamp(),
-        "patient_info": {
-            "patient_id": patient_id,
-            "full_name": full_name,
-            "document_type": doc_type,
-            "document_number": document_number
-        },
+        "patient_info": patient_summary,
         "answer": {
             "text": llm_response.text,
             "confidence": getattr(llm_response, 'confidence', 0.94),
@@ -774,34 +1147,197 @@ async def _process_query(
         "sources": sources,
         "metadata": {
             "total_records_analyzed": total_records,
-            "query_time_ms": int((time.time() - start_time) * 1000),
+            "query_time_ms": query_time_ms,
             "sources_used": len(sources),
-            "context_tokens": getattr(llm_response, 'tokens_used', 0)
+            # Conteo exacto que reporta la API; no se re-tokeniza el contexto
+            "context_tokens": getattr(llm_response, 'prompt_tokens', 0)
         }
     }
 
-    logger.info(f"Query completada exitosamente en {response['metadata']['query_time_ms']}ms")
+    logger.info(f"Query completada exitosamente en {query_time_ms}ms")
     
-    # 8. GUARDAR EN AUDIT LOGS (Historial)
-    try:
-        from app.models.audit_logs import AuditLog
-        from uuid import UUID
+    _response_cache.set(cache_key, response)
+    
+    # 7. GUARDAR EN AUDIT LOGS (Historial)
+    await _save_audit_log(db, input_data, sequence_chat_id, sanitized_doc_number, response)
+    
+    return response
+
+
+# === ENDPOINT STREAMING ===
+
+def _ndjson(event: dict) -> bytes:
+    """Serializa un evento como una línea NDJSON"""
+    return orjson.dumps(event) + b"\n"
+
+
+@router.post("/stream", openapi_extra=_QUERY_INPUT_OPENAPI)
+async def query_patient_stream(input_data: QueryInput = Depends(_parse_query_input)):
+    """
+    Igual que POST /query/ pero entrega la respuesta del LLM a medida que
+    se genera, como NDJSON (una línea JSON por evento):
+    
+    - {"type": "meta", "patient_info": ...}
+    - {"type": "token", "text": ...} por cada fragmento del modelo
+    - {"type": "done", "answer": ..., "sources": ..., "metadata": ...}
+    - {"type": "error", "error": ...} si algo falla
+    
+    Los errores de validación se responden como JSON igual que /query/.
+    """
+    sequence_chat_id = 1  # una entrada rechazada no reserva número
+    
+    is_valid, error_msg = validate_query_input(input_data)
+    if not is_valid:
+        logger.warning(f" Input inválido rechazado: {error_msg}")
+        return ORJSONResponse(_error_response(
+            input_data, sequence_chat_id, "INVALID_INPUT",
+            error_msg,
+            "Verifica que los datos sean correctos"
+        ))
+    
+    sanitized_doc_number = sanitize_document_number(input_data.document_number)
+    return StreamingResponse(
+        _stream_query(input_data, sanitized_doc_number),
+        media_type="application/x-ndjson"
+    )
+
+
+async def _stream_query(
+    input_data: QueryInput,
+    sanitized_doc_number: str
+) -> AsyncIterator[bytes]:
+    """
+    Generador del endpoint streaming. Abre su propia sesión porque las
+    dependencias con yield se cierran antes de que corra el cuerpo.
+    """
+    start_time = time.perf_counter()
+    
+    def error_event(code: str, message: str) -> bytes:
+        return _ndjson({"type": "error", "error": {"code": code, "message": message}})
+    
+    async with new_async_session() as db:
+        sequence_chat_id = await _next_sequence(db, input_data.session_id)
+        
+        # CACHE: la respuesta completa se entrega como un solo token
+        cache_key = _response_cache_key(input_data.document_type_id, sanitized_doc_number, input_data.question)
+        cached = _response_cache.get(cache_key)
+        if cached is not None:
+            response = {
+                **cached,
+                "session_id": input_data.session_id,
+                "sequence_chat_id": sequence_chat_id,
+                "timestamp": get_iso_timestamp(),
+                "metadata": {
+                    **cached["metadata"],
+                    "query_time_ms": _elapsed_ms(start_time)
+                }
+            }
+            yield _ndjson({"type": "meta", "patient_info": response["patient_info"]})
+            yield _ndjson({"type": "token", "text": response["answer"]["text"]})
+            yield _ndjson({
+                "type": "done",
+                "answer": response["answer"],
+                "sources": response["sources"],
+                "metadata": response["metadata"]
+            })
+            # Igual que POST /query/: la respuesta cacheada también queda en
+            # el historial de la sesión (y ocupa su sequence_chat_id)
+            await _save_audit_log(db, input_data, sequence_chat_id, sanitized_doc_number, response)
+            return
+        
+        try:
+            patient_info, clinical_data, similar_chunks = await _fetch_patient_data(
+                db, input_data.document_type_id, sanitized_doc_number, input_data.question
+            )
+        except Exception as e:
+            if isinstance(e, ExceptionGroup):
+                e = e.exceptions[0]
+            logger.error(f"Error en búsqueda de paciente: {type(e).__name__}")
+            yield error_event("DATABASE_ERROR", "Error al buscar datos del paciente")
+            return
+        
+        if not patient_info:
+            doc_type = get_document_type_name(input_data.document_type_id)
+            yield error_event(
+                "PATIENT_NOT_FOUND",
+                f"No se encontró paciente con documento {doc_type} {sanitized_doc_number}"
+            )
+            return
+        
+        patient_summary = _patient_summary(patient_info, input_data.document_type_id)
+        yield _ndjson({"type": "meta", "patient_info": patient_summary})
         
-        audit_log = AuditLog(
-            user_id=int(input_data.user_id),
-            session_id=UUID(input_data.session_id),
-            sequence_chat_id=sequence_chat_id,
-            document_type_id=input_data.document_type_id,
-            document_number=sanitized_doc_number,
-            question=input_data.question,
-            response_json=response
+        records = clinical_data.records
+        total_records = _count_records(records, similar_chunks)
+        
+        # Sin registros: la misma respuesta que POST /query/, sin LLM ni cache
+        if total_records == 0:
+            response = _no_data_response(input_data, sequence_chat_id, patient_summary, start_time)
+            yield _ndjson({"type": "token", "text": response["answer"]["text"]})
+            yield _ndjson({
+                "type": "done",
+                "answer": response["answer"],
+                "sources": response["sources"],
+                "metadata": response["metadata"]
+            })
+            await _save_audit_log(db, input_data, sequence_chat_id, sanitized_doc_number, response)
+            return
+        
+        context, sources = build_context_and_sources(
+            patient_info=patient_info,
+            clinical_records=records,
+            similar_chunks=similar_chunks,
+            sequence_counter=1
         )
-        db.add(audit_log)
-        db.commit()
-        logger.info(f"Consulta guardada en audit_logs: audit_log_id={audit_log.audit_log_id}")
-    except Exception as e:
-        logger.error(f"Error guardando en audit_logs: {type(e).__name__}: {e}")
-        # No fallar la petición si falla el guardado del log
-        db.rollback()
-    
-    return response
\ No newline at end of file
+        
+        # LLM en streaming; si falla antes del primer token se usa el fallback
+        parts: List[str] = []
+        model_used = llm_service.model
+        confidence = 0.94
+        try:
+            async with asyncio.timeout(LLM_TIMEOUT_SECONDS):
+                async for delta in llm_service.stream_llm(
+                    input_data.question, context,
+                    cache_key=prompt_cache_key(patient_info.patient_id, input_data.session_id)
+                ):
+                    parts.append(delta)
+                    yield _ndjson({"type": "token", "text": delta})
+        except Exception as e:
+            logger.error(f"Error en streaming del LLM: {type(e).__name__}")
+            if parts:
+                yield error_event("LLM_ERROR", "La respuesta del modelo se interrumpió")
+                return
+            fallback_text = _generate_fallback_response(records, input_data.question)
+            parts.append(fallback_text)
+            model_used = "fallback-system"
+            confidence = 0.65
+            yield _ndjson({"type": "token", "text": fallback_text})
+        
+        response = {
+            "status": "success",
+            "session_id": input_data.session_id,
+            "sequence_chat_id": sequence_chat_id,
+            "timestamp": get_iso_timestamp(),
+            "patient_info": patient_summary,
+            "answer": {
+                "text": "".join(parts).strip(),
+                "confidence": confidence,
+                "model_used": model_used
+            },
+            "sources": sources,
+            "metadata": {
+                "total_records_analyzed": total_records,
+                "query_time_ms": _elapsed_ms(start_time),
+                "sources_used": len(sources)
+            }
+        }
+        yield _ndjson({
+            "type": "done",
+            "answer": response["answer"],
+            "sources": sources,
+            "metadata": response["metadata"]
+        })
+        
+        if model_used != "fallback-system":
+            _response_cache.set(cache_key, response)
+        await _save_audit_log(db, input_data, sequence_chat_id, sanitized_doc_number, response)
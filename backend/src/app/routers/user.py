@@ -1,7 +1,7 @@
 # src/app/routers/user.py
 
 from fastapi import APIRouter, Depends, HTTPException, status
-from sqlalchemy.orm import Session
+from sqlalchemy.ext.asyncio import AsyncSession
 from typing import List
 from app.schemas.user import UserResponse, UserUpdate
 from app.database.database import get_db
@@ -15,46 +15,72 @@ router = APIRouter(
 )
 
 
+def _to_user_response(user: User) -> UserResponse:
+    """
+    UserResponse a partir del ORM sin revalidar: las columnas ya llegan
+    tipadas desde la BD. Los endpoints que lo usan declaran
+    response_model=None (el schema queda documentado en `responses`) para
+    que FastAPI no vuelva a validar la respuesta.
+    """
+    return UserResponse.model_construct(
+        user_id=user.user_id,
+        email=user.email,
+        first_name=user.first_name,
+        middle_name=user.middle_name,
+        first_surname=user.first_surname,
+        second_surname=user.second_surname,
+        is_active=user.is_active,
+        created_at=user.created_at,
+        updated_at=user.updated_at
+    )
+
+
 @router.get(
     "/",
-    response_model=List[UserResponse],
+    response_model=None,
+    responses={200: {"model": List[UserResponse]}},
     summary="Listar todos los usuarios"
 )
-def list_users(
+async def list_users(
     skip: int = 0,
     limit: int = 100,
-    db: Session = Depends(get_db),
+    after_user_id: int = 0,
+    db: AsyncSession = Depends(get_db),
     current_user: User = Depends(get_current_user)
-):
+) -> List[UserResponse]:
     """
-    Lista todos los usuarios con paginación.
+    Lista todos los usuarios con paginación, ordenados por ID.
     
-    - **skip**: Número de registros a saltar (default: 0)
+    - **after_user_id**: ID del último usuario de la página anterior (default: 0)
     - **limit**: Número máximo de registros (default: 100, max: 100)
+    - **skip**: Número de registros a saltar (default: 0; preferir after_user_id)
     """
     if limit > 100:
         limit = 100
     
-    users = UserService.get_all_users(db, skip=skip, limit=limit)
-    return users
+    users = await UserService.get_all_users(
+        db, after_user_id=after_user_id, limit=limit, skip=skip
+    )
+    return [_to_user_response(user) for user in users]
 
 
 
 @router.get(
     "/{user_id}",
-    response_model=UserResponse,
+    response_model=None,
+    responses={200: {"model": UserResponse}},
     summary="Obtener usuario por ID"
 )
-def get_user(
+async def get_user(
     user_id: int,
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_db),
     current_user: User = Depends(get_current_user)
-):
+) -> UserResponse:
     """
     Obtiene la información de un usuario específico por su ID.
     Requiere autenticación.
     """
-    user = UserService.get_user_by_id(db, user_id)
+    user = await UserService.get_user_by_id(db, user_id)
     
     if not user:
         raise HTTPException(
@@ -62,20 +88,21 @@ def get_user(
             detail="Usuario no encontrado"
         )
     
-    return user
+    return _to_user_response(user)
 
 
 @router.put(
     "/{user_id}",
-    response_model=UserResponse,
+    response_model=None,
+    responses={200: {"model": UserResponse}},
     summary="Actualizar usuario"
 )
-def update_user(
+async def update_user(
     user_id: int,
     update_data: UserUpdate,
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_db),
     current_user: User = Depends(get_current_user)
-):
+) -> UserResponse:
     """
     Actualiza la información de un usuario.
     Solo el mismo usuario o un administrador pueden actualizar.
@@ -91,7 +118,7 @@ def update_user(
         # Convertir el schema a dict, excluyendo valores None
         update_dict = update_data.model_dump(exclude_unset=True)
         
-        updated_user = UserService.update_user(db, user_id, update_dict)
+        updated_user = await UserService.update_user(db, user_id, update_dict)
         
         if not updated_user:
             raise HTTPException(
@@ -99,7 +126,7 @@ def update_user(
                 detail="Usuario no encontrado"
             )
         
-        return updated_user
+        return _to_user_response(updated_user)
         
     except Exception as e:
         raise HTTPException(
@@ -115,9 +142,9 @@ def update_user(
     status_code=status.HTTP_204_NO_CONTENT,
     summary="Desactivar usuario"
 )
-def deactivate_user(
+async def deactivate_user(
     user_id: int,
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_db),
     current_user: User = Depends(get_current_user)
 ):
     """
@@ -132,7 +159,7 @@ def deactivate_user(
         )
     
     try:
-        success = UserService.deactivate_user(db, user_id)
+        success = await UserService.deactivate_user(db, user_id)
         
         if not success:
             raise HTTPException(
@@ -4,21 +4,23 @@ from fastapi import APIRouter, WebSocket, WebSocketDisconnect, Query, status
 from typing import Optional
 import json
 import logging
+import orjson
 import asyncio
 from datetime import datetime, timezone
 
 from app.services.auth_utils import verify_token
-from app.services.clinical_service import fetch_patient_and_records
-from app.services.vector_search import search_similar_chunks
-from app.services.llm_service import llm_service
-from app.database.database import SessionLocal
+from app.services.llm_service import NO_DATA_CONFIDENCE, NO_DATA_MODEL, llm_service, prompt_cache_key
+from app.routers.query import (
+    _fetch_patient_data,
+    build_context_and_sources,
+)
+from app.database.database import new_async_session
 
 logger = logging.getLogger(__name__)
 
 router = APIRouter()
 
 # Configuración de timeouts
-STREAMING_CHUNK_DELAY = 0.05
 MAX_MESSAGE_SIZE = 10 * 1024 * 1024  # 10MB
 WEBSOCKET_TIMEOUT = 300  # 5 minutos
 
@@ -68,9 +70,9 @@ class ConnectionManager:
         return True
     
     async def send_json(self, websocket: WebSocket, data: dict):
-        """Envía datos JSON de forma segura"""
+        """Envía datos JSON de forma segura (orjson: fechas en ISO 8601)"""
         try:
-            await websocket.send_json(data)
+            await websocket.send_text(orjson.dumps(data).decode())
         except Exception as e:
             logger.error(f"Error enviando JSON: {str(e)}")
             raise
@@ -95,8 +97,13 @@ def sanitize_input(text: str, max_length: int = 1000) -> str:
     Returns:
         Texto sanitizado
     """
-    # Eliminar caracteres de control excepto saltos de línea
-    sanitized = ''.join(char for char in text if char.isprintable() or char in '\n\r')
+    # Eliminar caracteres de control excepto saltos de línea. El caso común
+    # (texto ya imprimible) se resuelve con una sola pasada en C; si no, la
+    # lista materializada evita el frame del generador dentro de join
+    if text.isprintable():
+        sanitized = text
+    else:
+        sanitized = ''.join([char for char in text if char.isprintable() or char in '\n\r'])
     
     # Truncar si es muy largo
     if len(sanitized) > max_length:
@@ -286,7 +293,7 @@ async def process_query(websocket: WebSocket, data: dict, user_id: int):
     """
     Procesa una query y envía la respuesta con streaming.
     """
-    db = SessionLocal()
+    db = new_async_session()
     
     try:
         # Sanitizar inputs
@@ -300,11 +307,10 @@ async def process_query(websocket: WebSocket, data: dict, user_id: int):
             "message": "Buscando información del paciente"
         })
         
-        # Buscar paciente
-        patient_info, clinical_data = fetch_patient_and_records(
-            db=db,
-            document_type_id=data["document_type_id"],
-            document_number=document_number
+        # Buscar paciente; registros clínicos y búsqueda vectorial corren
+        # en paralelo (y el embedding junto con la búsqueda del paciente)
+        patient_info, clinical_data, similar_chunks = await _fetch_patient_data(
+            db, data["document_type_id"], document_number, question
         )
         
         if not patient_info:
@@ -317,26 +323,19 @@ async def process_query(websocket: WebSocket, data: dict, user_id: int):
             })
             return
         
-        # Status: Búsqueda vectorial
+        # Status: Análisis
         await manager.send_json(websocket, {
             "type": "status",
             "message": "Analizando registros médicos"
         })
         
-        # Búsqueda vectorial
-        similar_chunks = await search_similar_chunks(
-            patient_id=patient_info.patient_id,
-            question=question,
-            k=15,
-            min_score=0.3
-        )
-        
-        # Construir contexto
-        from app.routers.query import build_context_from_real_data
-        context = build_context_from_real_data(
+        # Construir contexto y sources en un solo recorrido
+        records = clinical_data.records
+        context, sources = build_context_and_sources(
             patient_info=patient_info,
-            clinical_records=clinical_data.records,
-            similar_chunks=similar_chunks
+            clinical_records=records,
+            similar_chunks=similar_chunks,
+            sequence_counter=1
         )
         
         # Status: Generando respuesta
@@ -350,35 +349,28 @@ async def process_query(websocket: WebSocket, data: dict, user_id: int):
             "type": "stream_start"
         })
         
-        # Llamar al LLM
-        llm_response = await llm_service.run_llm(
+        # Reenviar los fragmentos del LLM a medida que el modelo los genera;
+        # sin registros ni chunks el servicio responde sin llamar a la API
+        has_data = clinical_data.has_data or bool(similar_chunks)
+        parts = []
+        async for delta in llm_service.stream_llm(
             question=question,
-            context=context
-        )
-        
-        # Enviar tokens uno por uno
-        if llm_response and llm_response.text:
-            words = llm_response.text.split()
-            for word in words:
-                await manager.send_json(websocket, {
-                    "type": "token",
-                    "token": word + " "
-                })
-                await asyncio.sleep(STREAMING_CHUNK_DELAY)
+            context=context,
+            has_data=has_data,
+            cache_key=prompt_cache_key(patient_info.patient_id, session_id)
+        ):
+            parts.append(delta)
+            await manager.send_json(websocket, {
+                "type": "token",
+                "token": delta
+            })
+        answer_text = "".join(parts).strip()
         
         # Fin de streaming
         await manager.send_json(websocket, {
             "type": "stream_end"
         })
         
-        # Construir sources
-        from app.routers.query import build_sources_from_real_data
-        sources = build_sources_from_real_data(
-            clinical_data.records,
-            similar_chunks,
-            sequence_counter=1
-        )
-        
         # Respuesta completa
         await manager.send_json(websocket, {
             "type": "complete",
@@ -386,20 +378,20 @@ async def process_query(websocket: WebSocket, data: dict, user_id: int):
             "timestamp": get_iso_timestamp(),
             "patient_info": {
                 "patient_id": patient_info.patient_id,
-                "full_name": f"{patient_info.first_name} {patient_info.first_surname}",
+                "full_name": patient_info.full_name or f"{patient_info.first_name} {patient_info.first_surname}",
                 "document_type": "CC",
                 "document_number": document_number
             },
             "answer": {
-                "text": llm_response.text,
-                "confidence": llm_response.confidence,
-                "model_used": llm_response.model_used
+                "text": answer_text,
+                "confidence": 0.85 if has_data else NO_DATA_CONFIDENCE,
+                "model_used": llm_service.model if has_data else NO_DATA_MODEL
             },
             "sources": sources,
             "metadata": {
-                "total_records_analyzed": len(clinical_data.records.appointments) + 
-                                        len(clinical_data.records.diagnoses) +
-                                        len(clinical_data.records.prescriptions),
+                "total_records_analyzed": (
+                    len(records.appointments) + len(records.diagnoses) + len(records.prescriptions)
+                ),
                 "vector_chunks_used": len(similar_chunks),
                 "query_time_ms": 0
             }
@@ -416,4 +408,4 @@ async def process_query(websocket: WebSocket, data: dict, user_id: int):
         })
     
     finally:
-        db.close()
\ No newline at end of file
+        await db.close()
\ No newline at end of file
@@ -21,6 +21,7 @@ class PatientInfo(BaseModel):
     registration_date: Optional[datetime] = None  #  Cambiar de date a datetime
     active: bool = True
     blood_type: Optional[str] = None
+    full_name: Optional[str] = None  # Patient.full_name, calculado en la BD
 
     class Config:
         from_attributes = True  # Antes era orm_mode = True
@@ -1,17 +1,22 @@
 # app/schemas/user.py
 
-from pydantic import BaseModel, EmailStr, Field, ConfigDict
-from typing import Optional
+from pydantic import BaseModel, EmailStr, Field, ConfigDict, StringConstraints
+from typing import Annotated, Optional
 from datetime import datetime
 
+# Nombres sin espacios sobrantes; la validación corre en pydantic-core.
+# No se usa str_strip_whitespace en el modelo para no alterar la contraseña
+Name = Annotated[str, StringConstraints(strip_whitespace=True, min_length=1, max_length=50)]
+OptionalName = Annotated[str, StringConstraints(strip_whitespace=True, max_length=50)]
+
 
 class UserBase(BaseModel):
     """Schema base con campos comunes de usuario"""
     email: EmailStr
-    first_name: str = Field(..., min_length=1, max_length=50)
-    middle_name: Optional[str] = Field(None, max_length=50)
-    first_surname: str = Field(..., min_length=1, max_length=50)
-    second_surname: Optional[str] = Field(None, max_length=50)
+    first_name: Name
+    middle_name: Optional[OptionalName] = None
+    first_surname: Name
+    second_surname: Optional[OptionalName] = None
 
 
 class UserCreate(UserBase):
@@ -37,10 +42,10 @@ class UserUpdate(BaseModel):
     Schema para actualizar un usuario existente.
     Todos los campos son opcionales.
     """
-    first_name: Optional[str] = Field(None, min_length=1, max_length=50)
-    middle_name: Optional[str] = Field(None, max_length=50)
-    first_surname: Optional[str] = Field(None, min_length=1, max_length=50)
-    second_surname: Optional[str] = Field(None, max_length=50)
+    first_name: Optional[Name] = None
+    middle_name: Optional[OptionalName] = None
+    first_surname: Optional[Name] = None
+    second_surname: Optional[OptionalName] = None
     email: Optional[EmailStr] = None
 
     model_config = ConfigDict(
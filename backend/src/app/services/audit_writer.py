@@ -0,0 +1,104 @@
+# src/app/services/audit_writer.py
+"""
+Escritura de audit_logs en segundo plano.
+
+Las consultas encolan su registro y siguen: una tarea del worker junta
+los registros de una ventana corta (o hasta llenar un lote) y los inserta
+con un solo INSERT de varias filas y un solo commit. El commit (y su
+fsync) sale de la latencia que ve el usuario y se paga una vez por lote.
+"""
+
+import asyncio
+import logging
+from typing import List, Optional
+
+from sqlalchemy import insert
+
+from app.database.database import new_async_session
+from app.models.audit_logs import AuditLog
+
+logger = logging.getLogger(__name__)
+
+# Un lote se escribe a los 50 ms de su primer registro o al llegar a 100
+AUDIT_FLUSH_INTERVAL_SECONDS = 0.05
+AUDIT_BATCH_SIZE = 100
+# Con la BD caída la cola no crece sin límite: lleno, el llamador escribe
+# directo (y falla como antes)
+AUDIT_QUEUE_MAXSIZE = 10_000
+
+# Marca de fin para la tarea (stop)
+_STOP = None
+
+
+class AuditWriter:
+    """Cola de registros de audit_logs y la tarea que los inserta por lotes"""
+
+    def __init__(self):
+        self._queue: Optional[asyncio.Queue] = None
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self) -> None:
+        """Arranca la tarea del worker (evento startup)"""
+        self._queue = asyncio.Queue(maxsize=AUDIT_QUEUE_MAXSIZE)
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        """Escribe lo pendiente y detiene la tarea (evento shutdown)"""
+        if self._task is None:
+            return
+        # La marca entra al final: todo lo encolado antes se escribe
+        await self._queue.put(_STOP)
+        await self._task
+        self._task = None
+
+    def submit(self, row: dict) -> bool:
+        """
+        Encola un registro (columnas de AuditLog). False si la tarea no
+        corre o la cola está llena: el llamador debe escribirlo él mismo.
+        """
+        if self._task is None or self._task.done():
+            return False
+        try:
+            self._queue.put_nowait(row)
+        except asyncio.QueueFull:
+            logger.warning("Cola de audit_logs llena: se escribe sin lote")
+            return False
+        return True
+
+    async def _run(self) -> None:
+        loop = asyncio.get_running_loop()
+        stopping = False
+        while not stopping:
+            row = await self._queue.get()
+            if row is _STOP:
+                break
+            batch: List[dict] = [row]
+            deadline = loop.time() + AUDIT_FLUSH_INTERVAL_SECONDS
+            while len(batch) < AUDIT_BATCH_SIZE:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    row = await asyncio.wait_for(self._queue.get(), timeout)
+                except TimeoutError:
+                    break
+                if row is _STOP:
+                    stopping = True
+                    break
+                batch.append(row)
+            await self._flush(batch)
+
+    async def _flush(self, batch: List[dict]) -> None:
+        # executemany de insert(): SQLAlchemy lo envía como un solo
+        # INSERT ... VALUES (...), (...) ("insertmanyvalues")
+        try:
+            async with new_async_session() as db:
+                await db.execute(insert(AuditLog), batch)
+                await db.commit()
+            logger.info(f"audit_logs: {len(batch)} registro(s) guardados en un lote")
+        except Exception as e:
+            # Igual que antes: un fallo del log no afecta a las consultas
+            logger.error(f"Error guardando lote de audit_logs ({len(batch)} registros): {type(e).__name__}: {e}")
+
+
+audit_writer = AuditWriter()
@@ -1,11 +1,34 @@
 # src/app/services/auth_service.py
 
-from sqlalchemy.orm import Session
+from sqlalchemy import bindparam, literal, select, update
 from sqlalchemy.exc import IntegrityError
-from typing import Optional, Dict
+from sqlalchemy.ext.asyncio import AsyncSession
+from typing import Optional, Dict, Tuple
+import hashlib
 
+from app.core.cache import TTLCache
 from app.models.user import User
-from app.core.security import hash_password, verify_password, create_access_token
+from app.core.security import hash_password_async, verify_and_update_password_async, create_access_token
+
+# email -> (user_id, password_hash, is_active) para logins repetidos.
+# TTL corto: cada worker tiene su propia copia y solo se invalida localmente
+_login_cache = TTLCache(maxsize=10_000, ttl=30)
+
+
+# Sentencias de las rutas calientes construidas una sola vez: retornan
+# filas (no objetos User) y reutilizan el SQL compilado del cache
+_email_exists_stmt = (
+    select(literal(1)).where(User.email == bindparam("email")).limit(1)
+)
+_login_credentials_stmt = (
+    select(User.user_id, User.password_hash, User.is_active)
+    .where(User.email == bindparam("email"))
+)
+_user_by_email_stmt = select(User).where(User.email == bindparam("email"))
+
+
+def _login_cache_key(email: str) -> bytes:
+    return hashlib.sha1(email.encode()).digest()
 
 
 class AuthService:
@@ -15,32 +38,32 @@ class AuthService:
     """
 
     @staticmethod
-    def register_user(db: Session, user_data) -> User:
+    async def register_user(db: AsyncSession, user_data) -> User:
         """
         Registra un nuevo usuario en el sistema.
         
         Args:
-            db: Sesión de base de datos
+            db: Sesión async de base de datos
             user_data: Esquema UserCreate con los datos del usuario
             
         Returns:
             User: Usuario creado
             
         Raises:
-            ValueError: Si el email ya está registrado o la contraseña es inválida
+            ValueError: Si el email ya está registrado
             Exception: Para otros errores de base de datos
         """
-        # Validar longitud de contraseña
-        if len(user_data.password) < 6:
-            raise ValueError("La contraseña debe tener al menos 6 caracteres")
+        # El formato del email y la longitud de la contraseña ya los valida
+        # UserCreate (422 antes de tocar la BD o hashear)
         
-        # Verificar si el email ya existe
-        existing_user = db.query(User).filter(User.email == user_data.email).first()
-        if existing_user:
+        # Verificar si el email ya existe: solo un SELECT 1 sobre el índice
+        # único, sin hidratar un User (una carrera la cubre el IntegrityError)
+        result = await db.execute(_email_exists_stmt, {"email": user_data.email})
+        if result.first() is not None:
             raise ValueError("El correo electrónico ya está registrado")
         
         # Hashear contraseña
-        hashed_password = hash_password(user_data.password)
+        hashed_password = await hash_password_async(user_data.password)
         
         # Crear nuevo usuario
         new_user = User(
@@ -54,48 +77,62 @@ class AuthService:
         
         try:
             db.add(new_user)
-            db.commit()
-            db.refresh(new_user)
+            await db.commit()
+            await db.refresh(new_user)
             return new_user
         except IntegrityError:
-            db.rollback()
+            await db.rollback()
             raise ValueError("Error de integridad: el correo ya existe")
         except Exception as e:
-            db.rollback()
+            await db.rollback()
             raise Exception(f"Error al crear usuario: {str(e)}")
 
     @staticmethod
-    def authenticate_user(db: Session, email: str, password: str) -> Optional[User]:
+    async def get_login_credentials(
+        db: AsyncSession,
+        email: str
+    ) -> Optional[Tuple[int, str, bool]]:
         """
-        Autentica un usuario validando email y contraseña.
+        Obtiene (user_id, password_hash, is_active) para el login.
+        
+        Consulta solo las tres columnas necesarias y las guarda en un cache
+        TTL en memoria, así los logins repetidos no tocan la base de datos.
         
         Args:
-            db: Sesión de base de datos
+            db: Sesión async de base de datos
             email: Email del usuario
-            password: Contraseña en texto plano
             
         Returns:
-            User si las credenciales son correctas, None si no
+            Tupla de credenciales o None si el usuario no existe
         """
-        # Buscar usuario por email
-        user = db.query(User).filter(User.email == email).first()
-        
-        if not user:
+        key = _login_cache_key(email)
+        credentials = _login_cache.get(key)
+        if credentials is not None:
+            return credentials
+        
+        result = await db.execute(_login_credentials_stmt, {"email": email})
+        row = result.first()
+        if row is None:
             return None
         
-        # Verificar contraseña
-        if not verify_password(password, user.password_hash):
-            return None
-        
-        return user
+        credentials = (row.user_id, row.password_hash, row.is_active)
+        _login_cache.set(key, credentials)
+        return credentials
+
+    @staticmethod
+    def invalidate_login_cache(*emails: str) -> None:
+        """Descarta credenciales cacheadas tras cambios en el usuario."""
+        for email in emails:
+            if email:
+                _login_cache.pop(_login_cache_key(email))
 
     @staticmethod
-    def login(db: Session, email: str, password: str) -> Dict[str, str]:
+    async def login(db: AsyncSession, email: str, password: str) -> Dict[str, str]:
         """
         Procesa el login y genera el token JWT.
         
         Args:
-            db: Sesión de base de datos
+            db: Sesión async de base de datos
             email: Email del usuario
             password: Contraseña del usuario
             
@@ -105,18 +142,37 @@ class AuthService:
         Raises:
             ValueError: Si las credenciales son incorrectas o el usuario está inactivo
         """
-        # Autenticar usuario
-        user = AuthService.authenticate_user(db, email, password)
+        # Autenticar usuario (credenciales desde cache o base de datos)
+        credentials = await AuthService.get_login_credentials(db, email)
         
-        if not user:
+        if not credentials:
             raise ValueError("Credenciales incorrectas")
         
+        user_id, password_hash, is_active = credentials
+        is_valid, new_hash = await verify_and_update_password_async(password, password_hash)
+        
+        if not is_valid:
+            raise ValueError("Credenciales incorrectas")
+        
+        # Migrar hashes bcrypt heredados a Argon2id
+        if new_hash:
+            try:
+                await db.execute(
+                    update(User)
+                    .where(User.user_id == user_id)
+                    .values(password_hash=new_hash)
+                )
+                await db.commit()
+            except Exception:
+                await db.rollback()
+            AuthService.invalidate_login_cache(email)
+        
         # Verificar que el usuario esté activo
-        if not user.is_active:
+        if not is_active:
             raise ValueError("Usuario inactivo. Contacte al administrador")
         
         # Generar token JWT
-        token_data = {"sub": str(user.user_id)}
+        token_data = {"sub": str(user_id)}
         access_token = create_access_token(token_data)
         
         return {
@@ -125,29 +181,30 @@ class AuthService:
         }
 
     @staticmethod
-    def get_user_by_email(db: Session, email: str) -> Optional[User]:
+    async def get_user_by_email(db: AsyncSession, email: str) -> Optional[User]:
         """
         Obtiene un usuario por su email.
         
         Args:
-            db: Sesión de base de datos
+            db: Sesión async de base de datos
             email: Email del usuario
             
         Returns:
             User si existe, None si no
         """
-        return db.query(User).filter(User.email == email).first()
+        result = await db.execute(_user_by_email_stmt, {"email": email})
+        return result.scalars().first()
 
     @staticmethod
-    def get_user_by_id(db: Session, user_id: int) -> Optional[User]:
+    async def get_user_by_id(db: AsyncSession, user_id: int) -> Optional[User]:
         """
         Obtiene un usuario por su ID.
         
         Args:
-            db: Sesión de base de datos
+            db: Sesión async de base de datos
             user_id: ID del usuario
             
         Returns:
             User si existe, None si no
         """
-        return db.query(User).filter(User.user_id == user_id).first()
\ No newline at end of file
+        return await db.get(User, user_id)
\ No newline at end of file
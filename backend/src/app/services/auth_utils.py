@@ -4,8 +4,7 @@ Utilidades de autenticación para WebSocket y otros usos.
 """
 
 from typing import Optional, Dict
-from jose import jwt, JWTError
-from app.core.security import SECRET_KEY, ALGORITHM
+from app.core.security import decode_access_token
 import logging
 
 logger = logging.getLogger(__name__)
@@ -16,7 +15,11 @@ def verify_token(token: str) -> Optional[Dict]:
     Verifica y decodifica un token JWT.
     """
     try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+        payload = decode_access_token(token)
+        if payload is None:
+            logger.warning("Token JWT inválido o expirado")
+            return None
+        
         user_id = payload.get("sub")
         if user_id is None:
             logger.warning("Token sin campo 'sub'")
@@ -27,9 +30,6 @@ def verify_token(token: str) -> Optional[Dict]:
             "exp": payload.get("exp")
         }
         
-    except JWTError as e:
-        logger.warning(f"Token JWT inválido: {type(e).__name__}")
-        return None
     except ValueError as e:
         logger.warning(f"Error convirtiendo user_id: {e}")
         return None
@@ -1,16 +1,17 @@
 # src/app/services/clinical_service.py
 from typing import Optional, Tuple, List
-from sqlalchemy.orm import Session
-from sqlalchemy import text
+from pydantic import TypeAdapter
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy import bindparam, select, text
 import logging
 
-# Modelos SQLAlchemy
+# Modelos SQLAlchemy. Las tablas hijas (citas, registros, prescripciones,
+# diagnósticos) no se cargan por el ORM: ni con relaciones selectin (1 + 4
+# consultas y objetos con identity map) se iguala la consulta json_agg
+# de abajo, que trae las cuatro en una sola sentencia
 from app.models.patient import Patient
-from app.models.appointment import Appointment
-from app.models.medical_record import MedicalRecord
-from app.models.prescription import Prescription
-from app.models.diagnosis import Diagnosis
-from app.models.record_diagnosis import RecordDiagnosis
+
+from app.core.cache import TTLCache
 
 # Schemas Pydantic
 from app.schemas.clinical import (
@@ -25,12 +26,47 @@ from app.schemas.clinical import (
 
 logger = logging.getLogger(__name__)
 
+# Pacientes por (document_type_id, document_number). En un chat se consulta
+# el mismo documento en cada pregunta y los datos del paciente casi no
+# cambian; el TTL acota lo desactualizado entre workers. Los "no
+# encontrado" no se guardan para que un paciente recién creado aparezca
+PATIENT_CACHE_TTL_SECONDS = 300
+_patient_cache = TTLCache(maxsize=4096, ttl=PATIENT_CACHE_TTL_SECONDS)
+
+
+# Solo las columnas de PatientInfo: la consulta retorna filas (no objetos
+# Patient con su identity map) y se construye una sola vez
+_patient_by_document_stmt = select(
+    Patient.patient_id,
+    Patient.first_name,
+    Patient.middle_name,
+    Patient.first_surname,
+    Patient.second_surname,
+    Patient.birth_date,
+    Patient.gender,
+    Patient.email,
+    Patient.document_type_id,
+    Patient.document_number,
+    Patient.registration_date,
+    Patient.active,
+    Patient.blood_type,
+    Patient.full_name.label("full_name"),
+).where(
+    Patient.document_type_id == bindparam("document_type_id"),
+    Patient.document_number == bindparam("document_number")
+)
+
+def invalidate_patient(document_type_id: int, document_number: str) -> None:
+    """Descarta el paciente cacheado (llamar al modificar sus datos)."""
+    _patient_cache.pop((document_type_id, document_number))
+
+
 # ============================================================================ 
 # P2-2: Función para obtener paciente por documento
 # ============================================================================
 
-def get_patient_by_document(
-    db: Session,
+async def get_patient_by_document(
+    db: AsyncSession,
     document_type_id: int,
     document_number: str
 ) -> Optional[PatientInfo]:
@@ -38,229 +74,210 @@ def get_patient_by_document(
     Busca paciente por document_type_id y document_number.
     Devuelve PatientInfo si existe, o None si no se encuentra.
     """
+    cache_key = (document_type_id, document_number)
+    cached = _patient_cache.get(cache_key)
+    if cached is not None:
+        return cached
+
     try:
-        patient = (
-            db.query(Patient)
-            .filter(
-                Patient.document_type_id == document_type_id,
-                Patient.document_number == document_number
-            )
-            .one_or_none()
+        result = await db.execute(
+            _patient_by_document_stmt,
+            {"document_type_id": document_type_id, "document_number": document_number}
         )
+        row = result.one_or_none()
     except Exception:
         logger.exception("Error ejecutando query get_patient_by_document")
         raise
 
-    if not patient:
+    if row is None:
         return None
 
-    #  Mapear manualmente para manejar registration_date correctamente
-    return PatientInfo(
-        patient_id=patient.patient_id,
-        first_name=patient.first_name,
-        middle_name=patient.middle_name,
-        first_surname=patient.first_surname,
-        second_surname=patient.second_surname,
-        birth_date=patient.birth_date,
-        gender=patient.gender,
-        email=patient.email,
-        document_type_id=patient.document_type_id,
-        document_number=patient.document_number,
-        registration_date=patient.registration_date,  # Ya es datetime desde la BD
-        active=patient.active,
-        blood_type=patient.blood_type
-    )
+    #  Las columnas seleccionadas tienen los mismos nombres que los campos
+    #  de PatientInfo y ya llegan tipadas (registration_date es datetime),
+    #  así que model_construct evita revalidarlas (la entrada del usuario
+    #  se valida en el router)
+    patient_info = PatientInfo.model_construct(**row._mapping)
+    _patient_cache.set(cache_key, patient_info)
+    return patient_info
 
 
 # ============================================================================ 
 # P2-3: Funciones para obtener datos clínicos por paciente
 # ============================================================================
 
-def get_appointments_by_patient(db: Session, patient_id: int) -> List[AppointmentDTO]:
+# SQL de cada tabla hija, compartido entre los getters individuales y la
+# consulta combinada de fetch_clinical_records (un solo round-trip).
+# Solo se seleccionan las columnas que consumen el contexto, las sources y
+# el fallback; los campos opcionales restantes de los DTO quedan en su
+# default (vital_signs, p. ej., es un JSON que nadie lee)
+#
+# No se lanzan los cuatro getters con asyncio.gather: una AsyncSession no
+# admite sentencias concurrentes y abrir una conexión por tabla consumiría
+# casi todo el pool (db_pool_size=5 por worker) en una sola petición. La
+# consulta combinada ya cuesta max(tabla) en la BD y un solo round-trip,
+# y el router la corre en paralelo con la búsqueda vectorial
+
+# Tope de filas por tabla, ordenadas de la más reciente a la más antigua:
+# lo máximo que consume build_context_and_sources. El ORDER BY + LIMIT en
+# SQL evita traer, serializar a JSON y validar filas que nadie lee
+MAX_APPOINTMENTS = 10
+MAX_MEDICAL_RECORDS = 10
+MAX_PRESCRIPTIONS = 15
+MAX_DIAGNOSES = 15
+
+# DISTINCT ON para evitar duplicados: toma la primera especialidad activa
+# si el doctor tiene varias. El orden por fecha (y el LIMIT) va afuera
+# porque DISTINCT ON exige ordenar primero por appointment_id
+_APPOINTMENTS_SQL = f"""
+    SELECT * FROM (
+        SELECT DISTINCT ON (a.appointment_id)
+            a.appointment_id,
+            a.patient_id,
+            a.doctor_id,
+            a.appointment_date,
+            a.start_time,
+            a.end_time,
+            a.appointment_type,
+            a.status,
+            a.reason,
+            a.creation_date,
+            d.first_name || ' ' || d.last_name AS doctor_name,
+            s.specialty_name,
+            d.medical_license_number
+        FROM smart_health.appointments a
+        INNER JOIN smart_health.doctors d ON a.doctor_id = d.doctor_id
+        LEFT JOIN smart_health.doctor_specialties ds ON d.doctor_id = ds.doctor_id AND ds.is_active = TRUE
+        LEFT JOIN smart_health.specialties s ON ds.specialty_id = s.specialty_id
+        WHERE a.patient_id = :patient_id
+        ORDER BY a.appointment_id, ds.certification_date DESC NULLS LAST
+    ) apt
+    ORDER BY apt.appointment_date DESC, apt.start_time DESC NULLS LAST, apt.creation_date DESC NULLS LAST
+    LIMIT {MAX_APPOINTMENTS}
+"""
+
+_MEDICAL_RECORDS_SQL = f"""
+    SELECT
+        mr.medical_record_id,
+        mr.patient_id,
+        mr.doctor_id,
+        mr.registration_datetime,
+        mr.record_type,
+        mr.summary_text
+    FROM smart_health.medical_records mr
+    WHERE mr.patient_id = :patient_id
+    ORDER BY mr.registration_datetime DESC
+    LIMIT {MAX_MEDICAL_RECORDS}
+"""
+
+_PRESCRIPTIONS_SQL = f"""
+    SELECT 
+        p.prescription_id,
+        p.medical_record_id,
+        p.medication_id,
+        p.dosage,
+        p.frequency,
+        p.duration,
+        p.instruction,
+        p.prescription_date,
+        COALESCE(m.commercial_name, 'Medicamento no especificado') AS medication_name
+    FROM smart_health.prescriptions p
+    INNER JOIN smart_health.medical_records mr 
+        ON p.medical_record_id = mr.medical_record_id
+    LEFT JOIN smart_health.medications m 
+        ON p.medication_id = m.medication_id
+    WHERE mr.patient_id = :patient_id
+    ORDER BY p.prescription_date DESC
+    LIMIT {MAX_PRESCRIPTIONS}
+"""
+
+#  Fecha del diagnóstico tomada del medical_record
+_DIAGNOSES_SQL = f"""
+    SELECT 
+        rd.record_diagnosis_id,
+        d.diagnosis_id,
+        d.icd_code,
+        d.description,
+        rd.diagnosis_type,
+        rd.note,
+        mr.registration_datetime AS diagnosis_date
+    FROM smart_health.diagnoses d
+    INNER JOIN smart_health.record_diagnoses rd 
+        ON d.diagnosis_id = rd.diagnosis_id
+    INNER JOIN smart_health.medical_records mr 
+        ON rd.medical_record_id = mr.medical_record_id
+    WHERE mr.patient_id = :patient_id
+    ORDER BY mr.registration_datetime DESC
+    LIMIT {MAX_DIAGNOSES}
+"""
+
+# Las cuatro tablas en una sola consulta: cada subconsulta se agrega como
+# un arreglo JSON (json_agg conserva el orden de la subconsulta) y se
+# entrega como texto para validarlo directamente desde el JSON
+_CLINICAL_RECORDS_SQL = text(f"""
+    SELECT
+        (SELECT COALESCE(json_agg(t), '[]'::json) FROM ({_APPOINTMENTS_SQL}) t)::text AS appointments,
+        (SELECT COALESCE(json_agg(t), '[]'::json) FROM ({_MEDICAL_RECORDS_SQL}) t)::text AS medical_records,
+        (SELECT COALESCE(json_agg(t), '[]'::json) FROM ({_PRESCRIPTIONS_SQL}) t)::text AS prescriptions,
+        (SELECT COALESCE(json_agg(t), '[]'::json) FROM ({_DIAGNOSES_SQL}) t)::text AS diagnoses
+""")
+
+
+# Validadores de lote, compilados una sola vez al importar el módulo.
+# validate_json convierte el arreglo completo (incluidas las fechas ISO
+# 8601 de json_agg) en el núcleo de pydantic, sin dicts intermedios
+_APPOINTMENTS_ADAPTER = TypeAdapter(List[AppointmentDTO])
+_MEDICAL_RECORDS_ADAPTER = TypeAdapter(List[MedicalRecordDTO])
+_PRESCRIPTIONS_ADAPTER = TypeAdapter(List[PrescriptionDTO])
+_DIAGNOSES_ADAPTER = TypeAdapter(List[DiagnosisDTO])
+
+
+async def get_appointments_by_patient(db: AsyncSession, patient_id: int) -> List[AppointmentDTO]:
     """
-    Obtiene todas las citas de un paciente con información del doctor,
-    ordenadas por fecha descendente.
+    Obtiene las MAX_APPOINTMENTS citas más recientes de un paciente con
+    información del doctor, ordenadas por fecha descendente.
     """
     try:
-        # Query optimizada con DISTINCT ON para evitar duplicados
-        # Toma la primera especialidad activa si el doctor tiene varias
-        query = text("""
-            SELECT DISTINCT ON (a.appointment_id)
-                a.appointment_id,
-                a.patient_id,
-                a.doctor_id,
-                a.room_id,
-                a.appointment_date,
-                a.start_time,
-                a.end_time,
-                a.appointment_type,
-                a.status,
-                a.reason,
-                a.creation_date,
-                d.first_name || ' ' || d.last_name AS doctor_name,
-                s.specialty_name,
-                d.medical_license_number
-            FROM smart_health.appointments a
-            INNER JOIN smart_health.doctors d ON a.doctor_id = d.doctor_id
-            LEFT JOIN smart_health.doctor_specialties ds ON d.doctor_id = ds.doctor_id AND ds.is_active = TRUE
-            LEFT JOIN smart_health.specialties s ON ds.specialty_id = s.specialty_id
-            WHERE a.patient_id = :patient_id
-            ORDER BY a.appointment_id, ds.certification_date DESC NULLS LAST
-        """)
-        
-        result = db.execute(query, {"patient_id": patient_id})
-        rows = result.fetchall()
-        
-        # Convertir a DTOs
-        appointments = []
-        for row in rows:
-            apt_dict = {
-                'appointment_id': row.appointment_id,
-                'patient_id': row.patient_id,
-                'doctor_id': row.doctor_id,
-                'room_id': row.room_id,
-                'appointment_date': row.appointment_date,
-                'start_time': row.start_time,
-                'end_time': row.end_time,
-                'appointment_type': row.appointment_type,
-                'status': row.status,
-                'reason': row.reason,
-                'creation_date': row.creation_date,
-                # Campos del doctor
-                'doctor_name': row.doctor_name,
-                'specialty_name': row.specialty_name,
-                'medical_license_number': row.medical_license_number,
-            }
-            appointments.append(AppointmentDTO(**apt_dict))
-        
-        # Ordenar por fecha después de eliminar duplicados
-        appointments.sort(key=lambda x: (x.appointment_date, x.start_time or x.creation_date), reverse=True)
-        
-        return appointments
-        
+        result = await db.execute(text(_APPOINTMENTS_SQL), {"patient_id": patient_id})
+        return _APPOINTMENTS_ADAPTER.validate_python([dict(r) for r in result.mappings()])
     except Exception:
         logger.exception("Error ejecutando query get_appointments_by_patient")
         raise
 
 
-def get_medical_records_by_patient(db: Session, patient_id: int) -> List[MedicalRecordDTO]:
+async def get_medical_records_by_patient(db: AsyncSession, patient_id: int) -> List[MedicalRecordDTO]:
     """
-    Obtiene todos los registros médicos de un paciente, ordenados por fecha descendente.
+    Obtiene los MAX_MEDICAL_RECORDS registros médicos más recientes de un
+    paciente, ordenados por fecha descendente.
     """
     try:
-        records = (
-            db.query(MedicalRecord)
-            .filter(MedicalRecord.patient_id == patient_id)
-            .order_by(MedicalRecord.registration_datetime.desc())
-            .all()
-        )
+        result = await db.execute(text(_MEDICAL_RECORDS_SQL), {"patient_id": patient_id})
+        return _MEDICAL_RECORDS_ADAPTER.validate_python([dict(r) for r in result.mappings()])
     except Exception:
         logger.exception("Error ejecutando query get_medical_records_by_patient")
         raise
 
-    return [MedicalRecordDTO.from_orm(rec) for rec in records]
-
 
-def get_prescriptions_by_patient(db: Session, patient_id: int) -> List[PrescriptionDTO]:
+async def get_prescriptions_by_patient(db: AsyncSession, patient_id: int) -> List[PrescriptionDTO]:
     """
-    Obtiene todas las prescripciones de un paciente con el nombre del medicamento.
+    Obtiene las MAX_PRESCRIPTIONS prescripciones más recientes de un
+    paciente con el nombre del medicamento.
     """
     try:
-        query = text("""
-            SELECT 
-                p.prescription_id,
-                p.medical_record_id,
-                p.medication_id,
-                p.dosage,
-                p.frequency,
-                p.duration,
-                p.instruction,
-                p.prescription_date,
-                p.alert_generated,
-                COALESCE(m.commercial_name, 'Medicamento no especificado') AS medication_name,
-                m.active_ingredient,
-                m.presentation AS pharmaceutical_form
-            FROM smart_health.prescriptions p
-            INNER JOIN smart_health.medical_records mr 
-                ON p.medical_record_id = mr.medical_record_id
-            LEFT JOIN smart_health.medications m 
-                ON p.medication_id = m.medication_id
-            WHERE mr.patient_id = :patient_id
-            ORDER BY p.prescription_date DESC
-        """)
-        
-        result = db.execute(query, {"patient_id": patient_id})
-        rows = result.fetchall()
-        
-        prescriptions = []
-        for row in rows:
-            presc_dict = {
-                'prescription_id': row.prescription_id,
-                'medical_record_id': row.medical_record_id,
-                'medication_id': row.medication_id,
-                'dosage': row.dosage,
-                'frequency': row.frequency,
-                'duration': row.duration,
-                'instruction': row.instruction,
-                'prescription_date': row.prescription_date,
-                'alert_generated': row.alert_generated,
-                'medication_name': row.medication_name,
-                'active_ingredient': row.active_ingredient,
-                'pharmaceutical_form': row.pharmaceutical_form,
-            }
-            prescriptions.append(PrescriptionDTO(**presc_dict))
-        
-        return prescriptions
-        
+        result = await db.execute(text(_PRESCRIPTIONS_SQL), {"patient_id": patient_id})
+        return _PRESCRIPTIONS_ADAPTER.validate_python([dict(r) for r in result.mappings()])
     except Exception:
         logger.exception("Error ejecutando query get_prescriptions_by_patient")
         raise
 
 
-def get_diagnoses_by_patient(db: Session, patient_id: int) -> List[DiagnosisDTO]:
+async def get_diagnoses_by_patient(db: AsyncSession, patient_id: int) -> List[DiagnosisDTO]:
     """
-    Obtiene todos los diagnósticos de un paciente con la fecha del registro médico.
+    Obtiene los MAX_DIAGNOSES diagnósticos más recientes de un paciente con
+    la fecha del registro médico.
     """
     try:
-        #  Query con SQL directo para obtener la fecha del medical_record
-        query = text("""
-            SELECT 
-                rd.record_diagnosis_id,
-                d.diagnosis_id,
-                d.icd_code,
-                d.description,
-                rd.diagnosis_type,
-                rd.note,
-                mr.registration_datetime AS diagnosis_date
-            FROM smart_health.diagnoses d
-            INNER JOIN smart_health.record_diagnoses rd 
-                ON d.diagnosis_id = rd.diagnosis_id
-            INNER JOIN smart_health.medical_records mr 
-                ON rd.medical_record_id = mr.medical_record_id
-            WHERE mr.patient_id = :patient_id
-            ORDER BY mr.registration_datetime DESC
-        """)
-        
-        result = db.execute(query, {"patient_id": patient_id})
-        rows = result.fetchall()
-        
-        # Convertir a DTOs
-        diagnoses = []
-        for row in rows:
-            diag_dict = {
-                'record_diagnosis_id': row.record_diagnosis_id,
-                'diagnosis_id': row.diagnosis_id,
-                'icd_code': row.icd_code,
-                'description': row.description,
-                'diagnosis_type': row.diagnosis_type,
-                'note': row.note,
-                #  Fecha del diagnóstico (del medical_record)
-                'diagnosis_date': row.diagnosis_date,
-            }
-            diagnoses.append(DiagnosisDTO(**diag_dict))
-        
-        return diagnoses
-        
+        result = await db.execute(text(_DIAGNOSES_SQL), {"patient_id": patient_id})
+        return _DIAGNOSES_ADAPTER.validate_python([dict(r) for r in result.mappings()])
     except Exception:
         logger.exception("Error ejecutando query get_diagnoses_by_patient")
         raise
@@ -270,8 +287,44 @@ def get_diagnoses_by_patient(db: Session, patient_id: int) -> List[DiagnosisDTO]
 # Función principal que integra todo (usada por P1)
 # ============================================================================
 
-def fetch_patient_and_records(
-    db: Session,
+async def fetch_clinical_records(db: AsyncSession, patient: PatientInfo) -> ClinicalDataResult:
+    """
+    Obtiene citas, registros, prescripciones y diagnósticos del paciente
+    en un solo round-trip y con una sola conexión del pool.
+    """
+    try:
+        result = await db.execute(_CLINICAL_RECORDS_SQL, {"patient_id": patient.patient_id})
+        row = result.one()
+    except Exception:
+        logger.exception("Error ejecutando query fetch_clinical_records")
+        raise
+
+    # Agrupar en ClinicalRecords; los contenedores solo envuelven listas de
+    # DTO ya construidos, así que también se arman con model_construct
+    records = ClinicalRecords.model_construct(
+        appointments=_APPOINTMENTS_ADAPTER.validate_json(row.appointments),
+        medical_records=_MEDICAL_RECORDS_ADAPTER.validate_json(row.medical_records),
+        prescriptions=_PRESCRIPTIONS_ADAPTER.validate_json(row.prescriptions),
+        diagnoses=_DIAGNOSES_ADAPTER.validate_json(row.diagnoses)
+    )
+
+    # Determinar si hay datos (P2-5); `or` corta en la primera lista no vacía
+    has_data = bool(
+        records.appointments
+        or records.medical_records
+        or records.prescriptions
+        or records.diagnoses
+    )
+
+    return ClinicalDataResult.model_construct(
+        patient=patient,
+        records=records,
+        has_data=has_data
+    )
+
+
+async def fetch_patient_and_records(
+    db: AsyncSession,
     document_type_id: int,
     document_number: str
 ) -> Tuple[Optional[PatientInfo], ClinicalDataResult]:
@@ -284,41 +337,15 @@ def fetch_patient_and_records(
         - ClinicalDataResult con todos los registros y flag has_data
     """
     # 1. Buscar paciente
-    patient = get_patient_by_document(db, document_type_id, document_number)
+    patient = await get_patient_by_document(db, document_type_id, document_number)
 
     if not patient:
         # Paciente no encontrado
-        return None, ClinicalDataResult(
+        return None, ClinicalDataResult.model_construct(
             patient=None,
-            records=ClinicalRecords(),
+            records=ClinicalRecords.model_construct(),
             has_data=False
         )
 
-    # 2. Obtener todos los registros clínicos
-    appointments = get_appointments_by_patient(db, patient.patient_id)
-    medical_records = get_medical_records_by_patient(db, patient.patient_id)
-    prescriptions = get_prescriptions_by_patient(db, patient.patient_id)
-    diagnoses = get_diagnoses_by_patient(db, patient.patient_id)
-
-    # 3. Agrupar en ClinicalRecords
-    records = ClinicalRecords(
-        appointments=appointments,
-        medical_records=medical_records,
-        prescriptions=prescriptions,
-        diagnoses=diagnoses
-    )
-
-    # 4. Determinar si hay datos (P2-5)
-    has_data = any([
-        len(appointments) > 0,
-        len(medical_records) > 0,
-        len(prescriptions) > 0,
-        len(diagnoses) > 0
-    ])
-
-    # 5. Retornar resultado completo
-    return patient, ClinicalDataResult(
-        patient=patient,
-        records=records,
-        has_data=has_data
-    )
\ No newline at end of file
+    # 2. Obtener todos los registros clínicos (una sola consulta)
+    return patient, await fetch_clinical_records(db, patient)
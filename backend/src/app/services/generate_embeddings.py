@@ -15,7 +15,8 @@ sys.path.append(str(root_dir))
 
 from openai import OpenAI
 from sqlalchemy import text
-from app.database.database import get_db
+from app.database.database import get_sync_db
+from app.database.db_config import settings
 from dotenv import load_dotenv
 
 # Cargar variables de entorno
@@ -26,7 +27,8 @@ client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
 
 def generate_embedding(text: str) -> list:
     """
-    Genera un embedding usando OpenAI text-embedding-ada-002
+    Genera un embedding con el modelo de settings.embedding_model
+    (el mismo que usa la búsqueda vectorial para las preguntas)
     
     Args:
         text: Texto para generar el embedding
@@ -37,7 +39,7 @@ def generate_embedding(text: str) -> list:
     try:
         response = client.embeddings.create(
             input=text,
-            model="text-embedding-ada-002"
+            model=settings.embedding_model
         )
         return response.data[0].embedding
     except Exception as e:
@@ -50,7 +52,7 @@ def update_medical_records_embeddings(limit: int = 100):
     print(" ACTUALIZANDO MEDICAL RECORDS")
     print("="*60)
     
-    db = next(get_db())
+    db = next(get_sync_db())
     
     try:
         # Obtener registros sin embedding usando SQLAlchemy
@@ -93,7 +95,7 @@ def update_patients_embeddings(limit: int = 100):
     print(" ACTUALIZANDO PATIENTS")
     print("="*60)
     
-    db = next(get_db())
+    db = next(get_sync_db())
     
     try:
         result = db.execute(text("""
@@ -139,7 +141,7 @@ def update_doctors_embeddings(limit: int = 100):
     print("‍ ACTUALIZANDO DOCTORS")
     print("="*60)
     
-    db = next(get_db())
+    db = next(get_sync_db())
     
     try:
         result = db.execute(text("""
@@ -183,7 +185,7 @@ def update_appointments_embeddings(limit: int = 100):
     print(" ACTUALIZANDO APPOINTMENTS")
     print("="*60)
     
-    db = next(get_db())
+    db = next(get_sync_db())
     
     try:
         result = db.execute(text("""
@@ -226,7 +228,7 @@ def update_diagnoses_embeddings(limit: int = 100):
     print(" ACTUALIZANDO DIAGNOSES")
     print("="*60)
     
-    db = next(get_db())
+    db = next(get_sync_db())
     
     try:
         result = db.execute(text("""
@@ -268,7 +270,7 @@ def update_medications_embeddings(limit: int = 100):
     print(" ACTUALIZANDO MEDICATIONS")
     print("="*60)
     
-    db = next(get_db())
+    db = next(get_sync_db())
     
     try:
         result = db.execute(text("""
@@ -1,74 +1,126 @@
 # src/app/services/llm_client.py
-from openai import AsyncOpenAI
-from typing import Dict, List
+from typing import TYPE_CHECKING, List, Optional, Set, Tuple
+import asyncio
+import functools
+import importlib.util
 import logging
 from app.database.db_config import settings
 
+if TYPE_CHECKING:
+    from openai import AsyncOpenAI
+
 logger = logging.getLogger(__name__)
 
-class LLMClient:
-    """Cliente para interactuar con OpenAI GPT"""
-    
-    def __init__(self):
-        self.client = AsyncOpenAI(
-            api_key=settings.openai_api_key,
-            timeout=settings.llm_timeout
-        )
-        self.model = settings.llm_model
-        self.temperature = settings.llm_temperature
-        self.max_tokens = settings.llm_max_tokens
+# httpx solo habla HTTP/2 con el paquete h2 instalado (requirements.txt);
+# sin él se queda en HTTP/1.1 con keep-alive en lugar de fallar
+_HTTP2_AVAILABLE = importlib.util.find_spec("h2") is not None
+
+# Tope de peticiones simultáneas a OpenAI por worker, compartido por chat,
+# streams y embeddings: el exceso espera aquí en lugar de sumar 429 que
+# luego hay que reintentar
+openai_semaphore = asyncio.Semaphore(settings.llm_max_concurrency)
+
+
+@functools.cache
+def get_openai_client() -> "AsyncOpenAI":
+    """
+    Único AsyncOpenAI del proceso, creado en el primer uso (import diferido).
     
-    async def generate(self, prompt: str, system_prompt: str) -> Dict:
-        """
-        Genera respuesta del LLM.
-        """
+    LLMService y los embeddings lo comparten: un solo pool de conexiones
+    httpx y un solo handshake TLS que calentar en el startup.
+    """
+    import httpx
+    from openai import AsyncOpenAI
+    return AsyncOpenAI(
+        api_key=settings.openai_api_key,
+        timeout=settings.llm_timeout,
+        # El SDK reintenta 429/5xx/timeouts/errores de red con
+        # backoff exponencial (y respeta Retry-After)
+        max_retries=settings.llm_max_retries,
+        # HTTP/2: las peticiones concurrentes (chat, streams y lotes de
+        # embeddings) se multiplexan sobre una sola conexión TLS que se
+        # mantiene viva entre peticiones
+        http_client=httpx.AsyncClient(
+            http2=_HTTP2_AVAILABLE,
+            timeout=settings.llm_timeout,
+            follow_redirects=True,
+            limits=httpx.Limits(
+                max_connections=settings.llm_max_concurrency * 2,
+                max_keepalive_connections=settings.llm_max_concurrency,
+                keepalive_expiry=60,
+            ),
+        ),
+    )
+
+
+# ============================================================================
+# FUNCIÓN PARA VECTOR SEARCH (Persona 3)
+# ============================================================================
+
+class EmbeddingBatcher:
+    """
+    Agrupa las preguntas que llegan dentro de una ventana corta en una sola
+    llamada a embeddings.create (la API acepta una lista de inputs), así
+    las consultas concurrentes comparten un round-trip HTTP.
+    """
+
+    def __init__(self, window_seconds: float = 0.005, max_batch: int = 100):
+        self.window_seconds = window_seconds
+        self.max_batch = max_batch
+        self._pending: List[Tuple[str, asyncio.Future]] = []
+        self._flush_handle: Optional[asyncio.TimerHandle] = None
+        self._tasks: Set[asyncio.Task] = set()
+
+    async def embed(self, text: str) -> List[float]:
+        """Embedding de un texto, resuelto cuando se procesa su lote"""
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append((text, future))
+
+        if len(self._pending) >= self.max_batch:
+            self._flush()
+        elif self._flush_handle is None:
+            self._flush_handle = loop.call_later(self.window_seconds, self._flush)
+
+        return await future
+
+    def _flush(self) -> None:
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+
+        batch, self._pending = self._pending, []
+        if batch:
+            task = asyncio.get_running_loop().create_task(self._run(batch))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _run(self, batch: List[Tuple[str, asyncio.Future]]) -> None:
+        # Textos repetidos dentro del lote se envían una sola vez
+        texts = list(dict.fromkeys(text for text, _ in batch))
         try:
-            # Preparar parámetros base
-            params = {
-                "model": self.model,
-                "messages": [
-                    {"role": "system", "content": system_prompt},
-                    {"role": "user", "content": prompt}
-                ],
-            }
-            
-            # gpt-5-nano solo acepta temperature=1 (default)
-            # Para otros modelos, usar el configurado
-            if not self.model.startswith("gpt-5"):
-                params["temperature"] = self.temperature
-            
-            # Usar el parámetro correcto según el modelo
-            if self.model.startswith(("gpt-5", "gpt-4.1", "gpt-4o")):
-                params["max_completion_tokens"] = self.max_tokens
-            else:
-                params["max_tokens"] = self.max_tokens
-            
-            response = await self.client.chat.completions.create(**params)
-            
-            result = {
-                "text": response.choices[0].message.content,
-                "model_used": response.model,
-                "tokens_used": response.usage.total_tokens
+            async with openai_semaphore:
+                response = await get_openai_client().embeddings.create(
+                    model=settings.embedding_model,
+                    input=texts
+                )
+            vectors = {
+                texts[item.index]: item.embedding for item in response.data
             }
-            
-            logger.info(f" LLM generó respuesta. Tokens usados: {result['tokens_used']}")
-            return result
-            
+            logger.info(f" Embeddings generados: {len(texts)} texto(s) en un lote")
         except Exception as e:
-            logger.error(f" Error en LLM: {str(e)}")
-            from app.schemas.llm_schemas import LLMError
-            raise LLMError(
-                message="Error al generar respuesta del LLM",
-                details={"error": str(e), "model": self.model}
-            )
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
 
-# Instancia global del cliente
-llm_client = LLMClient()
+        for text, future in batch:
+            if not future.done():
+                future.set_result(vectors[text])
 
 
-# ============================================================================
-# FUNCIÓN PARA VECTOR SEARCH (Persona 3)
-# ============================================================================
+embedding_batcher = EmbeddingBatcher()
+
 
 async def get_embedding(text: str) -> List[float]:
     """
@@ -82,18 +134,8 @@ async def get_embedding(text: str) -> List[float]:
         Lista de floats representando el vector embedding
     """
     try:
-        client = AsyncOpenAI(api_key=settings.openai_api_key)
-        
-        response = await client.embeddings.create(
-            model="text-embedding-3-small",  # Modelo de embeddings de OpenAI
-            input=text
-        )
-        
-        embedding = response.data[0].embedding
-        logger.info(f" Embedding generado: {len(embedding)} dimensiones")
-        
-        return embedding
+        return await embedding_batcher.embed(text)
         
     except Exception as e:
         logger.error(f" Error generando embedding: {str(e)}")
-        raise Exception(f"Error al generar embedding: {str(e)}")
\ No newline at end of file
+        raise Exception(f"Error al generar embedding: {str(e)}")
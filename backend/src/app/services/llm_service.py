@@ -1,116 +1,328 @@
 # src/app/services/llm_service.py
 
-import os
+import hashlib
 import logging
-from typing import Optional
-from openai import AsyncOpenAI
+from typing import TYPE_CHECKING, AsyncIterator, List, Optional
 from pydantic import BaseModel
 from dotenv import load_dotenv
+from app.core.cache import TTLCache
+from app.database.db_config import settings
+from app.services.llm_client import get_openai_client, openai_semaphore
 
 # Cargar variables de entorno
 load_dotenv()
 
+if TYPE_CHECKING:
+    from openai import AsyncOpenAI
+
 logger = logging.getLogger(__name__)
 
+SYSTEM_PROMPT = (
+    "Eres un asistente médico amigable y profesional.\n"
+    "Respondes en un tono conversacional, como en un chat, sin usar símbolos de Markdown como ### o **.\n\n"
+    "INSTRUCCIONES:\n"
+    "1. Responde ÚNICAMENTE con la información del contexto clínico proporcionado.\n"
+    "2. Si no tienes información, di 'No tengo esa información en el historial'.\n"
+    "3. Usa un lenguaje claro y natural, como si hablaras con un colega.\n"
+    "4. Organiza la información de forma cronológica cuando sea relevante.\n"
+    "5. Menciona fechas, medicamentos y diagnósticos de forma natural en el texto.\n"
+    "6. NO uses:\n"
+    "   - Símbolos ### para títulos\n"
+    "   - Asteriscos ** para negritas\n"
+    "   - Guiones - para viñetas\n"
+    "7. En lugar de listas con viñetas, escribe párrafos fluidos.\n"
+    "8. Separa ideas con saltos de línea simples para mejor legibilidad.\n\n"
+    "EJEMPLO DE ESTILO:\n"
+    "Según el historial clínico, el paciente tuvo una cita el 2 de marzo de 2022 para control de presión arterial con la doctora Camila Cárdenas.\n\n"
+    "El 10 de octubre de 2022 acudió a emergencia por síntomas respiratorios.\n\n"
+    "La más reciente fue el 9 de noviembre de 2024, un examen médico de chequeo general con la doctora Carolina Gutiérrez, especialista en medicina física y rehabilitación.\n"
+)
+
+# Mensaje de sistema fijo, armado una sola vez y siempre primero: el prefijo
+# idéntico entre peticiones es el que aprovecha el prompt caching de OpenAI
+_SYSTEM_MESSAGE = {"role": "system", "content": SYSTEM_PROMPT}
+
+
+def prompt_cache_key(patient_id, session_id) -> str:
+    """
+    Clave de prompt caching de OpenAI para (paciente, sesión).
+    
+    OpenAI cachea por su cuenta los prefijos de 1024+ tokens y enruta por el
+    prompt_cache_key: las preguntas de seguimiento de una sesión llegan al
+    servidor que ya tiene system + contexto y solo se cobra completa la
+    pregunta. Se envía un hash, no los identificadores.
+    """
+    return hashlib.blake2b(f"{patient_id}:{session_id}".encode(), digest_size=16).hexdigest()
+
+
+def _cache_options(cache_key: Optional[str]) -> dict:
+    # extra_body: el SDK mínimo de requirements.txt no conoce el parámetro
+    return {"extra_body": {"prompt_cache_key": cache_key}} if cache_key else {}
+
+
+# Respuestas por blake2b(modelo, pregunta normalizada, contexto). El contexto
+# es determinista para un paciente y sus datos: si algo cambia en la BD el
+# contexto cambia y la clave también. Cubre al chat por websocket, que no
+# pasa por el cache de respuestas del router
+ANSWER_CACHE_TTL_SECONDS = 1800
+_answer_cache = TTLCache(maxsize=1024, ttl=ANSWER_CACHE_TTL_SECONDS)
+
+
 class LLMResponse(BaseModel):
     """Respuesta estructurada del LLM."""
     text: str
     confidence: float = 0.85
     model_used: str = "gpt-4"
     tokens_used: int = 0
+    prompt_tokens: int = 0  # tamaño real del contexto enviado, según la API
+
+
+# Respuesta fija cuando no hay datos clínicos: el modelo solo podría decir
+# que no hay información, así que se responde sin llamar a la API
+NO_DATA_TEXT = "No hay información disponible sobre el paciente en los registros clínicos."
+NO_DATA_MODEL = "shortcut"
+NO_DATA_CONFIDENCE = 0.1
+
+# Contexto más corto que esto no tiene nada que resumir
+_MIN_CONTEXT_CHARS = 50
+
+
+def _has_context(context: str, has_data: bool) -> bool:
+    return has_data and len(context.strip()) >= _MIN_CONTEXT_CHARS
 
 
 class LLMService:
     """Servicio para interactuar con OpenAI GPT API."""
 
     def __init__(self):
-        api_key = os.getenv("OPENAI_API_KEY")
-        if not api_key:
+        if not settings.openai_api_key:
             raise ValueError("OPENAI_API_KEY no está configurada en .env")
         
-        self.client = AsyncOpenAI(api_key=api_key)
         self.model = "gpt-4o-mini"
         self.max_tokens = 2000
         
         logger.info(f"LLM Service inicializado. Modelo: {self.model}")
 
+    @property
+    def client(self) -> "AsyncOpenAI":
+        """
+        Cliente de OpenAI compartido (ver get_openai_client), creado en el primer uso.
+        
+        Importar `openai` cuesta ~0.4s; diferirlo acelera el arranque del
+        worker (el import se precarga en segundo plano en el startup).
+        """
+        return get_openai_client()
+
+    async def warm_up(self) -> None:
+        """
+        Abre la conexión (TCP + TLS) del pool del cliente con una petición
+        liviana, para que la primera consulta real no pague el handshake.
+        """
+        await self.client.with_options(timeout=5, max_retries=0).models.list()
+
+    def _answer_cache_key(self, question: str, context: str) -> bytes:
+        digest = hashlib.blake2b(digest_size=16)
+        for part in (self.model, question.strip().lower(), context):
+            digest.update(part.encode())
+            digest.update(b"\0")
+        return digest.digest()
+
+    @staticmethod
+    def _build_messages(question: str, context: str) -> List[dict]:
+        """
+        Mensajes system + user para el contexto clínico y la pregunta.
+        
+        El contexto va antes que la pregunta: system + contexto es el
+        prefijo que se repite entre preguntas sobre el mismo paciente y el
+        que aprovecha el prompt caching; la pregunta queda al final.
+        """
+        user_message = (
+            f"CONTEXTO CLÍNICO:\n{context}\n\n"
+            f"PREGUNTA DEL USUARIO:\n{question}\n\n"
+            "Responde únicamente con la información del contexto."
+        )
+        return [_SYSTEM_MESSAGE, {"role": "user", "content": user_message}]
+
+    async def _completion_stream(
+        self,
+        messages: List[dict],
+        max_tokens: int,
+        cache_key: Optional[str]
+    ) -> AsyncIterator:
+        """
+        Chunks crudos de chat.completions en streaming. Con include_usage el
+        último chunk (sin choices) trae el conteo de tokens. Si el consumidor
+        corta antes se cierra la respuesta HTTP y el modelo deja de generar.
+        
+        El cupo de openai_semaphore se retiene mientras dure el stream.
+        """
+        async with openai_semaphore:
+            raw = await self.client.chat.completions.with_raw_response.create(
+                model=self.model,
+                max_completion_tokens=max_tokens,
+                messages=messages,
+                temperature=0.3,
+                stream=True,
+                stream_options={"include_usage": True},
+                **_cache_options(cache_key),
+            )
+            remaining = raw.headers.get("x-ratelimit-remaining-requests")
+            if remaining is not None:
+                logger.debug(f"Peticiones restantes en la ventana de OpenAI: {remaining}")
+            stream = raw.parse()
+            try:
+                async for chunk in stream:
+                    yield chunk
+            finally:
+                await stream.close()
+
     async def run_llm(
         self,
         question: str,
         context: str,
-        max_tokens: Optional[int] = None
+        max_tokens: Optional[int] = None,
+        has_data: bool = True,
+        cache_key: Optional[str] = None
     ) -> LLMResponse:
         """
         Genera una respuesta usando el modelo del LLM según el contexto clínico entregado.
+        
+        Con has_data=False (o un contexto vacío) retorna NO_DATA_TEXT sin
+        llamar a la API. cache_key (ver prompt_cache_key) agrupa las
+        peticiones que comparten prefijo en el prompt caching de OpenAI.
         """
         
+        if not _has_context(context, has_data):
+            logger.info("Sin datos clínicos: respuesta fija sin llamar al LLM.")
+            return LLMResponse.model_construct(
+                text=NO_DATA_TEXT,
+                confidence=NO_DATA_CONFIDENCE,
+                model_used=NO_DATA_MODEL,
+                tokens_used=0,
+                prompt_tokens=0
+            )
+
         if max_tokens is None:
             max_tokens = self.max_tokens
 
-        system_prompt = (
-            "Eres un asistente médico amigable y profesional.\n"
-            "Respondes en un tono conversacional, como en un chat, sin usar símbolos de Markdown como ### o **.\n\n"
-            "INSTRUCCIONES:\n"
-            "1. Responde ÚNICAMENTE con la información del contexto clínico proporcionado.\n"
-            "2. Si no tienes información, di 'No tengo esa información en el historial'.\n"
-            "3. Usa un lenguaje claro y natural, como si hablaras con un colega.\n"
-            "4. Organiza la información de forma cronológica cuando sea relevante.\n"
-            "5. Menciona fechas, medicamentos y diagnósticos de forma natural en el texto.\n"
-            "6. NO uses:\n"
-            "   - Símbolos ### para títulos\n"
-            "   - Asteriscos ** para negritas\n"
-            "   - Guiones - para viñetas\n"
-            "7. En lugar de listas con viñetas, escribe párrafos fluidos.\n"
-            "8. Separa ideas con saltos de línea simples para mejor legibilidad.\n\n"
-            "EJEMPLO DE ESTILO:\n"
-            "Según el historial clínico, el paciente tuvo una cita el 2 de marzo de 2022 para control de presión arterial con la doctora Camila Cárdenas.\n\n"
-            "El 10 de octubre de 2022 acudió a emergencia por síntomas respiratorios.\n\n"
-            "La más reciente fue el 9 de noviembre de 2024, un examen médico de chequeo general con la doctora Carolina Gutiérrez, especialista en medicina física y rehabilitación.\n"
-        )
+        answer_key = self._answer_cache_key(question, context)
+        cached = _answer_cache.get(answer_key)
+        if cached is not None:
+            logger.info("Respuesta del LLM servida desde cache.")
+            # Sin llamada a la API: no se consumieron tokens
+            return cached.model_copy(update={"tokens_used": 0, "prompt_tokens": 0})
 
-        user_message = (
-            f"CONTEXTO CLÍNICO:\n{context}\n\n"
-            f"PREGUNTA DEL USUARIO:\n{question}\n\n"
-            "Responde únicamente con la información del contexto."
-        )
+        messages = self._build_messages(question, context)
 
         try:
             logger.info("Llamando a la API de OpenAI.")
             logger.debug(f"Longitud del contexto: {len(context)} caracteres.")
 
-            response = await self.client.chat.completions.create(
-                model=self.model,
-                max_completion_tokens=max_tokens,
-                messages=[
-                    {"role": "system", "content": system_prompt},
-                    {"role": "user", "content": user_message}
-                ],
-                temperature=0.3,
-            )
-
-            if not response.choices:
-                raise ValueError("La API retornó una respuesta vacía.")
+            # Se consume en streaming: la conexión recibe datos desde el
+            # primer token (no queda ociosa hasta el final, lo que evita
+            # cortes de proxies por inactividad) y el uso llega al final
+            parts: List[str] = []
+            usage = None
+            async for chunk in self._completion_stream(messages, max_tokens, cache_key):
+                if chunk.usage is not None:
+                    usage = chunk.usage
+                if chunk.choices:
+                    delta = chunk.choices[0].delta.content
+                    if delta:
+                        parts.append(delta)
 
-            response_text = response.choices[0].message.content
+            response_text = "".join(parts)
 
-            if not isinstance(response_text, str) or len(response_text.strip()) < 10:
+            # Una respuesta corta pero no vacía es válida
+            if not response_text.strip():
                 raise ValueError("La respuesta generada no es válida.")
 
             tokens_used = 0
-            if hasattr(response, "usage") and response.usage is not None:
-                tokens_used = getattr(response.usage, "completion_tokens", 0)
+            prompt_tokens = 0
+            if usage is not None:
+                tokens_used = getattr(usage, "completion_tokens", 0)
+                prompt_tokens = getattr(usage, "prompt_tokens", 0)
+                details = getattr(usage, "prompt_tokens_details", None)
+                cached_tokens = getattr(details, "cached_tokens", None)
+                if cached_tokens:
+                    logger.debug(f"Tokens del prompt servidos desde cache: {cached_tokens}/{prompt_tokens}")
 
             logger.info(f"Respuesta del LLM recibida. Tokens usados: {tokens_used}")
 
-            return LLMResponse(
+            # Valores ya verificados arriba: se arma sin revalidar
+            llm_response = LLMResponse.model_construct(
                 text=response_text.strip(),
                 confidence=0.85,
                 model_used=self.model,
-                tokens_used=tokens_used
+                tokens_used=tokens_used,
+                prompt_tokens=prompt_tokens
             )
+            _answer_cache.set(answer_key, llm_response)
+            return llm_response
 
         except Exception as e:
             logger.error(f"Error en la llamada al LLM: {type(e).__name__}: {str(e)}")
+            # Los errores de red se exponen como ConnectionError para que el
+            # llamador decida si reintentar sin importar openai
+            from openai import APIConnectionError
+            if isinstance(e, APIConnectionError):
+                raise ConnectionError(str(e)) from e
+            raise
+
+    async def stream_llm(
+        self,
+        question: str,
+        context: str,
+        max_tokens: Optional[int] = None,
+        has_data: bool = True,
+        cache_key: Optional[str] = None
+    ) -> AsyncIterator[str]:
+        """
+        Igual que run_llm pero entrega el texto a medida que el modelo lo
+        genera (stream=True), así el primer token llega al cliente sin
+        esperar la respuesta completa.
+        """
+        if not _has_context(context, has_data):
+            logger.info("Sin datos clínicos: respuesta fija sin llamar al LLM.")
+            yield NO_DATA_TEXT
+            return
+
+        if max_tokens is None:
+            max_tokens = self.max_tokens
+
+        answer_key = self._answer_cache_key(question, context)
+        cached = _answer_cache.get(answer_key)
+        if cached is not None:
+            logger.info("Respuesta del LLM servida desde cache (streaming).")
+            yield cached.text
+            return
+
+        messages = self._build_messages(question, context)
+
+        try:
+            logger.info("Llamando a la API de OpenAI (streaming).")
+            parts: List[str] = []
+            async for chunk in self._completion_stream(messages, max_tokens, cache_key):
+                if not chunk.choices:
+                    continue
+                delta = chunk.choices[0].delta.content
+                if delta:
+                    parts.append(delta)
+                    yield delta
+
+            # Solo respuestas completas (un stream cortado no llega aquí)
+            text = "".join(parts).strip()
+            if text:
+                _answer_cache.set(answer_key, LLMResponse.model_construct(
+                    text=text,
+                    confidence=0.85,
+                    model_used=self.model,
+                    tokens_used=0,
+                    prompt_tokens=0
+                ))
+
+        except Exception as e:
+            logger.error(f"Error en el streaming del LLM: {type(e).__name__}: {str(e)}")
             raise
 
 
@@ -8,101 +8,226 @@ y los transforma en:
 - Metadatos de rendimiento y trazabilidad.
 """
 
+import heapq
 import tiktoken
-from datetime import date
-from typing import List, Dict, Any
+from datetime import date, time
+from functools import lru_cache
+from typing import List, Dict, Any, Optional
 from app.schemas.clinical import PatientInfo, ClinicalRecords
 from app.schemas.rag import SimilarChunk
 
-def calculate_age(birth_date: date) -> int:
-    """Calcula la edad a partir de la fecha de nacimiento."""
-    today = date.today()
+# Encabezados fijos de las secciones del contexto
+_HEADER_BASIC_INFO = "### Información Básica del Paciente"
+_HEADER_APPOINTMENTS = "\n### Citas Médicas Recientes"
+_HEADER_DIAGNOSES = "\n### Diagnósticos Registrados"
+_HEADER_PRESCRIPTIONS = "\n### Medicamentos Recetados"
+_HEADER_SIMILAR_CHUNKS = "\n### Información Adicional Relevante"
+
+def calculate_age(birth_date: date, today: Optional[date] = None) -> int:
+    """
+    Calcula la edad a partir de la fecha de nacimiento.
+    
+    `today` permite reutilizar la fecha ya leída en la petición; la
+    comparación de tuplas resta 1 si aún no llega el cumpleaños.
+    """
+    if today is None:
+        today = date.today()
     return today.year - birth_date.year - ((today.month, today.day) < (birth_date.month, birth_date.day))
 
+
+@lru_cache(maxsize=1)
+def _encoder():
+    """Codificador cl100k_base, cargado una sola vez por proceso."""
+    return tiktoken.get_encoding("cl100k_base")
+
+
+class _TokenBudget:
+    """
+    Acumula secciones del contexto contando tokens a medida que entran.
+    Cuando una sección no cabe se agrega solo el prefijo que alcanza y se
+    deja de agregar: lo que queda fuera del presupuesto nunca se tokeniza.
+    
+    El total suma los tokens de cada sección más uno por el salto de línea
+    que las une, así que es una cota superior del conteo del texto final.
+    Nunca se arma ni tokeniza el texto completo: solo la sección que
+    desborda se decodifica, recortada al espacio restante.
+    """
+
+    def __init__(self, max_tokens: int):
+        self.remaining = max_tokens
+        self.sections: List[str] = []
+        self.full = False
+
+    def add(self, lines: List[str]) -> bool:
+        """Agrega las líneas como una sección; False si ya no hay espacio."""
+        if self.full:
+            return False
+        section = "\n".join(lines)
+        # encode_ordinary: el texto clínico no lleva tokens especiales, así
+        # que se omite su búsqueda (y un "<|endoftext|>" en una nota no
+        # hace fallar a encode con ValueError)
+        tokens = _encoder().encode_ordinary(section)
+        separator = 1 if self.sections else 0  # salto de línea entre secciones
+        cost = len(tokens) + separator
+        if cost > self.remaining:
+            self.full = True
+            keep = self.remaining - separator
+            if keep > 0:
+                self.sections.append(_encoder().decode(tokens[:keep]))
+                self.remaining = 0
+            return False
+        self.sections.append(section)
+        self.remaining -= cost
+        return True
+
+
+def _appointment_line(appt) -> str:
+    time_str = f" a las {appt.start_time}" if appt.start_time else ""
+    reason_str = f": {appt.reason}" if appt.reason else ""
+    
+    #  Agregar información del doctor si está disponible
+    doctor_info = ""
+    if appt.doctor_name and appt.specialty_name:
+        doctor_info = f" con {appt.doctor_name} ({appt.specialty_name})"
+    elif appt.doctor_name:
+        doctor_info = f" con {appt.doctor_name}"
+    
+    return f"- {appt.appointment_date}{time_str}{doctor_info}{reason_str}"
+
+
+def _diagnosis_line(dx) -> str:
+    desc = dx.description or f"Código CIE: {dx.icd_code or 'N/A'}"
+    return f"- {desc}"
+
+
+def _prescription_line(rx) -> str:
+    if rx.instruction:
+        return f"- {rx.instruction}"
+    if rx.dosage:
+        return f"- Medicamento ID {rx.medication_id}, dosis: {rx.dosage}"
+    return f"- Medicamento ID {rx.medication_id}"
+
+
 def build_context(
     patient: PatientInfo,
     records: ClinicalRecords,
     similar_chunks: List[SimilarChunk],
     max_tokens: int = 4000
 ) -> tuple[str, int]:
-    parts = []
-    name_parts = [
+    budget = _TokenBudget(max_tokens)
+    # filter(None) descarta en C tanto los None como las cadenas vacías
+    full_name = " ".join(filter(None, (
         patient.first_name,
         patient.middle_name,
         patient.first_surname,
         patient.second_surname
-    ]
-    full_name = " ".join(part for part in name_parts if part is not None)
+    )))
     age = calculate_age(patient.birth_date)
 
-    parts.append("### Información Básica del Paciente")
-    parts.append(f"Nombre: {full_name}")
-    parts.append(f"Edad: {age} años")
-    parts.append(f"Género: {patient.gender}")
-    parts.append(f"Documento: {patient.document_number} (Tipo ID: {patient.document_type_id})")
+    budget.add([
+        _HEADER_BASIC_INFO,
+        f"Nombre: {full_name}",
+        f"Edad: {age} años",
+        f"Género: {patient.gender}",
+        f"Documento: {patient.document_number} (Tipo ID: {patient.document_type_id})",
+    ])
 
     if records.appointments:
-        parts.append("\n### Citas Médicas Recientes")
-        sorted_appts = sorted(
+        # Solo se usan las 5 más recientes: nlargest es O(N log 5) y da el
+        # mismo orden (estable) que sorted(reverse=True)[:5]. Sin hora se
+        # usa time.min (no date.min) para no comparar time con date
+        sorted_appts = heapq.nlargest(
+            5,
             records.appointments,
-            key=lambda x: (x.appointment_date, x.start_time or x.end_time or date.min),
-            reverse=True
-        )[:5]
-        for appt in sorted_appts:
-            time_str = f" a las {appt.start_time}" if appt.start_time else ""
-            reason_str = f": {appt.reason}" if appt.reason else ""
-            
-            #  Agregar información del doctor si está disponible
-            doctor_info = ""
-            if appt.doctor_name:
-                doctor_info = f" con {appt.doctor_name}"
-                if appt.specialty_name:
-                    doctor_info += f" ({appt.specialty_name})"
-            
-            parts.append(f"- {appt.appointment_date}{time_str}{doctor_info}{reason_str}")
+            key=lambda x: (x.appointment_date, x.start_time or x.end_time or time.min)
+        )
+        budget.add([_HEADER_APPOINTMENTS, *map(_appointment_line, sorted_appts)])
 
     if records.diagnoses:
-        parts.append("\n### Diagnósticos Registrados")
-        for dx in records.diagnoses:
-            desc = dx.description or f"Código CIE: {dx.icd_code or 'N/A'}"
-            parts.append(f"- {desc}")
+        budget.add([_HEADER_DIAGNOSES, *map(_diagnosis_line, records.diagnoses)])
 
     if records.prescriptions:
-        parts.append("\n### Medicamentos Recetados")
-        for rx in records.prescriptions:
-            if rx.instruction:
-                parts.append(f"- {rx.instruction}")
-            else:
-                med_info = f"Medicamento ID {rx.medication_id}"
-                if rx.dosage:
-                    med_info += f", dosis: {rx.dosage}"
-                parts.append(f"- {med_info}")
-
-    if similar_chunks:
-        parts.append("\n### Información Adicional Relevante")
+        budget.add([_HEADER_PRESCRIPTIONS, *map(_prescription_line, records.prescriptions)])
+
+    if similar_chunks and budget.add([_HEADER_SIMILAR_CHUNKS]):
+        # search_similar_chunks ya ordena y corta a k en SQL (ORDER BY
+        # relevancia + LIMIT por tabla); el orden se asegura aquí para
+        # chunks de otras fuentes y el bucle corta al agotar el presupuesto
         sorted_chunks = sorted(similar_chunks, key=lambda x: x.relevance_score, reverse=True)
         for chunk in sorted_chunks:
-            parts.append(f"[Relevancia: {chunk.relevance_score:.2f}] {chunk.chunk_text}")
-            date_str = f" ({chunk.date.strftime('%Y-%m-%d')})" if chunk.date else ""
+            # isoformat (en C) en lugar de strftime; [:10] recorta la hora
+            date_str = f" ({chunk.date.isoformat()[:10]})" if chunk.date else ""
             
             #  Agregar info del doctor si es appointment
             doctor_info = ""
             if chunk.source_type == "appointment" and chunk.doctor_name:
-                doctor_info = f", Doctor: {chunk.doctor_name}"
                 if chunk.specialty_name:
-                    doctor_info += f" ({chunk.specialty_name})"
+                    doctor_info = f", Doctor: {chunk.doctor_name} ({chunk.specialty_name})"
+                else:
+                    doctor_info = f", Doctor: {chunk.doctor_name}"
             
-            parts.append(f"[Fuente: {chunk.source_type} ID {chunk.source_id}{date_str}{doctor_info}]")
-            parts.append("")
+            # Un chunk por sección: al agotarse el presupuesto no se
+            # formatean ni tokenizan los siguientes
+            if not budget.add([
+                f"[Relevancia: {chunk.relevance_score:.2f}] {chunk.chunk_text}",
+                f"[Fuente: {chunk.source_type} ID {chunk.source_id}{date_str}{doctor_info}]",
+                ""
+            ]):
+                break
+
+    return "\n".join(budget.sections), max_tokens - budget.remaining
+
 
-    full_text = "\n".join(parts)
-    encoder = tiktoken.get_encoding("cl100k_base")
-    tokens = encoder.encode(full_text)
-    if len(tokens) > max_tokens:
-        tokens = tokens[:max_tokens]
-        full_text = encoder.decode(tokens)
+def _doctor_info(name, specialty, medical_license) -> Optional[Dict[str, Any]]:
+    """Bloque "doctor" de una source, o None si no hay nombre ni especialidad."""
+    if not (name or specialty):
+        return None
+    doctor_info = {}
+    if name:
+        doctor_info["name"] = name
+    if specialty:
+        doctor_info["specialty"] = specialty
+    if medical_license:
+        doctor_info["medical_license"] = medical_license
+    return doctor_info
 
-    return full_text, len(tokens)
+
+def _chunk_source(chunk: SimilarChunk) -> Dict[str, Any]:
+    source = {
+        "source_id": None,
+        "type": chunk.source_type,
+        "original_source_id": chunk.source_id,
+        "patient_id": chunk.patient_id,
+        "relevance_score": round(chunk.relevance_score, 3),
+        "text_snippet": chunk.chunk_text[:250]
+    }
+    
+    #  Si es appointment, agregar info del doctor
+    if chunk.source_type == "appointment":
+        doctor_info = _doctor_info(chunk.doctor_name, chunk.specialty_name, chunk.medical_license)
+        if doctor_info:
+            source["doctor"] = doctor_info
+    return source
+
+
+def _appointment_source(appt) -> Dict[str, Any]:
+    source = {
+        "source_id": None,
+        "type": "appointment",
+        "appointment_id": appt.appointment_id,
+        "date": appt.appointment_date,  # orjson la serializa en ISO 8601
+        "text_snippet": (appt.reason or "")[:250],
+        "relevance_score": 0.98  # Alta relevancia para datos directos
+    }
+    
+    #  Agregar info del doctor
+    doctor_info = _doctor_info(appt.doctor_name, appt.specialty_name, appt.medical_license_number)
+    if doctor_info:
+        source["doctor"] = doctor_info
+    
+    if appt.reason:
+        source["reason"] = appt.reason
+    return source
 
 
 def build_sources(
@@ -113,66 +238,13 @@ def build_sources(
     Construye la lista de sources según la especificación del proyecto.
     Incluye información del doctor para appointments.
     """
-    sources = []
-    source_counter = 1
-    
-    # Vector chunks
-    for chunk in similar_chunks:
-        source = {
-            "source_id": source_counter,
-            "type": chunk.source_type,
-            "original_source_id": chunk.source_id,
-            "patient_id": chunk.patient_id,
-            "relevance_score": round(chunk.relevance_score, 3),
-            "text_snippet": chunk.chunk_text[:250]
-        }
-        
-        #  Si es appointment, agregar info del doctor
-        if chunk.source_type == "appointment":
-            if chunk.doctor_name or chunk.specialty_name:
-                doctor_info = {}
-                if chunk.doctor_name:
-                    doctor_info["name"] = chunk.doctor_name
-                if chunk.specialty_name:
-                    doctor_info["specialty"] = chunk.specialty_name
-                if chunk.medical_license:
-                    doctor_info["medical_license"] = chunk.medical_license
-                
-                if doctor_info:
-                    source["doctor"] = doctor_info
-        
-        sources.append(source)
-        source_counter += 1
+    # Vector chunks y luego citas clínicas; el bucle queda en la comprensión
+    sources = [_chunk_source(chunk) for chunk in similar_chunks]
+    sources.extend(map(_appointment_source, records.appointments or ()))
     
-    # Clinical appointments
-    for appt in records.appointments:
-        source = {
-            "source_id": source_counter,
-            "type": "appointment",
-            "appointment_id": appt.appointment_id,
-            "date": appt.appointment_date.isoformat(),
-            "text_snippet": (appt.reason or "")[:250],
-            "relevance_score": 0.98  # Alta relevancia para datos directos
-        }
-        
-        #  Agregar info del doctor
-        if appt.doctor_name or appt.specialty_name:
-            doctor_info = {}
-            if appt.doctor_name:
-                doctor_info["name"] = appt.doctor_name
-            if appt.specialty_name:
-                doctor_info["specialty"] = appt.specialty_name
-            if appt.medical_license_number:
-                doctor_info["medical_license"] = appt.medical_license_number
-            
-            if doctor_info:
-                source["doctor"] = doctor_info
-        
-        if appt.reason:
-            source["reason"] = appt.reason
-        
-        sources.append(source)
-        source_counter += 1
+    # Numeración en una sola pasada al final
+    for sequence, source in enumerate(sources, start=1):
+        source["source_id"] = sequence
     
     return sources
 
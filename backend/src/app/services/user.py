@@ -1,9 +1,20 @@
 # app/services/user_service.py
 
-from sqlalchemy.orm import Session
+from sqlalchemy import delete, select, update
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import aliased
 from ..models.user import User
+from .auth_service import AuthService
+from ..core.security import get_user_cached, invalidate_user_cache
 from typing import Optional, List
 
+# Columnas que update_user puede escribir, fijadas al importar: la clave
+# primaria, las fechas que maneja la BD y el hash (solo lo cambia el flujo
+# de contraseñas) quedan fuera aunque el llamador las envíe
+_UPDATABLE_FIELDS = frozenset(User.__table__.columns.keys()) - {
+    "user_id", "created_at", "updated_at", "password_hash", "is_active"
+}
+
 
 class UserService:
     """
@@ -11,55 +22,74 @@ class UserService:
     """
 
     @staticmethod
-    def get_user_by_id(db: Session, user_id: int) -> Optional[User]:
+    async def get_user_by_id(db: AsyncSession, user_id: int) -> Optional[User]:
         """
         Obtiene un usuario por su ID.
         
         Args:
-            db: Sesión de base de datos
+            db: Sesión async de base de datos
             user_id: ID del usuario
             
         Returns:
-            User si existe, None si no
+            User si existe, None si no (desde el cache de usuarios si está vigente)
         """
-        return db.query(User).filter(User.user_id == user_id).first()
+        return await get_user_cached(db, user_id)
 
     @staticmethod
-    def get_user_by_email(db: Session, email: str) -> Optional[User]:
+    async def get_user_by_email(db: AsyncSession, email: str) -> Optional[User]:
         """
         Obtiene un usuario por su email.
         
         Args:
-            db: Sesión de base de datos
+            db: Sesión async de base de datos
             email: Email del usuario
             
         Returns:
             User si existe, None si no
         """
-        return db.query(User).filter(User.email == email).first()
+        return await AuthService.get_user_by_email(db, email)
 
     @staticmethod
-    def get_all_users(db: Session, skip: int = 0, limit: int = 100) -> List[User]:
+    async def get_all_users(
+        db: AsyncSession,
+        after_user_id: int = 0,
+        limit: int = 100,
+        skip: int = 0
+    ) -> List[User]:
         """
-        Obtiene todos los usuarios con paginación.
+        Obtiene los usuarios por páginas, ordenados por ID.
+        
+        Paginación por keyset: cada página pide los usuarios con ID mayor al
+        último de la anterior, una búsqueda en el índice de la PK que cuesta
+        lo mismo en cualquier página (OFFSET lee y descarta `skip` filas).
         
         Args:
-            db: Sesión de base de datos
-            skip: Número de registros a saltar
+            db: Sesión async de base de datos
+            after_user_id: ID del último usuario de la página anterior
             limit: Número máximo de registros a retornar
+            skip: Registros a saltar (compatibilidad; preferir after_user_id)
             
         Returns:
             Lista de usuarios
         """
-        return db.query(User).offset(skip).limit(limit).all()
+        stmt = (
+            select(User)
+            .where(User.user_id > after_user_id)
+            .order_by(User.user_id)
+            .limit(limit)
+        )
+        if skip:
+            stmt = stmt.offset(skip)
+        result = await db.execute(stmt)
+        return list(result.scalars().all())
 
     @staticmethod
-    def update_user(db: Session, user_id: int, update_data: dict) -> Optional[User]:
+    async def update_user(db: AsyncSession, user_id: int, update_data: dict) -> Optional[User]:
         """
         Actualiza los datos de un usuario.
         
         Args:
-            db: Sesión de base de datos
+            db: Sesión async de base de datos
             user_id: ID del usuario a actualizar
             update_data: Diccionario con los campos a actualizar
             
@@ -70,98 +100,134 @@ class UserService:
             ValueError: Si hay error en la validación
             Exception: Para otros errores
         """
-        user = db.query(User).filter(User.user_id == user_id).first()
-        
-        if not user:
-            return None
-        
-        # Actualizar solo los campos proporcionados
-        for field, value in update_data.items():
-            if value is not None and hasattr(user, field):
-                setattr(user, field, value)
-        
+        # Solo campos editables con valor (los None no borran datos)
+        values = {
+            field: value for field, value in update_data.items()
+            if value is not None and field in _UPDATABLE_FIELDS
+        }
+        if not values:
+            return await db.get(User, user_id)
+        
+        # Un solo UPDATE ... RETURNING en lugar de SELECT + UPDATE + SELECT
+        # (refresh). El subquery del RETURNING ve la fila anterior al
+        # UPDATE: es el email viejo para invalidar su cache de login
+        previous = aliased(User, name="previous")
+        previous_email = (
+            select(previous.email)
+            .where(previous.user_id == user_id)
+            .scalar_subquery()
+            .label("previous_email")
+        )
         try:
-            db.commit()
-            db.refresh(user)
-            return user
+            result = await db.execute(
+                update(User)
+                .where(User.user_id == user_id)
+                .values(**values)
+                .returning(User, previous_email)
+            )
+            row = result.one_or_none()
+            await db.commit()
         except Exception as e:
-            db.rollback()
+            await db.rollback()
             raise Exception(f"Error al actualizar usuario: {str(e)}")
+        
+        if row is None:
+            return None
+        user, old_email = row
+        invalidate_user_cache(user_id)
+        AuthService.invalidate_login_cache(old_email, user.email)
+        return user
+
+    @staticmethod
+    async def _set_active(db: AsyncSession, user_id: int, is_active: bool) -> Optional[str]:
+        """UPDATE ... RETURNING email de is_active; None si el usuario no existe"""
+        result = await db.execute(
+            update(User)
+            .where(User.user_id == user_id)
+            .values(is_active=is_active)
+            .returning(User.email)
+        )
+        email = result.scalar_one_or_none()
+        await db.commit()
+        invalidate_user_cache(user_id)
+        return email
 
     @staticmethod
-    def deactivate_user(db: Session, user_id: int) -> bool:
+    async def deactivate_user(db: AsyncSession, user_id: int) -> bool:
         """
         Desactiva un usuario (soft delete).
         
         Args:
-            db: Sesión de base de datos
+            db: Sesión async de base de datos
             user_id: ID del usuario
             
         Returns:
             True si se desactivó correctamente, False si no existe
         """
-        user = db.query(User).filter(User.user_id == user_id).first()
-        
-        if not user:
-            return False
-        
-        user.is_active = False
-        
         try:
-            db.commit()
-            return True
+            email = await UserService._set_active(db, user_id, False)
         except Exception as e:
-            db.rollback()
+            await db.rollback()
             raise Exception(f"Error al desactivar usuario: {str(e)}")
+        
+        if email is None:
+            return False
+        AuthService.invalidate_login_cache(email)
+        return True
 
     @staticmethod
-    def activate_user(db: Session, user_id: int) -> bool:
+    async def activate_user(db: AsyncSession, user_id: int) -> bool:
         """
         Activa un usuario previamente desactivado.
         
         Args:
-            db: Sesión de base de datos
+            db: Sesión async de base de datos
             user_id: ID del usuario
             
         Returns:
             True si se activó correctamente, False si no existe
         """
-        user = db.query(User).filter(User.user_id == user_id).first()
-        
-        if not user:
-            return False
-        
-        user.is_active = True
-        
         try:
-            db.commit()
-            return True
+            email = await UserService._set_active(db, user_id, True)
         except Exception as e:
-            db.rollback()
+            await db.rollback()
             raise Exception(f"Error al activar usuario: {str(e)}")
+        
+        if email is None:
+            return False
+        AuthService.invalidate_login_cache(email)
+        return True
 
     @staticmethod
-    def delete_user_permanently(db: Session, user_id: int) -> bool:
+    async def delete_user_permanently(db: AsyncSession, user_id: int) -> bool:
         """
         Elimina permanentemente un usuario de la base de datos.
         ADVERTENCIA: Esta operación no se puede deshacer.
         
         Args:
-            db: Sesión de base de datos
+            db: Sesión async de base de datos
             user_id: ID del usuario
             
         Returns:
             True si se eliminó, False si no existe
         """
-        user = db.query(User).filter(User.user_id == user_id).first()
-        
-        if not user:
-            return False
-        
+        # DELETE ... RETURNING: un round-trip sin cargar antes el usuario (y
+        # sin que la sesión intente cargar audit_logs, que es lazy="raise");
+        # el email retornado es el que se invalida en el cache de login
         try:
-            db.delete(user)
-            db.commit()
-            return True
+            result = await db.execute(
+                delete(User)
+                .where(User.user_id == user_id)
+                .returning(User.email)
+            )
+            email = result.scalar_one_or_none()
+            await db.commit()
         except Exception as e:
-            db.rollback()
-            raise Exception(f"Error al eliminar usuario: {str(e)}")
\ No newline at end of file
+            await db.rollback()
+            raise Exception(f"Error al eliminar usuario: {str(e)}")
+        
+        invalidate_user_cache(user_id)
+        if email is None:
+            return False
+        AuthService.invalidate_login_cache(email)
+        return True
\ No newline at end of file
@@ -1,9 +1,15 @@
+from functools import lru_cache
 from typing import List
-from sqlalchemy import text
-from sqlalchemy.orm import Session
+from sqlalchemy import Float, Integer, TextClause, bindparam, text
+from sqlalchemy.exc import DataError, ProgrammingError, SQLAlchemyError
+from sqlalchemy.ext.asyncio import AsyncSession
+import numpy as np
 from app.schemas.rag import SimilarChunk
 from app.services.llm_client import get_embedding
-from app.database.database import SessionLocal
+from app.database.database import new_async_session
+from app.core.cache import TTLCache
+from app.database.db_config import settings
+import hashlib
 import logging
 
 logger = logging.getLogger(__name__)
@@ -14,6 +20,293 @@ MAX_PER_TABLE = 10
 DEFAULT_YEARS_BACK = 5
 DEFAULT_MIN_SCORE = 0.3
 
+# Similitud = producto interno. Los embeddings de OpenAI vienen con norma 1,
+# así que -(a <#> b) es directamente el coseno en [-1, 1] (sin raíz ni
+# normalización por fila) y min_score se interpreta como umbral de coseno.
+# La búsqueda es exacta sobre las filas del paciente (filtro por patient_id)
+
+# "vector" o "halfvec" (ver 06-halfvec-embeddings.sql); la pregunta se
+# castea al mismo tipo que las columnas para usar el operador nativo.
+# El parámetro viaja en formato binario de pgvector (ver _register_vector
+# en database.py): np.float32 para vector (6 KB) o HalfVector para halfvec
+# (3 KB, y el CAST queda sin conversión por hacer en el servidor)
+_VECTOR_TYPE = settings.embedding_type
+
+
+def _query_vector_param(query_embedding):
+    """Embedding de la pregunta en el tipo binario de las columnas"""
+    if _VECTOR_TYPE == "halfvec" and isinstance(query_embedding, np.ndarray):
+        from pgvector import HalfVector
+        return HalfVector(query_embedding)
+    return query_embedding
+
+class VectorStoreError(Exception):
+    """Falla transitoria del vector search (embeddings o conexión a la BD)."""
+
+
+# Embeddings de preguntas por blake2b(modelo, pregunta normalizada). Las preguntas
+# clínicas se repiten mucho ("¿medicación actual?", "¿alergias?"), así que
+# se evita la llamada a la API de embeddings. Se guardan como np.float32
+# de solo lectura (~6 KB por vector de 1536 dimensiones), listos para
+# enviarse como parámetro sin conversión.
+# El modelo va en la clave: al cambiar EMBEDDING_MODEL no se mezclan
+# vectores de espacios distintos
+EMBEDDING_CACHE_TTL_SECONDS = 86400
+_embedding_cache = TTLCache(maxsize=4096, ttl=EMBEDDING_CACHE_TTL_SECONDS)
+
+
+# Resultados (patient_id, pregunta) -> chunks. TTL corto: en un chat las
+# reformulaciones idénticas llegan seguidas y así se evita repetir las
+# cuatro consultas de similitud. Los embeddings clínicos los escribe otro
+# proceso (generate_embeddings), así que no hay invalidación posible aquí:
+# el TTL acota cuánto tarda en verse un registro nuevo
+CHUNKS_CACHE_TTL_SECONDS = 60
+_chunks_cache = TTLCache(maxsize=2048, ttl=CHUNKS_CACHE_TTL_SECONDS)
+
+
+_EMBEDDING_KEY_PREFIX = settings.embedding_model.encode() + b"\0"
+
+
+# Cache semántico: por paciente (y parámetros de búsqueda) se guardan los
+# últimos embeddings con sus chunks. Una pregunta distinta pero casi igual
+# ("¿qué medicamentos toma?" / "¿qué medicamentos está tomando?") reutiliza
+# los chunks si el coseno con alguna supera el umbral, sin tocar la BD. Los
+# embeddings tienen norma 1, así que el coseno es un producto punto
+SEMANTIC_CACHE_MIN_SIMILARITY = 0.92
+SEMANTIC_CACHE_ENTRIES_PER_PATIENT = 16
+_semantic_cache = TTLCache(maxsize=1024, ttl=CHUNKS_CACHE_TTL_SECONDS)
+
+
+def _semantic_lookup(scope: tuple, query_embedding: np.ndarray):
+    """Chunks de una pregunta previa lo bastante similar, o None."""
+    if not isinstance(query_embedding, np.ndarray):
+        return None
+    for vector, chunks in _semantic_cache.get(scope, ()):
+        if float(vector @ query_embedding) >= SEMANTIC_CACHE_MIN_SIMILARITY:
+            return chunks
+    return None
+
+
+def _semantic_store(scope: tuple, query_embedding: np.ndarray, chunks: tuple) -> None:
+    if not isinstance(query_embedding, np.ndarray):
+        return
+    entries = _semantic_cache.get(scope, ())
+    _semantic_cache.set(
+        scope,
+        ((query_embedding, chunks),) + entries[:SEMANTIC_CACHE_ENTRIES_PER_PATIENT - 1]
+    )
+
+
+def _embedding_cache_key(question: str) -> bytes:
+    # Normalizada igual que el cache de respuestas del router: minúsculas
+    # y espacios colapsados, así "¿Alergias?  " y "¿alergias?" (el mismo
+    # botón o pregunta repetida) caen en la misma entrada del cache de
+    # embeddings y del de chunks, sin embedding ni SQL
+    digest = hashlib.blake2b(_EMBEDDING_KEY_PREFIX, digest_size=16)
+    digest.update(" ".join(question.lower().split()).encode())
+    return digest.digest()
+
+
+async def get_question_embedding(question: str) -> np.ndarray:
+    """
+    Embedding de la pregunta como np.float32 (parámetro binario de
+    pgvector), cacheado por contenido.
+    """
+    key = _embedding_cache_key(question)
+    vector = _embedding_cache.get(key)
+    if vector is None:
+        try:
+            embedding = await get_embedding(question)
+        except Exception as e:
+            raise VectorStoreError(f"Error generando embedding: {e}") from e
+        vector = np.asarray(embedding, dtype=np.float32)
+        vector.flags.writeable = False  # compartido entre peticiones
+        _embedding_cache.set(key, vector)
+    return vector
+
+
+# ================================
+# CONSULTAS POR TABLA
+# ================================
+# Todas devuelven las mismas columnas para poder unirse con UNION ALL y
+# resolver las cuatro búsquedas en un solo viaje a la BD. appointment_date
+# es DATE y las demás fechas TIMESTAMP: se castea y se recupera en Python.
+
+_SOURCE_QUERIES = {
+    "appointment": f"""
+        SELECT * FROM (
+            SELECT DISTINCT ON (a.appointment_id)
+                'appointment' AS source_type,
+                a.appointment_id AS source_id,
+                a.patient_id AS patient_id,
+                a.reason AS text,
+                a.appointment_date::timestamp AS date,
+                -(a.reason_embedding <#> CAST(:q_emb AS {_VECTOR_TYPE})) AS relevance_score,
+                d.first_name || ' ' || d.last_name AS doctor_name,
+                s.specialty_name AS specialty_name,
+                d.medical_license_number AS medical_license_number
+            FROM smart_health.appointments a
+            INNER JOIN smart_health.doctors d ON a.doctor_id = d.doctor_id
+            LEFT JOIN smart_health.doctor_specialties ds 
+                   ON d.doctor_id = ds.doctor_id AND ds.is_active = TRUE
+            LEFT JOIN smart_health.specialties s ON ds.specialty_id = s.specialty_id
+            WHERE a.patient_id = :patient_id
+                AND a.reason_embedding IS NOT NULL
+                AND a.reason IS NOT NULL
+                AND a.appointment_date >= NOW() - INTERVAL '5 years'
+            ORDER BY a.appointment_id, ds.certification_date DESC NULLS LAST
+        ) apt
+        ORDER BY relevance_score DESC
+        LIMIT :limit_value
+    """,
+    "medical_record": f"""
+        SELECT
+            'medical_record' AS source_type,
+            medical_record_id AS source_id,
+            patient_id AS patient_id,
+            summary_text AS text,
+            registration_datetime AS date,
+            -(summary_embedding <#> CAST(:q_emb AS {_VECTOR_TYPE})) AS relevance_score,
+            NULL AS doctor_name,
+            NULL AS specialty_name,
+            NULL AS medical_license_number
+        FROM smart_health.medical_records
+        WHERE patient_id = :patient_id
+            AND summary_embedding IS NOT NULL
+            AND summary_text IS NOT NULL
+            AND registration_datetime >= NOW() - INTERVAL '5 years'
+        ORDER BY summary_embedding <#> CAST(:q_emb AS {_VECTOR_TYPE})
+        LIMIT :limit_value
+    """,
+    "diagnosis": f"""
+        SELECT
+            'diagnosis' AS source_type,
+            d.diagnosis_id AS source_id,
+            mr.patient_id AS patient_id,
+            d.icd_code || ' - ' || d.description AS text,
+            mr.registration_datetime AS date,
+            -(d.description_embedding <#> CAST(:q_emb AS {_VECTOR_TYPE})) AS relevance_score,
+            NULL AS doctor_name,
+            NULL AS specialty_name,
+            NULL AS medical_license_number
+        FROM smart_health.diagnoses d
+        INNER JOIN smart_health.record_diagnoses rd 
+                ON d.diagnosis_id = rd.diagnosis_id
+        INNER JOIN smart_health.medical_records mr 
+                ON rd.medical_record_id = mr.medical_record_id
+        WHERE mr.patient_id = :patient_id
+            AND d.description_embedding IS NOT NULL
+            AND d.description IS NOT NULL
+            AND mr.registration_datetime >= NOW() - INTERVAL '5 years'
+        ORDER BY d.description_embedding <#> CAST(:q_emb AS {_VECTOR_TYPE})
+        LIMIT :limit_value
+    """,
+    "prescription": f"""
+        SELECT
+            'prescription' AS source_type,
+            p.prescription_id AS source_id,
+            mr.patient_id AS patient_id,
+            m.commercial_name || ' - ' || 
+            COALESCE(p.dosage, '') || ' - ' || 
+            COALESCE(p.frequency, '') AS text,
+            p.prescription_date AS date,
+            -(m.medication_embedding <#> CAST(:q_emb AS {_VECTOR_TYPE})) AS relevance_score,
+            NULL AS doctor_name,
+            NULL AS specialty_name,
+            NULL AS medical_license_number
+        FROM smart_health.prescriptions p
+        INNER JOIN smart_health.medical_records mr 
+                ON p.medical_record_id = mr.medical_record_id
+        INNER JOIN smart_health.medications m 
+                ON p.medication_id = m.medication_id
+        WHERE mr.patient_id = :patient_id
+            AND m.medication_embedding IS NOT NULL
+            AND m.commercial_name IS NOT NULL
+            AND p.prescription_date >= NOW() - INTERVAL '5 years'
+        ORDER BY m.medication_embedding <#> CAST(:q_emb AS {_VECTOR_TYPE})
+        LIMIT :limit_value
+    """,
+}
+
+# Tipos de los parámetros enteros: el dialecto de psycopg los emite como
+# %(x)s::INTEGER, así cada ejecución envía los mismos tipos (psycopg elige
+# int2/int4/int8 según el valor) y el prepared statement que psycopg crea
+# tras unas ejecuciones se reutiliza en lugar de preparar uno por variante.
+# q_emb no se tipa: viaja como float32 binario de pgvector y ya se castea
+_SOURCE_BINDS = (
+    bindparam("patient_id", type_=Integer),
+    bindparam("limit_value", type_=Integer),
+)
+
+# Consulta de una sola tabla (camino de respaldo si la unión falla),
+# armada una sola vez al importar
+_SOURCE_SQL = {
+    source: text(sql).bindparams(*_SOURCE_BINDS)
+    for source, sql in _SOURCE_QUERIES.items()
+}
+
+
+@lru_cache(maxsize=16)
+def _union_sql(sources: tuple) -> TextClause:
+    """
+    Las consultas de `sources` unidas en una sola sentencia (cacheada).
+    
+    Cada tabla conserva su ORDER BY distancia + LIMIT (lo que puede servir
+    un índice ANN); el umbral de score y el top-k global se aplican afuera,
+    así por la red solo viajan las k filas que se usan.
+    """
+    union = " UNION ALL ".join(f"({_SOURCE_QUERIES[source]})" for source in sources)
+    return text(
+        f"SELECT * FROM ({union}) chunks"
+        " WHERE relevance_score >= :min_score"
+        " ORDER BY relevance_score DESC"
+        " LIMIT :k"
+    ).bindparams(*_SOURCE_BINDS, bindparam("min_score", type_=Float), bindparam("k", type_=Integer))
+
+
+def _row_to_chunk(row) -> SimilarChunk:
+    # Filas ya tipadas por el driver (datos internos): model_construct
+    # arma cada chunk sin pasar por el validador de pydantic. Las columnas
+    # se desempacan por posición (el mismo orden en todas las consultas)
+    # en lugar de leerse una a una por nombre
+    (source_type, source_id, patient_id, chunk_text, chunk_date,
+     relevance_score, doctor_name, specialty_name, medical_license) = row
+    if source_type == "appointment" and chunk_date is not None:
+        chunk_date = chunk_date.date()
+    return SimilarChunk.model_construct(
+        source_type=source_type,
+        source_id=source_id,
+        patient_id=patient_id,
+        chunk_text=chunk_text,
+        date=chunk_date,
+        relevance_score=float(relevance_score),
+        doctor_name=doctor_name,
+        specialty_name=specialty_name,
+        medical_license=medical_license,
+    )
+
+
+async def _search_per_table(db: AsyncSession, sources: tuple, params: dict) -> tuple[list, bool]:
+    """
+    Una consulta por tabla: si una falla (p. ej. falta su columna de
+    embeddings) se descarta solo esa tabla y se limpia la transacción para
+    que las siguientes puedan correr.
+    
+    Returns:
+        (filas, complete); complete es False si alguna tabla falló
+    """
+    rows = []
+    complete = True
+    for source in sources:
+        try:
+            result = await db.execute(_SOURCE_SQL[source], params)
+            rows.extend(result.fetchall())
+        except (ProgrammingError, DataError) as e:
+            logger.error(f"Error al consultar {source}: {e}")
+            await db.rollback()
+            complete = False
+    return rows, complete
+
 
 async def search_similar_chunks(
     patient_id: int,
@@ -21,238 +314,86 @@ async def search_similar_chunks(
     k: int = DEFAULT_TOP_K,
     min_score: float = DEFAULT_MIN_SCORE,
     allowed_sources: list[str] | None = None,
+    query_embedding: np.ndarray | None = None,
 ) -> List[SimilarChunk]:
     """
     Devuelve los k chunks más relevantes para la pregunta de un paciente.
 
-    Fuentes consultadas:
+    Fuentes consultadas (en una sola sentencia UNION ALL):
     - appointments
     - medical_records
     - diagnoses
     - prescriptions
-    """
-
-    # Generar embedding de la pregunta
-    question_embedding = await get_embedding(question)
 
-    if isinstance(question_embedding, list):
-        embedding_str = '[' + ','.join(map(str, question_embedding)) + ']'
-    else:
-        embedding_str = question_embedding
+    `query_embedding` permite pasar el vector ya calculado con
+    get_question_embedding (p. ej. en paralelo con la búsqueda del paciente).
+    """
 
-    db: Session = SessionLocal()
-    try:
-        chunks: List[SimilarChunk] = []
+    cache_key = (
+        patient_id,
+        _embedding_cache_key(question),
+        k,
+        min_score,
+        tuple(allowed_sources) if allowed_sources is not None else None
+    )
+    cached = _chunks_cache.get(cache_key)
+    if cached is not None:
+        return list(cached)
 
-        # ================================
-        # 1. APPOINTMENTS
-        # ================================
-        try:
-            sql_appointments = text("""
-                SELECT DISTINCT ON (a.appointment_id)
-                    a.appointment_id AS source_id,
-                    a.patient_id AS patient_id,
-                    a.reason AS text,
-                    a.appointment_date AS date,
-                    d.first_name || ' ' || d.last_name AS doctor_name,
-                    s.specialty_name,
-                    d.medical_license_number,
-                    1 - (a.reason_embedding <-> CAST(:q_emb AS vector)) AS relevance_score
-                FROM smart_health.appointments a
-                INNER JOIN smart_health.doctors d ON a.doctor_id = d.doctor_id
-                LEFT JOIN smart_health.doctor_specialties ds 
-                       ON d.doctor_id = ds.doctor_id AND ds.is_active = TRUE
-                LEFT JOIN smart_health.specialties s ON ds.specialty_id = s.specialty_id
-                WHERE a.patient_id = :patient_id
-                    AND a.reason_embedding IS NOT NULL
-                    AND a.reason IS NOT NULL
-                    AND a.appointment_date >= NOW() - INTERVAL '5 years'
-                ORDER BY a.appointment_id, 
-                         ds.certification_date DESC NULLS LAST, 
-                         a.reason_embedding <-> CAST(:q_emb AS vector)
-                LIMIT :limit_value
-            """)
-
-            rows = db.execute(
-                sql_appointments,
-                {
-                    "patient_id": patient_id,
-                    "q_emb": embedding_str,
-                    "limit_value": min(k, MAX_PER_TABLE),
-                },
-            ).fetchall()
-
-            for row in rows:
-                chunks.append(
-                    SimilarChunk(
-                        source_type="appointment",
-                        source_id=row.source_id,
-                        patient_id=row.patient_id,
-                        chunk_text=row.text,
-                        date=row.date,
-                        relevance_score=float(row.relevance_score),
-                        doctor_name=row.doctor_name,
-                        specialty_name=row.specialty_name,
-                        medical_license=row.medical_license_number,
-                    )
-                )
-        except Exception as e:
-            logger.error(f"Error al consultar appointments: {e}")
+    # Las tablas excluidas por allowed_sources ni siquiera se consultan
+    sources = tuple(
+        source for source in _SOURCE_QUERIES
+        if allowed_sources is None or source in allowed_sources
+    )
+    if not sources:
+        return []
 
-        # ================================
-        # 2. MEDICAL RECORDS
-        # ================================
-        try:
-            sql_medical_records = text("""
-                SELECT
-                    medical_record_id AS source_id,
-                    patient_id AS patient_id,
-                    summary_text AS text,
-                    registration_datetime AS date,
-                    1 - (summary_embedding <-> CAST(:q_emb AS vector)) AS relevance_score
-                FROM smart_health.medical_records
-                WHERE patient_id = :patient_id
-                    AND summary_embedding IS NOT NULL
-                    AND summary_text IS NOT NULL
-                    AND registration_datetime >= NOW() - INTERVAL '5 years'
-                ORDER BY summary_embedding <-> CAST(:q_emb AS vector)
-                LIMIT :limit_value
-            """)
-
-            rows_mr = db.execute(
-                sql_medical_records,
-                {
-                    "patient_id": patient_id,
-                    "q_emb": embedding_str,
-                    "limit_value": min(k, MAX_PER_TABLE),
-                },
-            ).fetchall()
-
-            for row in rows_mr:
-                chunks.append(
-                    SimilarChunk(
-                        source_type="medical_record",
-                        source_id=row.source_id,
-                        patient_id=row.patient_id,
-                        chunk_text=row.text,
-                        date=row.date,
-                        relevance_score=float(row.relevance_score),
-                    )
-                )
-        except Exception as e:
-            logger.error(f"Error al consultar medical_records: {e}")
+    # Generar embedding de la pregunta (cacheado por contenido)
+    if query_embedding is None:
+        query_embedding = await get_question_embedding(question)
 
-        # ================================
-        # 3. DIAGNOSES
-        # ================================
-        try:
-            sql_diagnoses = text("""
-                SELECT
-                    d.diagnosis_id AS source_id,
-                    mr.patient_id AS patient_id,
-                    d.icd_code || ' - ' || d.description AS text,
-                    mr.registration_datetime AS date,
-                    1 - (d.description_embedding <-> CAST(:q_emb AS vector)) AS relevance_score
-                FROM smart_health.diagnoses d
-                INNER JOIN smart_health.record_diagnoses rd 
-                        ON d.diagnosis_id = rd.diagnosis_id
-                INNER JOIN smart_health.medical_records mr 
-                        ON rd.medical_record_id = mr.medical_record_id
-                WHERE mr.patient_id = :patient_id
-                    AND d.description_embedding IS NOT NULL
-                    AND d.description IS NOT NULL
-                    AND mr.registration_datetime >= NOW() - INTERVAL '5 years'
-                ORDER BY d.description_embedding <-> CAST(:q_emb AS vector)
-                LIMIT :limit_value
-            """)
-
-            rows_diag = db.execute(
-                sql_diagnoses,
-                {
-                    "patient_id": patient_id,
-                    "q_emb": embedding_str,
-                    "limit_value": min(k, MAX_PER_TABLE),
-                },
-            ).fetchall()
-
-            for row in rows_diag:
-                chunks.append(
-                    SimilarChunk(
-                        source_type="diagnosis",
-                        source_id=row.source_id,
-                        patient_id=row.patient_id,
-                        chunk_text=row.text,
-                        date=row.date,
-                        relevance_score=float(row.relevance_score),
-                    )
-                )
-        except Exception as e:
-            logger.error(f"Error al consultar diagnoses: {e}")
+    # Misma búsqueda salvo la pregunta: clave del cache semántico
+    semantic_scope = (patient_id, *cache_key[2:])
+    similar = _semantic_lookup(semantic_scope, query_embedding)
+    if similar is not None:
+        logger.info("Chunks servidos desde el cache semántico")
+        _chunks_cache.set(cache_key, similar)
+        return list(similar)
+    params = {
+        "patient_id": patient_id,
+        "q_emb": _query_vector_param(query_embedding),
+        "limit_value": min(k, MAX_PER_TABLE),
+        "min_score": min_score,
+        "k": k,
+    }
 
-        # ================================
-        # 4. PRESCRIPTIONS
-        # ================================
+    db: AsyncSession = new_async_session()
+    try:
+        complete = True  # False si alguna tabla falló: no se cachea
         try:
-            sql_prescriptions = text("""
-                SELECT
-                    p.prescription_id AS source_id,
-                    mr.patient_id AS patient_id,
-                    m.commercial_name || ' - ' || 
-                    COALESCE(p.dosage, '') || ' - ' || 
-                    COALESCE(p.frequency, '') AS text,
-                    p.prescription_date AS date,
-                    1 - (m.medication_embedding <-> CAST(:q_emb AS vector)) AS relevance_score
-                FROM smart_health.prescriptions p
-                INNER JOIN smart_health.medical_records mr 
-                        ON p.medical_record_id = mr.medical_record_id
-                INNER JOIN smart_health.medications m 
-                        ON p.medication_id = m.medication_id
-                WHERE mr.patient_id = :patient_id
-                    AND m.medication_embedding IS NOT NULL
-                    AND m.commercial_name IS NOT NULL
-                    AND p.prescription_date >= NOW() - INTERVAL '5 years'
-                ORDER BY m.medication_embedding <-> CAST(:q_emb AS vector)
-                LIMIT :limit_value
-            """)
-
-            rows_presc = db.execute(
-                sql_prescriptions,
-                {
-                    "patient_id": patient_id,
-                    "q_emb": embedding_str,
-                    "limit_value": min(k, MAX_PER_TABLE),
-                },
-            ).fetchall()
-
-            for row in rows_presc:
-                chunks.append(
-                    SimilarChunk(
-                        source_type="prescription",
-                        source_id=row.source_id,
-                        patient_id=row.patient_id,
-                        chunk_text=row.text,
-                        date=row.date,
-                        relevance_score=float(row.relevance_score),
-                    )
-                )
-        except Exception as e:
-            logger.error(f"Error al consultar prescriptions: {e}")
+            # Filas ya filtradas por score, ordenadas y cortadas a k en SQL
+            result = await db.execute(_union_sql(sources), params)
+            chunks = [_row_to_chunk(row) for row in result.fetchall()]
+        except (ProgrammingError, DataError) as e:
+            # Un error de una tabla invalida toda la unión: se repite tabla
+            # por tabla para conservar los resultados de las demás
+            logger.error(f"Error en la búsqueda vectorial combinada: {e}")
+            await db.rollback()
+            rows, complete = await _search_per_table(db, sources, params)
 
-        # ================================
-        # FILTRADO FINAL
-        # ================================
-        chunks = [c for c in chunks if c.relevance_score >= min_score]
-
-        if allowed_sources is not None:
-            chunks = [c for c in chunks if c.source_type in allowed_sources]
-
-        chunks.sort(key=lambda c: c.relevance_score, reverse=True)
-        chunks = chunks[:k]
+            # ================================
+            # FILTRADO FINAL (solo sin la unión)
+            # ================================
+            chunks = [_row_to_chunk(row) for row in rows if row.relevance_score >= min_score]
+            chunks.sort(key=lambda c: c.relevance_score, reverse=True)
+            chunks = chunks[:k]
 
+        if complete:
+            _chunks_cache.set(cache_key, tuple(chunks))
+            _semantic_store(semantic_scope, query_embedding, tuple(chunks))
         return chunks
 
-    except Exception as e:
-        logger.error(f"Error general en vector search: {e}")
-        return []
+    except SQLAlchemyError as e:
+        raise VectorStoreError(f"Error general en vector search: {e}") from e
     finally:
-        db.close()
+        await db.close()
@@ -0,0 +1,93 @@
+-- ##################################################
+-- #   SMART HEALTH PERFORMANCE INDEXES SCRIPT      #
+-- ##################################################
+-- This script adds indexes that back the API's hot query paths.
+-- Indexes are created CONCURRENTLY so they can be applied to a live
+-- database without blocking writes; therefore this script must NOT be
+-- wrapped in a transaction (the DDL pipeline runs with autocommit).
+-- Target DBMS: PostgreSQL 11+ (INCLUDE columns)
+
+-- ##################################################
+-- #               USERS / LOGIN                    #
+-- ##################################################
+
+-- Index 1: users (login)
+-- El login busca por email y solo lee user_id, password_hash e is_active:
+-- con estas columnas en INCLUDE Postgres responde con un index-only scan
+-- sin visitar el heap
+CREATE UNIQUE INDEX CONCURRENTLY IF NOT EXISTS ix_users_email_login
+ON smart_health.users (email)
+INCLUDE (user_id, password_hash, is_active);
+
+COMMENT ON INDEX smart_health.ix_users_email_login
+IS 'Índice cubriente para el login: email -> (user_id, password_hash, is_active)';
+
+
+-- ##################################################
+-- #      CLINICAL RECORDS / VECTOR SEARCH          #
+-- ##################################################
+-- La búsqueda vectorial siempre filtra por paciente: con estos índices
+-- Postgres llega directo a las filas del paciente y calcula el producto
+-- interno exacto sobre unas decenas de vectores (el equivalente a un
+-- sub-índice por paciente). Un índice ANN global (HNSW/IVFFlat) no sirve
+-- aquí: filtra después de recorrer el grafo y con un predicado tan
+-- selectivo devuelve menos de k filas. Los mismos índices cubren las
+-- consultas de fetch_clinical_records.
+
+-- Index 2: appointments por paciente y fecha
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_appointments_patient_date
+ON smart_health.appointments (patient_id, appointment_date DESC);
+
+COMMENT ON INDEX smart_health.ix_appointments_patient_date
+IS 'Citas de un paciente ordenadas por fecha (historial y búsqueda vectorial)';
+
+-- Index 3: medical_records por paciente y fecha
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_medical_records_patient_datetime
+ON smart_health.medical_records (patient_id, registration_datetime DESC);
+
+COMMENT ON INDEX smart_health.ix_medical_records_patient_datetime
+IS 'Registros médicos de un paciente ordenados por fecha';
+
+-- Index 4: prescriptions por registro médico
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_prescriptions_medical_record
+ON smart_health.prescriptions (medical_record_id);
+
+COMMENT ON INDEX smart_health.ix_prescriptions_medical_record
+IS 'Join prescriptions -> medical_records al filtrar por paciente';
+
+-- Index 5: record_diagnoses por registro médico
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_record_diagnoses_medical_record
+ON smart_health.record_diagnoses (medical_record_id);
+
+COMMENT ON INDEX smart_health.ix_record_diagnoses_medical_record
+IS 'Join record_diagnoses -> medical_records al filtrar por paciente';
+
+-- Index 6: citas con embedding por paciente y fecha (parcial)
+-- Mismo predicado que la búsqueda vectorial de citas: solo entran las filas
+-- con reason y reason_embedding, así el escaneo por paciente no visita en
+-- el heap las citas sin embedding. El filtro de 5 años usa NOW() (no
+-- inmutable) y no puede ir en el predicado; lo resuelve el rango sobre
+-- appointment_date. Tampoco se puede cubrir el vector con INCLUDE: 6 KB
+-- (3 KB en halfvec) exceden el tamaño máximo de una entrada de B-tree
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_appointments_patient_date_embedded
+ON smart_health.appointments (patient_id, appointment_date DESC)
+WHERE reason_embedding IS NOT NULL AND reason IS NOT NULL;
+
+COMMENT ON INDEX smart_health.ix_appointments_patient_date_embedded
+IS 'Citas con embedding de un paciente por fecha (búsqueda vectorial de citas)';
+
+-- Index 7: audit_logs por sesión y secuencia
+-- El historial de una sesión filtra por session_id y ordena por
+-- sequence_chat_id; la siembra de chat_session_counters (07) toma el
+-- MAX(sequence_chat_id) de cada sesión. Ambos resuelven con un descenso
+-- del índice (el orden DESC se lee recorriéndolo hacia atrás) sin sort
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_audit_logs_session_sequence
+ON smart_health.audit_logs (session_id, sequence_chat_id DESC);
+
+COMMENT ON INDEX smart_health.ix_audit_logs_session_sequence
+IS 'Mensajes de una sesión de chat por secuencia (historial y última secuencia)';
+
+
+-- ##################################################
+-- #                 END OF SCRIPT                  #
+-- ##################################################
@@ -0,0 +1,57 @@
+-- ##################################################
+-- #   SMART HEALTH HALFVEC EMBEDDINGS SCRIPT       #
+-- ##################################################
+-- OPCIONAL: convierte a halfvec (float16) las columnas de embeddings que
+-- usa la búsqueda vectorial del API. Cada vector de 1536 dimensiones pasa
+-- de 6 KB a 3 KB, así que cada consulta lee la mitad de bytes; la pérdida
+-- de precisión no afecta el ranking por coseno de vectores normalizados.
+-- No está registrado en el pipeline automático: aplicarlo a mano y luego
+-- configurar EMBEDDING_TYPE=halfvec en el backend.
+-- Target DBMS: PostgreSQL with pgvector >= 0.7.0 (halfvec)
+
+BEGIN;
+
+-- Los índices IVFFlat con vector_cosine_ops no aplican a halfvec:
+-- se eliminan y se recrean con halfvec_cosine_ops
+DROP INDEX IF EXISTS smart_health.idx_medical_records_summary_embedding;
+DROP INDEX IF EXISTS smart_health.idx_appointments_reason_embedding;
+DROP INDEX IF EXISTS smart_health.idx_diagnoses_description_embedding;
+DROP INDEX IF EXISTS smart_health.idx_medications_embedding;
+
+ALTER TABLE smart_health.medical_records
+ALTER COLUMN summary_embedding TYPE halfvec(1536) USING summary_embedding::halfvec(1536);
+
+ALTER TABLE smart_health.appointments
+ALTER COLUMN reason_embedding TYPE halfvec(1536) USING reason_embedding::halfvec(1536);
+
+ALTER TABLE smart_health.diagnoses
+ALTER COLUMN description_embedding TYPE halfvec(1536) USING description_embedding::halfvec(1536);
+
+ALTER TABLE smart_health.medications
+ALTER COLUMN medication_embedding TYPE halfvec(1536) USING medication_embedding::halfvec(1536);
+
+CREATE INDEX IF NOT EXISTS idx_medical_records_summary_embedding
+ON smart_health.medical_records
+USING ivfflat (summary_embedding halfvec_cosine_ops)
+WITH (lists = 100);
+
+CREATE INDEX IF NOT EXISTS idx_appointments_reason_embedding
+ON smart_health.appointments
+USING ivfflat (reason_embedding halfvec_cosine_ops)
+WITH (lists = 100);
+
+CREATE INDEX IF NOT EXISTS idx_diagnoses_description_embedding
+ON smart_health.diagnoses
+USING ivfflat (description_embedding halfvec_cosine_ops)
+WITH (lists = 100);
+
+CREATE INDEX IF NOT EXISTS idx_medications_embedding
+ON smart_health.medications
+USING ivfflat (medication_embedding halfvec_cosine_ops)
+WITH (lists = 100);
+
+COMMIT;
+
+-- ##################################################
+-- #                 END OF SCRIPT                  #
+-- ##################################################
@@ -0,0 +1,30 @@
+-- ##################################################
+-- #   SMART HEALTH CHAT SESSION COUNTERS SCRIPT    #
+-- ##################################################
+-- Contador por sesión de chat para sequence_chat_id. El API reserva cada
+-- número con un solo upsert (INSERT ... ON CONFLICT DO UPDATE ... RETURNING):
+-- una búsqueda por PK y el lock de una fila, sin carreras entre consultas
+-- simultáneas de la misma sesión.
+-- Target DBMS: PostgreSQL
+
+BEGIN;
+
+-- Table: chat_session_counters
+-- Brief: Last sequence_chat_id assigned per chat session
+CREATE TABLE IF NOT EXISTS smart_health.chat_session_counters (
+    session_id UUID PRIMARY KEY,
+    last_seq INTEGER NOT NULL
+);
+
+COMMENT ON TABLE smart_health.chat_session_counters IS 'Last sequence_chat_id assigned per chat session.';
+COMMENT ON COLUMN smart_health.chat_session_counters.session_id IS 'Session identifier for the chat.';
+COMMENT ON COLUMN smart_health.chat_session_counters.last_seq IS 'Last message sequence number assigned in the session.';
+
+-- Sesiones existentes: continúan desde su último mensaje registrado
+INSERT INTO smart_health.chat_session_counters (session_id, last_seq)
+SELECT session_id, MAX(sequence_chat_id)
+FROM smart_health.audit_logs
+GROUP BY session_id
+ON CONFLICT (session_id) DO NOTHING;
+
+COMMIT;
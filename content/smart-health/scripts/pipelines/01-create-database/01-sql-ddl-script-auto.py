@@ -16,7 +16,9 @@ SQL_FILES = [
     '01-create-database.sql',
     '02-create-tables.sql',
     '03-alter-tables.sql',
-    '04-create-embeddings.sql'
+    '04-create-embeddings.sql',
+    '05-create-performance-indexes.sql',
+    '07-create-chat-session-counters.sql'
 ]
 
 # ============================================
@@ -155,7 +157,8 @@ def main():
             execute_custom_script(filepath,'Database Creation',SQL_FILES[0],sql_dir,
                                   args.host, args.port, args.user, args.password, dbname='postgres')
         else:
-            sql_scripts_descriptions = ['Tables Creation', 'Alter Tables', 'Create Embeddings']
+            sql_scripts_descriptions = ['Tables Creation', 'Alter Tables', 'Create Embeddings', 'Performance Indexes',
+                                        'Chat Session Counters']
             for i in range(len(SQL_FILES[1:])):
                 
                 filepath = os.path.join(sql_dir, SQL_FILES[1:][i])
@@ -0,0 +1,22 @@
+# gunicorn.conf.py
+# Gunicorn lo carga automáticamente desde el directorio de trabajo (/app).
+
+import os
+
+
+def post_fork(server, worker):
+    """
+    Con --preload la app se importa en el master antes del fork; si algún
+    engine llegó a abrir conexiones, el worker no debe reutilizarlas.
+    """
+    from app.database.database import reset_engines_after_fork
+
+    reset_engines_after_fork()
+
+    # Opcional: fijar cada worker a un núcleo (round-robin) para conservar
+    # cachés de CPU calientes. Solo tiene sentido con núcleos dedicados
+    if os.getenv("WORKER_CPU_AFFINITY") == "1" and hasattr(os, "sched_setaffinity"):
+        cpus = sorted(os.sched_getaffinity(0))
+        cpu = cpus[worker.age % len(cpus)]
+        os.sched_setaffinity(0, {cpu})
+        server.log.info("Worker %s fijado a la CPU %s", worker.pid, cpu)